@@ -0,0 +1,136 @@
+import asyncio
+import threading
+import concurrent.futures
+from typing import Any, Callable, Coroutine, List, Optional, Set
+
+from PyQt5.QtCore import QObject, pyqtSignal
+
+DEFAULT_RUNTIME_WORKERS = 8
+
+class _QtDispatcher(QObject):
+    """
+    Runs callables on the thread that owns it, which is the GUI thread since it's created at import
+    """
+    dispatch = pyqtSignal(object)
+
+    def __init__(self):
+        super().__init__()
+        self.dispatch.connect(self._run)
+
+    def _run(self, fn: Callable):
+        try:
+            fn()
+        except Exception as e:
+            print(f"post_to_qt callback failed: {e}")
+
+_qt_dispatcher = _QtDispatcher()
+
+def post_to_qt(fn: Callable, *args):
+    # call fn on the GUI thread, immediately if we are already on it
+    if threading.current_thread() is threading.main_thread():
+        fn(*args)
+    else:
+        _qt_dispatcher.dispatch.emit(lambda: fn(*args))
+
+class AsyncRuntime:
+    """
+    A single background asyncio event loop that LLM nodes, task sessions and any other async work submit coroutines to
+    submit() can be called from any thread and returns a concurrent.futures.Future, "on_done" callbacks are delivered on the Qt thread
+    Blocking work inside coroutines should go through asyncio.to_thread, which uses the runtime's worker pool
+    """
+    def __init__(self, name: str = "AsyncRuntime", max_workers: int = DEFAULT_RUNTIME_WORKERS):
+        self._name = name
+        self._max_workers = max_workers
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._futures: Set[concurrent.futures.Future] = set()
+        self._shutdown_hooks: List[Callable[[], Coroutine]] = []
+
+    def start(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._loop.is_closed():
+                self._loop = asyncio.new_event_loop()
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix=f"{self._name}Worker")
+                self._loop.set_default_executor(self._executor)
+                self._thread = threading.Thread(target=self._run_loop, name=self._name, daemon=True)
+                self._thread.start()
+            return self._loop
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_forever()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        return self.start()
+
+    def is_running(self) -> bool:
+        return self._loop is not None and self._loop.is_running()
+
+    def in_runtime_thread(self) -> bool:
+        return self._thread is not None and threading.current_thread() is self._thread
+
+    def submit(self, coro: Coroutine, on_done: Callable[[concurrent.futures.Future], None] = None) -> concurrent.futures.Future:
+        future = asyncio.run_coroutine_threadsafe(coro, self.start())
+        with self._lock:
+            self._futures.add(future)
+        future.add_done_callback(self._forget_future)
+        if on_done:
+            future.add_done_callback(lambda f: post_to_qt(on_done, f))
+        return future
+
+    def _forget_future(self, future: concurrent.futures.Future):
+        with self._lock:
+            self._futures.discard(future)
+
+    def run(self, coro: Coroutine, timeout: Optional[float] = None) -> Any:
+        # blocking helper for synchronous callers, never call from inside the runtime
+        if self.in_runtime_thread():
+            coro.close()
+            raise RuntimeError("AsyncRuntime.run called from the runtime thread, await the coroutine instead")
+        return self.submit(coro).result(timeout)
+
+    def cancel_all(self):
+        with self._lock:
+            futures = list(self._futures)
+        for future in futures:
+            future.cancel()
+
+    def add_shutdown_hook(self, hook: Callable[[], Coroutine]):
+        # hooks are awaited on the runtime loop before it stops, ie closing network sessions
+        self._shutdown_hooks.append(hook)
+
+    def shutdown(self, timeout: float = 5.0):
+        with self._lock:
+            loop = self._loop
+        if loop is None or loop.is_closed():
+            return
+
+        self.cancel_all()
+
+        async def run_shutdown_hooks():
+            for hook in self._shutdown_hooks:
+                try:
+                    await hook()
+                except Exception as e:
+                    print(f"AsyncRuntime shutdown hook failed: {e}")
+
+        try:
+            asyncio.run_coroutine_threadsafe(run_shutdown_hooks(), loop).result(timeout)
+        except Exception as e:
+            print(f"AsyncRuntime failed to run shutdown hooks: {e}")
+
+        loop.call_soon_threadsafe(loop.stop)
+        if self._thread:
+            self._thread.join(timeout)
+        with self._lock:
+            self._loop = None
+            self._thread = None
+        loop.close()
+        if self._executor:
+            self._executor.shutdown(wait=False)
+
+# Global runtime, every async task in the app should run here
+ASYNC_RUNTIME = AsyncRuntime()
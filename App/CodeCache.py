@@ -0,0 +1,78 @@
+import builtins
+import hashlib
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from types import CodeType
+from typing import Any, Dict, Optional, Tuple
+
+# only the standard library, this is imported by PythonSandboxWorker
+
+MAX_CODE_OBJECTS = 256
+# imported once and put in every namespace, so generated snippets don't pay for them each run
+PREIMPORTED_MODULES = ["os", "sys", "json", "re", "glob", "shutil", "subprocess", "pathlib", "time", "datetime", "math"]
+
+class CodeCache:
+    """
+    Compiled code objects for TaskNode_Python code, keyed by a hash of the source, so code that runs again (ie search
+    nodes, generated helpers) is only compiled once. Least recently used code is dropped past "max_entries".
+    make_namespace() gives the globals to run code in, a copy of a small base namespace with the preimported
+    modules rather than the globals of the module running it.
+    """
+    def __init__(self, max_entries: int = MAX_CODE_OBJECTS, preimport: Optional[list] = None):
+        self.max_entries = max_entries
+        self._code: "OrderedDict[str, CodeType]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._base_namespace: Optional[Dict[str, Any]] = None
+        self._preimport = PREIMPORTED_MODULES if preimport is None else preimport
+        self.hits = 0
+        self.misses = 0
+        self.compile_time = 0.0
+
+    def get(self, source: str, filename: str = "<python>") -> Tuple[CodeType, bool]:
+        # returns the code and True if it was already compiled, SyntaxError is raised like compile()
+        key = hashlib.sha256(f"{filename}\0{source}".encode('utf-8')).hexdigest()
+        with self._lock:
+            code = self._code.get(key)
+            if code is not None:
+                self._code.move_to_end(key)
+                self.hits += 1
+                return code, True
+        start = time.perf_counter()
+        code = compile(source, filename, "exec")
+        with self._lock:
+            self.compile_time += time.perf_counter() - start
+            self.misses += 1
+            self._code[key] = code
+            while len(self._code) > self.max_entries:
+                self._code.popitem(last=False)
+        return code, False
+
+    def preimport(self) -> Dict[str, Any]:
+        # builds the base namespace, call ahead of time to take the imports off the first run
+        if self._base_namespace is None:
+            namespace = {"__name__": "__sandbox__", "__builtins__": builtins}
+            for module_name in self._preimport:
+                try:
+                    namespace[module_name] = importlib.import_module(module_name)
+                except ImportError as e:
+                    print(f"CodeCache failed to preimport {module_name}: {e}")
+            self._base_namespace = namespace
+        return self._base_namespace
+
+    def make_namespace(self, names: Dict[str, Any]) -> Dict[str, Any]:
+        namespace = dict(self.preimport())
+        namespace.update(names)
+        return namespace
+
+    def clear(self):
+        with self._lock:
+            self._code.clear()
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"entries": len(self._code), "hits": self.hits, "misses": self.misses,
+                    "compile_ms": round(self.compile_time * 1000.0, 3)}
+
+GLOBAL_CODE_CACHE = CodeCache()
@@ -0,0 +1,139 @@
+from typing import Dict, List, Tuple
+
+NO_NODE = -1
+
+# counts edits to any task graph's structure, a CompiledGraph from before an edit is compiled again
+_graph_edits = 0
+
+def Mark_Graph_Edited():
+    # call after adding or removing nodes, TaskNode.add_child does
+    global _graph_edits
+    _graph_edits += 1
+
+def Get_Graph_Edits() -> int:
+    return _graph_edits
+
+class NodeReferenceError(Exception):
+    pass
+
+class CompiledGraph:
+    """
+    A flat view of a task graph for walking it without going back to the root
+    Nodes are stored in depth first (pre-order) order, so a node's index is its position in the order the graph
+    executes, the next node to run is always index + 1, and a node's subtree is the range [index, subtree_end[index]).
+    "parent", "first_child" and "next_sibling" are indexes into "nodes", NO_NODE when there isn't one,
+    "child_index" is the node's index in its parent's children, which is what a TaskContext node_stack holds.
+    "child_names" indexes each node's children by name, for resolving node_output:// references, the first child
+    with a name wins. Resolved references are kept, so each one is only looked up once.
+    The graph is compiled from the TaskNodes, it has to be compiled again if nodes are added or removed, "edits" is
+    Get_Graph_Edits() when it was, see TaskContext.get_graph.
+    """
+    def __init__(self, root):
+        self.root = root
+        self.edits = Get_Graph_Edits()
+        self.nodes: List = []
+        self.parent: List[int] = []
+        self.first_child: List[int] = []
+        self.next_sibling: List[int] = []
+        self.child_index: List[int] = []
+        self.depth: List[int] = []
+        self.subtree_end: List[int] = []
+        self.children: List[List[int]] = []
+        self.child_names: List[Dict[str, int]] = []
+        self._indices: Dict[int, int] = {} # id(node) -> index
+        self._references: Dict[Tuple[int, str], int] = {} # (index of the referencing node, path) -> index
+        if root is not None:
+            self._compile()
+
+    def _compile(self):
+        # iterative, generated graphs can be deeper than the recursion limit
+        pending = [(self.root, NO_NODE, 0)]
+        while pending:
+            node, parent, child_index = pending.pop()
+            index = len(self.nodes)
+            self.nodes.append(node)
+            self.parent.append(parent)
+            self.first_child.append(NO_NODE)
+            self.next_sibling.append(NO_NODE)
+            self.child_index.append(child_index)
+            self.depth.append(0 if parent == NO_NODE else self.depth[parent] + 1)
+            self.subtree_end.append(index + 1)
+            self.children.append([])
+            self.child_names.append({})
+            self._indices[id(node)] = index
+            if parent != NO_NODE:
+                siblings = self.children[parent]
+                if len(siblings) == 0:
+                    self.first_child[parent] = index
+                else:
+                    self.next_sibling[siblings[-1]] = index
+                siblings.append(index)
+                self.child_names[parent].setdefault(node.name, index)
+            for child_index in range(len(node.children) - 1, -1, -1):
+                pending.append((node.children[child_index], index, child_index))
+
+        for index in range(len(self.nodes) - 1, 0, -1):
+            parent = self.parent[index]
+            self.subtree_end[parent] = max(self.subtree_end[parent], self.subtree_end[index])
+
+    def __len__(self) -> int:
+        return len(self.nodes)
+
+    def get_index(self, node) -> int:
+        return self._indices.get(id(node), NO_NODE)
+
+    def get_index_from_stack(self, node_stack: List[int]) -> int:
+        # node_stack is the child index at each level, from the root down
+        index = 0
+        for child_index in node_stack:
+            index = self.children[index][child_index]
+        return index
+
+    def get_node_stack(self, index: int) -> List[int]:
+        node_stack = []
+        while self.parent[index] != NO_NODE:
+            node_stack.append(self.child_index[index])
+            index = self.parent[index]
+        node_stack.reverse()
+        return node_stack
+
+    def get_next_index(self, index: int) -> int:
+        return index + 1 if index + 1 < len(self.nodes) else NO_NODE
+
+    def resolve_reference(self, index: int, node_path: str) -> int:
+        """
+        The node a path refers to from the node at "index", ie "TaskNode1", "task1/TaskNode1" or "../TaskNode1"
+        Names are looked up from the node's parent, each leading ../ goes up a level
+        """
+        key = (index, node_path)
+        if key in self._references:
+            return self._references[key]
+
+        search_index = self.parent[index]
+        if search_index == NO_NODE:
+            raise NodeReferenceError(f"Invalid node path: {node_path}")
+        path_parts = node_path.split('/')
+        while len(path_parts) > 0 and path_parts[0] == "..":
+            if self.parent[search_index] == NO_NODE:
+                raise NodeReferenceError(f"Invalid node path: {node_path}")
+            search_index = self.parent[search_index]
+            path_parts = path_parts[1:]
+        for search_name in path_parts:
+            if search_name not in self.child_names[search_index]:
+                raise NodeReferenceError(f"Node not found: {search_name}")
+            search_index = self.child_names[search_index][search_name]
+
+        self._references[key] = search_index
+        return search_index
+
+    def validate_references(self, prefix: str) -> List[str]:
+        # resolves every input starting with "prefix" once, returns a message for each one that doesn't resolve
+        errors = []
+        for index, node in enumerate(self.nodes):
+            for input in node.inputs:
+                if input.startswith(prefix):
+                    try:
+                        self.resolve_reference(index, input[len(prefix):])
+                    except NodeReferenceError as e:
+                        errors.append(f"{node.name}: {input}: {e}")
+        return errors
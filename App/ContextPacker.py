@@ -0,0 +1,205 @@
+import re
+from enum import Enum
+from typing import Dict, List, Optional, Tuple
+
+from LLMScheduler import estimate_tokens
+
+# truncating a block to less than this is not worth the tokens, the block is dropped instead
+MIN_TRUNCATED_TOKENS = 64
+# top_n splits text into chunks of about this many lines, on blank lines where possible
+TOP_N_CHUNK_LINES = 40
+TRUNCATION_MARKER = "\n... [{0} tokens omitted] ...\n"
+
+# default priorities, higher is packed first
+PRIORITY_REQUIRED = 1000
+PRIORITY_INSTRUCTION = 80
+PRIORITY_INPUT = 50
+
+class TruncatePolicy(str, Enum):
+    Full = "full"       # all or nothing
+    Head = "head"       # keep the start, ie a log's header or a file's imports and declarations
+    Tail = "tail"       # keep the end, ie the most recent lines of a log or conversation
+    TopN = "top_n"      # keep the chunks most relevant to the query, in their original order
+
+class ContextBlock:
+    """
+    A candidate block of prompt text for ContextPacker
+    "name" identifies the block in the manifest, ie the input key or prompt summary
+    "required" blocks are always included and only count against the budget
+    """
+    def __init__(self, name: str, text: str, priority: int = PRIORITY_INPUT, policy: TruncatePolicy = TruncatePolicy.Full, kind: str = "input", required: bool = False):
+        self.name = name
+        self.text = text
+        self.priority = priority
+        self.policy = TruncatePolicy(policy)
+        self.kind = kind
+        self.required = required
+        self.tokens = estimate_tokens(text)
+
+class ContextManifest:
+    """
+    What ContextPacker did with each block, (kind, name, tokens, packed tokens) per list
+    """
+    def __init__(self, budget_tokens: int = 0):
+        self.budget_tokens = budget_tokens
+        self.included: List[Tuple[str, str, int, int]] = []
+        self.truncated: List[Tuple[str, str, int, int]] = []
+        self.dropped: List[Tuple[str, str, int, int]] = []
+
+    def merge(self, other: 'ContextManifest'):
+        self.budget_tokens += other.budget_tokens
+        self.included += other.included
+        self.truncated += other.truncated
+        self.dropped += other.dropped
+
+    def get_packed_tokens(self) -> int:
+        return sum(item[3] for item in self.included + self.truncated)
+
+    def get_omitted_tokens(self) -> int:
+        return sum(item[2] - item[3] for item in self.truncated + self.dropped)
+
+    def has_omissions(self) -> bool:
+        return len(self.truncated) > 0 or len(self.dropped) > 0
+
+    def to_dict(self) -> Dict:
+        def items(entries):
+            return [{"kind": kind, "name": name, "tokens": tokens, "packed_tokens": packed} for kind, name, tokens, packed in entries]
+        return {
+            "budget_tokens": self.budget_tokens,
+            "packed_tokens": self.get_packed_tokens(),
+            "included": items(self.included),
+            "truncated": items(self.truncated),
+            "dropped": items(self.dropped),
+        }
+
+    def get_omission_note(self) -> str:
+        # told to the model so it knows it is not seeing everything it was given
+        notes = [f"{name} (truncated to {packed} of {tokens} tokens)" for _, name, tokens, packed in self.truncated]
+        notes += [f"{name} ({tokens} tokens)" for _, name, tokens, _ in self.dropped]
+        return "context omitted to fit the token budget: " + ", ".join(notes) if len(notes) > 0 else ""
+
+    def __str__(self) -> str:
+        return (f"{self.get_packed_tokens()}/{self.budget_tokens} tokens packed, {len(self.included)} included, "
+                f"{len(self.truncated)} truncated, {len(self.dropped)} dropped ({self.get_omitted_tokens()} tokens)")
+
+class ContextPacker:
+    """
+    Chooses which blocks go into a prompt under a token budget
+    Required blocks are counted first, the rest are taken by priority (then in their given order) while they fit.
+    A block that does not fit is truncated to what is left of the budget according to its policy, or dropped
+    if its policy is Full or too little is left. Packed blocks are returned in their given order.
+    """
+    def pack(self, blocks: List[ContextBlock], budget_tokens: int, query: str = "") -> Tuple[List[ContextBlock], ContextManifest]:
+        manifest = ContextManifest(budget_tokens)
+        remaining = budget_tokens
+        packed: Dict[int, ContextBlock] = {}
+
+        for index, block in enumerate(blocks):
+            if block.required:
+                packed[index] = block
+                remaining -= block.tokens
+                manifest.included.append((block.kind, block.name, block.tokens, block.tokens))
+
+        candidates = sorted((index for index, block in enumerate(blocks) if not block.required), key=lambda index: -blocks[index].priority)
+        for index in candidates:
+            block = blocks[index]
+            if block.tokens <= remaining:
+                packed[index] = block
+                remaining -= block.tokens
+                manifest.included.append((block.kind, block.name, block.tokens, block.tokens))
+                continue
+
+            truncated = None
+            if block.policy != TruncatePolicy.Full and remaining >= MIN_TRUNCATED_TOKENS:
+                truncated = self.truncate(block, remaining, query)
+            if truncated is None:
+                manifest.dropped.append((block.kind, block.name, block.tokens, 0))
+            else:
+                packed[index] = truncated
+                remaining -= truncated.tokens
+                manifest.truncated.append((block.kind, block.name, block.tokens, truncated.tokens))
+
+        return [packed[index] for index in sorted(packed.keys())], manifest
+
+    def truncate(self, block: ContextBlock, budget_tokens: int, query: str = "") -> Optional[ContextBlock]:
+        lines = block.text.splitlines(keepends=True)
+        if block.policy == TruncatePolicy.TopN:
+            text = self._take_relevant_chunks(lines, budget_tokens, query)
+        else:
+            # leave room for the marker
+            kept = self._take_lines(lines if block.policy == TruncatePolicy.Head else lines[::-1],
+                                    budget_tokens - estimate_tokens(TRUNCATION_MARKER.format(block.tokens)))
+            if len(kept) == 0:
+                return None
+            if block.policy == TruncatePolicy.Head:
+                kept_text = "".join(kept)
+                text = kept_text + TRUNCATION_MARKER.format(block.tokens - estimate_tokens(kept_text))
+            else:
+                kept_text = "".join(kept[::-1])
+                text = TRUNCATION_MARKER.format(block.tokens - estimate_tokens(kept_text)) + kept_text
+
+        if text is None:
+            return None
+        return ContextBlock(block.name, text, block.priority, block.policy, block.kind, block.required)
+
+    def _take_lines(self, lines: List[str], budget_tokens: int) -> List[str]:
+        kept = []
+        characters = 0
+        for line in lines:
+            if (characters + len(line)) // 4 + 1 > budget_tokens:
+                break
+            kept.append(line)
+            characters += len(line)
+        return kept
+
+    def _split_chunks(self, lines: List[str]) -> List[str]:
+        chunks = []
+        current = []
+        for line in lines:
+            current.append(line)
+            if len(current) >= TOP_N_CHUNK_LINES or (line.strip() == "" and len(current) >= TOP_N_CHUNK_LINES // 2):
+                chunks.append("".join(current))
+                current = []
+        if len(current) > 0:
+            chunks.append("".join(current))
+        return chunks
+
+    def _take_relevant_chunks(self, lines: List[str], budget_tokens: int, query: str) -> Optional[str]:
+        chunks = self._split_chunks(lines)
+        query_words = set(word.lower() for word in re.findall(r"\w{3,}", query))
+
+        def score(index: int) -> float:
+            words = re.findall(r"\w{3,}", chunks[index].lower())
+            if len(words) == 0:
+                return 0.0
+            hits = sum(1 for word in words if word in query_words)
+            # earlier chunks win ties, they usually hold the declarations the rest depends on
+            return hits / len(words) - index * 1e-9
+
+        marker_tokens = estimate_tokens(TRUNCATION_MARKER.format(0))
+        kept = set()
+        used = 0
+        for index in sorted(range(len(chunks)), key=score, reverse=True):
+            tokens = estimate_tokens(chunks[index]) + marker_tokens
+            if used + tokens <= budget_tokens:
+                kept.add(index)
+                used += tokens
+        if len(kept) == 0:
+            return None
+
+        parts = []
+        omitted = 0
+        for index, chunk in enumerate(chunks):
+            if index in kept:
+                if omitted > 0:
+                    parts.append(TRUNCATION_MARKER.format(omitted))
+                    omitted = 0
+                parts.append(chunk)
+            else:
+                omitted += estimate_tokens(chunk)
+        if omitted > 0:
+            parts.append(TRUNCATION_MARKER.format(omitted))
+        return "".join(parts)
+
+# Global packer, shared by every TaskNode_LLM
+GLOBAL_CONTEXT_PACKER = ContextPacker()
@@ -0,0 +1,180 @@
+import hashlib
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional
+
+from LLMScheduler import estimate_tokens
+from SessionContext import Get_Entry_Response_Text
+from TypeDefs import SessionEntry, ResponseEntryType
+
+# sender used for entries the reducer writes, they are sent as user turns
+CONTEXT_REDUCER_SENDER = "context_reducer"
+
+# the most recent conversation entries are always sent as is
+KEEP_RECENT_ENTRIES = 6
+# older entries are summarised in runs of about this size, from the start of the session, so the same
+# run gives the same summary (and the same prompt prefix) on every turn
+SUMMARY_CHUNK_TOKENS = 8000
+SUMMARY_CACHE_SIZE = 512
+
+SUMMARY_PROMPT = """Summarise the following part of a conversation between a user and an AI assistant working on a software task.
+Keep every decision, requirement, file name, api and open question, drop pleasantries and anything later superseded.
+Reply with the summary only.
+"""
+
+def Get_Entry_Tokens(entry: SessionEntry) -> int:
+    return estimate_tokens(Get_Entry_Response_Text(entry))
+
+def Get_Entry_Phases(entries: List[SessionEntry]) -> List[Optional[int]]:
+    """
+    The task phase of each entry, Task adds its prompts and messages with a "task_phase" in their metadata, the
+    entries after one of those (ie the llm responses) are in the same phase, None before the first
+    """
+    phases = []
+    phase = None
+    for entry in entries:
+        if entry.metadata and entry.metadata.get("task_phase") is not None:
+            phase = int(entry.metadata["task_phase"])
+        phases.append(phase)
+    return phases
+
+class ContextReducer:
+    """
+    Brings a session back under a token budget before it is sent, as a pipeline of stages run in order until it fits
+        evict_superseded_files: older versions of a file that was written again later are replaced by a one line note
+        reduce_earlier_phases: conversation from task phases before the latest one is summarised, or dropped without
+            a summarize callable
+        summarize_older_entries: runs of older conversation are replaced by a summary from a cheap model
+        drop_oldest_entries: last resort, the oldest conversation entries are dropped
+    Instructions and the most recent KEEP_RECENT_ENTRIES entries are never touched.
+    Stages are async callables (entries, budget_tokens, summarize) -> entries and can be replaced or extended.
+    Summaries are cached by the hash of the entries they replace.
+    """
+    def __init__(self):
+        self.stages = [self.evict_superseded_files, self.reduce_earlier_phases, self.summarize_older_entries, self.drop_oldest_entries]
+        self._summary_cache: "OrderedDict[str, str]" = OrderedDict()
+
+    def get_tokens(self, entries: List[SessionEntry]) -> int:
+        return sum(Get_Entry_Tokens(entry) for entry in entries)
+
+    async def reduce(self, entries: List[SessionEntry], budget_tokens: int, summarize: Optional[Callable[[str], Awaitable[str]]] = None) -> List[SessionEntry]:
+        # returns a new list, entries that are kept are the same objects, the session itself is never modified
+        entries = list(entries)
+        for stage in self.stages:
+            if self.get_tokens(entries) <= budget_tokens:
+                break
+            entries = await stage(entries, budget_tokens, summarize)
+        return entries
+
+    def _get_reducible_indices(self, entries: List[SessionEntry]) -> List[int]:
+        conversation = [index for index, entry in enumerate(entries) if entry.entry_type != ResponseEntryType.INSTRUCTION]
+        return conversation[:-KEEP_RECENT_ENTRIES] if KEEP_RECENT_ENTRIES > 0 else conversation
+
+    async def evict_superseded_files(self, entries: List[SessionEntry], budget_tokens: int, summarize) -> List[SessionEntry]:
+        latest = {}
+        for index, entry in enumerate(entries):
+            if entry.entry_type == ResponseEntryType.FILE and entry.metadata.get("type") == "file":
+                latest[entry.metadata.get("filename")] = index
+
+        result = list(entries)
+        for index, entry in enumerate(entries):
+            if entry.entry_type == ResponseEntryType.FILE and entry.metadata.get("type") == "file":
+                filename = entry.metadata.get("filename")
+                if latest[filename] != index:
+                    note = SessionEntry("System", f"(an earlier version of {filename} was written here, it is superseded by a later version)")
+                    note.time_stamp = entry.time_stamp
+                    result[index] = note
+        return result
+
+    async def reduce_earlier_phases(self, entries: List[SessionEntry], budget_tokens: int, summarize) -> List[SessionEntry]:
+        phases = Get_Entry_Phases(entries)
+        current_phase = phases[-1] if len(phases) > 0 else None
+        if current_phase is None:
+            return entries
+        # the session filter leaves out the tagged entries of other phases, so the untagged entries before the
+        # first tagged one are from earlier phases too
+        indices = [index for index in self._get_reducible_indices(entries)
+                   if phases[index] is None or phases[index] < current_phase]
+        if summarize is not None:
+            return await self._summarize_indices(entries, indices, budget_tokens, summarize, phases)
+        return self._drop_indices(entries, indices, budget_tokens)
+
+    async def summarize_older_entries(self, entries: List[SessionEntry], budget_tokens: int, summarize) -> List[SessionEntry]:
+        if summarize is None:
+            return entries
+        return await self._summarize_indices(entries, self._get_reducible_indices(entries), budget_tokens, summarize)
+
+    async def _summarize_indices(self, entries: List[SessionEntry], indices: List[int], budget_tokens: int, summarize, phases: Optional[List[Optional[int]]] = None) -> List[SessionEntry]:
+        # split the entries at "indices" into runs of consecutive entries, in one phase if "phases" is given
+        chunks: List[List[int]] = []
+        chunk_tokens = 0
+        previous_index = None
+        for index in indices:
+            tokens = Get_Entry_Tokens(entries[index])
+            if (len(chunks) == 0 or previous_index != index - 1 or chunk_tokens + tokens > SUMMARY_CHUNK_TOKENS
+                    or (phases is not None and phases[index] != phases[previous_index])):
+                chunks.append([])
+                chunk_tokens = 0
+            chunks[-1].append(index)
+            chunk_tokens += tokens
+            previous_index = index
+
+        total_tokens = self.get_tokens(entries)
+        replacements = {}
+        for chunk in chunks:
+            if total_tokens <= budget_tokens:
+                break
+            chunk_entries = [entries[index] for index in chunk]
+            if len(chunk_entries) == 1 and chunk_entries[0].sender == CONTEXT_REDUCER_SENDER:
+                continue
+            summary = await self._get_summary(chunk_entries, summarize)
+            if summary is None:
+                continue
+            summary_entry = SessionEntry(CONTEXT_REDUCER_SENDER, f"[summary of earlier conversation]\n{summary}")
+            summary_entry.time_stamp = chunk_entries[-1].time_stamp
+            total_tokens += Get_Entry_Tokens(summary_entry) - self.get_tokens(chunk_entries)
+            replacements[chunk[0]] = (chunk, summary_entry)
+
+        result = []
+        skip = set()
+        for index, entry in enumerate(entries):
+            if index in replacements:
+                chunk, summary_entry = replacements[index]
+                skip.update(chunk)
+                result.append(summary_entry)
+            elif index not in skip:
+                result.append(entry)
+        return result
+
+    async def drop_oldest_entries(self, entries: List[SessionEntry], budget_tokens: int, summarize) -> List[SessionEntry]:
+        return self._drop_indices(entries, self._get_reducible_indices(entries), budget_tokens)
+
+    def _drop_indices(self, entries: List[SessionEntry], indices: List[int], budget_tokens: int) -> List[SessionEntry]:
+        total_tokens = self.get_tokens(entries)
+        drop = set()
+        for index in indices:
+            if total_tokens <= budget_tokens:
+                break
+            drop.add(index)
+            total_tokens -= Get_Entry_Tokens(entries[index])
+        return [entry for index, entry in enumerate(entries) if index not in drop]
+
+    async def _get_summary(self, chunk_entries: List[SessionEntry], summarize) -> Optional[str]:
+        text = "\n".join(f"{entry.sender}: {Get_Entry_Response_Text(entry)}" for entry in chunk_entries)
+        key = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        if key in self._summary_cache:
+            self._summary_cache.move_to_end(key)
+            return self._summary_cache[key]
+        try:
+            summary = await summarize(SUMMARY_PROMPT + "\n" + text)
+        except Exception as e:
+            print(f"ContextReducer failed to summarise {len(chunk_entries)} entries: {e}")
+            return None
+        if not summary:
+            return None
+        self._summary_cache[key] = summary
+        if len(self._summary_cache) > SUMMARY_CACHE_SIZE:
+            self._summary_cache.popitem(last=False)
+        return summary
+
+# Global reducer, shared by every TaskNode_LLM
+GLOBAL_CONTEXT_REDUCER = ContextReducer()
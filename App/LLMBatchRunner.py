@@ -0,0 +1,161 @@
+import asyncio
+import aiohttp
+import json
+import time
+from typing import Dict, List, Tuple
+
+from LLMConnectionPool import GLOBAL_CONNECTION_POOL
+from TaskNode_LLM import TaskNode_LLM, LLM_Interface, Get_Model_Interface
+
+# batches usually finish in minutes, but the providers only promise 24 hours
+BATCH_POLL_INTERVAL = 30.0
+BATCH_MAX_WAIT = 24 * 60 * 60
+BATCH_REQUEST_TIMEOUT = 120.0
+
+OPENAI_BATCH_FINAL_STATES = ("completed", "failed", "expired", "cancelled")
+
+class LLMBatchError(Exception):
+    pass
+
+class LLMBatchRunner:
+    """
+    Submits the composed requests of several TaskNode_LLMs through the providers' batch apis
+    (OpenAI files + batches, Anthropic message batches), polls until they finish and returns the results.
+    Nodes are grouped per provider and server, so a single run can end up as more than one batch.
+    The result for each node is {"text": response text, "usage": provider usage block} or {"error": message},
+    TaskNode_LLM.complete_batch_request() turns it into session entries, variables and files.
+    """
+    def __init__(self, poll_interval: float = BATCH_POLL_INTERVAL, max_wait: float = BATCH_MAX_WAIT):
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+
+    async def run(self, nodes: List[TaskNode_LLM]) -> List[Dict]:
+        # the nodes must already have their prompt composed, ie TaskNode_LLM.prepare_request()
+        groups: Dict[Tuple, List[Tuple[str, TaskNode_LLM]]] = {}
+        for index, node in enumerate(nodes):
+            key = (Get_Model_Interface(node.llm_model), node._get_base_url())
+            groups.setdefault(key, []).append((f"node_{index}", node))
+
+        results: Dict[str, Dict] = {}
+        group_results = await asyncio.gather(*[self._run_group(interface, base_url, requests) for (interface, base_url), requests in groups.items()],
+                                             return_exceptions=True)
+        for ((interface, base_url), requests), group_result in zip(groups.items(), group_results):
+            if isinstance(group_result, asyncio.CancelledError):
+                raise group_result
+            if isinstance(group_result, BaseException):
+                for custom_id, _ in requests:
+                    results[custom_id] = {"error": f"{interface.name} batch failed: {group_result}"}
+            else:
+                results.update(group_result)
+
+        return [results.get(f"node_{index}", {"error": "missing from batch results"}) for index in range(len(nodes))]
+
+    async def _run_group(self, interface: LLM_Interface, base_url: str, requests: List[Tuple[str, TaskNode_LLM]]) -> Dict[str, Dict]:
+        headers = requests[0][1].get_request_headers()
+        bodies = []
+        for custom_id, node in requests:
+            body = node.get_request_body(False)
+            body.pop("stream", None)
+            bodies.append((custom_id, body))
+
+        if interface == LLM_Interface.OpenAI:
+            return await self._run_openai_batch(base_url, headers, bodies)
+        elif interface == LLM_Interface.Anthropic:
+            return await self._run_anthropic_batch(base_url, headers, bodies)
+        raise LLMBatchError(f"no batch api for {interface}")
+
+    async def _request_json(self, interface: LLM_Interface, method: str, url: str, headers: Dict, **kwargs) -> Dict:
+        body = await GLOBAL_CONNECTION_POOL.request(interface, method, url, headers, timeout=BATCH_REQUEST_TIMEOUT, **kwargs)
+        return json.loads(body)
+
+    async def _poll(self, interface: LLM_Interface, url: str, headers: Dict, is_done) -> Dict:
+        start = time.monotonic()
+        while True:
+            status = await self._request_json(interface, "GET", url, headers)
+            if is_done(status):
+                return status
+            if time.monotonic() - start > self.max_wait:
+                raise LLMBatchError(f"batch did not finish within {self.max_wait} seconds: {url}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def _cancel(self, interface: LLM_Interface, url: str, headers: Dict):
+        # best effort, the run was cancelled so nobody is waiting for the answer
+        try:
+            await GLOBAL_CONNECTION_POOL.request(interface, "POST", url, headers, timeout=BATCH_REQUEST_TIMEOUT)
+        except Exception as e:
+            print(f"LLMBatchRunner failed to cancel batch {url}: {e}")
+
+    async def _run_openai_batch(self, base_url: str, headers: Dict, bodies: List[Tuple[str, Dict]]) -> Dict[str, Dict]:
+        interface = LLM_Interface.OpenAI
+        lines = [json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}) for custom_id, body in bodies]
+        form = aiohttp.FormData()
+        form.add_field("purpose", "batch")
+        form.add_field("file", "\n".join(lines).encode('utf-8'), filename="batch.jsonl", content_type="application/jsonl")
+        # multipart sets its own content type
+        upload_headers = {key: value for key, value in headers.items() if key.lower() != "content-type"}
+        input_file = await self._request_json(interface, "POST", f"{base_url}/v1/files", upload_headers, data=form)
+
+        batch = await self._request_json(interface, "POST", f"{base_url}/v1/batches", headers,
+                                         json={"input_file_id": input_file["id"], "endpoint": "/v1/chat/completions", "completion_window": "24h"})
+        try:
+            batch = await self._poll(interface, f"{base_url}/v1/batches/{batch['id']}", headers,
+                                     lambda status: status.get("status") in OPENAI_BATCH_FINAL_STATES)
+        except asyncio.CancelledError:
+            await self._cancel(interface, f"{base_url}/v1/batches/{batch['id']}/cancel", headers)
+            raise
+
+        results: Dict[str, Dict] = {}
+        for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+            if not file_id:
+                continue
+            content = await GLOBAL_CONNECTION_POOL.request(interface, "GET", f"{base_url}/v1/files/{file_id}/content", headers, timeout=BATCH_REQUEST_TIMEOUT)
+            for line in content.decode('utf-8').splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    results[item["custom_id"]] = {"error": str(item.get("error") or response.get("body"))}
+                else:
+                    body = response["body"]
+                    results[item["custom_id"]] = {"text": body["choices"][0]["message"].get("content") or "", "usage": body.get("usage")}
+
+        for custom_id, _ in bodies:
+            if custom_id not in results:
+                results[custom_id] = {"error": f"batch {batch.get('status')}"}
+        return results
+
+    async def _run_anthropic_batch(self, base_url: str, headers: Dict, bodies: List[Tuple[str, Dict]]) -> Dict[str, Dict]:
+        interface = LLM_Interface.Anthropic
+        headers = dict(headers)
+        headers["anthropic-beta"] = ",".join(filter(None, [headers.get("anthropic-beta"), "message-batches-2024-09-24"]))
+        batch = await self._request_json(interface, "POST", f"{base_url}/v1/messages/batches", headers,
+                                         json={"requests": [{"custom_id": custom_id, "params": body} for custom_id, body in bodies]})
+        try:
+            batch = await self._poll(interface, f"{base_url}/v1/messages/batches/{batch['id']}", headers,
+                                     lambda status: status.get("processing_status") == "ended")
+        except asyncio.CancelledError:
+            await self._cancel(interface, f"{base_url}/v1/messages/batches/{batch['id']}/cancel", headers)
+            raise
+
+        results: Dict[str, Dict] = {}
+        content = await GLOBAL_CONNECTION_POOL.request(interface, "GET", batch["results_url"], headers, timeout=BATCH_REQUEST_TIMEOUT)
+        for line in content.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            result = item.get("result") or {}
+            if result.get("type") == "succeeded":
+                message = result["message"]
+                text = "".join(block.get("text", "") for block in message.get("content", []) if block.get("type") == "text")
+                results[item["custom_id"]] = {"text": text, "usage": message.get("usage")}
+            else:
+                results[item["custom_id"]] = {"error": str(result.get("error") or result.get("type"))}
+
+        for custom_id, _ in bodies:
+            if custom_id not in results:
+                results[custom_id] = {"error": "missing from batch results"}
+        return results
+
+# Global batch runner, used by Task when it finds a run of batch api nodes
+GLOBAL_BATCH_RUNNER = LLMBatchRunner()
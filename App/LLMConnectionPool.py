@@ -0,0 +1,141 @@
+import asyncio
+import aiohttp
+from typing import Any, AsyncGenerator, Dict
+
+from AsyncRuntime import ASYNC_RUNTIME
+
+DEFAULT_CONNECTION_LIMIT = 16
+DEFAULT_KEEPALIVE_TIMEOUT = 75.0
+
+class ProviderConnectionConfig:
+    """
+    Connection settings for a single LLM provider
+    "base_url" is only used for warm up, requests still pass their full url
+    """
+    def __init__(self, base_url: str = "", limit: int = DEFAULT_CONNECTION_LIMIT, keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT):
+        self.base_url = base_url
+        self.limit = limit
+        self.keepalive_timeout = keepalive_timeout
+
+class LLMConnectionPool:
+    """
+    Process wide pool of aiohttp.ClientSessions, one per provider (LLM_Interface)
+    aiohttp sessions are bound to the event loop they were created on, so all sessions live on the ASYNC_RUNTIME loop.
+    Requests made from any other loop are pumped through the runtime loop and the response lines are handed back
+    to the caller's loop, so keep-alive connections are never tied to a short lived loop.
+    """
+    def __init__(self):
+        self._configs: Dict[Any, ProviderConnectionConfig] = {}
+        self._sessions: Dict[Any, aiohttp.ClientSession] = {}
+        ASYNC_RUNTIME.add_shutdown_hook(self.aclose)
+
+    def configure(self, provider, base_url: str = "", limit: int = DEFAULT_CONNECTION_LIMIT, keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT):
+        # changes only apply to sessions created after this call
+        self._configs[provider] = ProviderConnectionConfig(base_url, limit, keepalive_timeout)
+
+    def get_config(self, provider) -> ProviderConnectionConfig:
+        if provider not in self._configs:
+            self._configs[provider] = ProviderConnectionConfig()
+        return self._configs[provider]
+
+    def _get_session(self, provider) -> aiohttp.ClientSession:
+        # must only be called on the runtime loop
+        session = self._sessions.get(provider)
+        if session is None or session.closed:
+            config = self.get_config(provider)
+            connector = aiohttp.TCPConnector(limit=config.limit, keepalive_timeout=config.keepalive_timeout, ttl_dns_cache=300)
+            session = aiohttp.ClientSession(connector=connector)
+            self._sessions[provider] = session
+        return session
+
+    async def stream_post(self, provider, url: str, headers: Dict, data: Dict, timeout: float) -> AsyncGenerator[bytes, None]:
+        """
+        POST "data" to "url" on the provider session and yield the response body line by line
+        Exceptions raised by aiohttp (ClientResponseError, TimeoutError..) are re-raised on the caller's loop
+        """
+        caller_loop = asyncio.get_running_loop()
+        pool_loop = ASYNC_RUNTIME.loop
+        if caller_loop is pool_loop:
+            session = self._get_session(provider)
+            async with session.post(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                async for line in response.content:
+                    yield line
+            return
+
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def put(item):
+            caller_loop.call_soon_threadsafe(queue.put_nowait, item)
+
+        async def pump():
+            try:
+                session = self._get_session(provider)
+                async with session.post(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                    response.raise_for_status()
+                    async for line in response.content:
+                        put((line, None))
+            except BaseException as e:
+                put((None, e))
+                return
+            put((None, None))
+
+        pump_future = asyncio.run_coroutine_threadsafe(pump(), pool_loop)
+        try:
+            while True:
+                line, error = await queue.get()
+                if error is not None:
+                    raise error
+                if line is None:
+                    break
+                yield line
+        finally:
+            # stop pumping if the consumer stopped early
+            if not pump_future.done():
+                pump_future.cancel()
+
+    async def request(self, provider, method: str, url: str, headers: Dict, json: Any = None, data: Any = None, timeout: float = 60.0) -> bytes:
+        """
+        Plain (non streaming) request on the provider session, returns the response body
+        Raises aiohttp.ClientResponseError for error statuses
+        """
+        async def send():
+            session = self._get_session(provider)
+            async with session.request(method, url, headers=headers, json=json, data=data, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                return await response.read()
+
+        pool_loop = ASYNC_RUNTIME.loop
+        if asyncio.get_running_loop() is pool_loop:
+            return await send()
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(send(), pool_loop))
+
+    def warm_up(self, providers = None):
+        """
+        Open a connection to each configured provider so the first request skips DNS/TCP/TLS setup
+        Runs in the background, failures are only reported
+        """
+        pool_loop = ASYNC_RUNTIME.loop
+        providers = providers if providers is not None else list(self._configs.keys())
+
+        async def warm_up_provider(provider):
+            config = self.get_config(provider)
+            if not config.base_url:
+                return
+            try:
+                session = self._get_session(provider)
+                async with session.head(config.base_url, timeout=aiohttp.ClientTimeout(total=10)) as response:
+                    await response.read()
+            except Exception as e:
+                print(f"LLMConnectionPool warm up failed for {provider}: {e}")
+
+        for provider in providers:
+            asyncio.run_coroutine_threadsafe(warm_up_provider(provider), pool_loop)
+
+    async def aclose(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions.clear()
+
+# Global connection pool, lives for the whole process
+GLOBAL_CONNECTION_POOL = LLMConnectionPool()
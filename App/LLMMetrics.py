@@ -0,0 +1,164 @@
+import time
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from Serializable import ISerializable
+
+class ModelPrice:
+    """
+    USD per million tokens, cache reads/writes are billed separately from regular input tokens
+    """
+    def __init__(self, input: float, output: float, cache_read: float = 0.0, cache_write: float = 0.0):
+        self.input = input
+        self.output = output
+        self.cache_read = cache_read
+        self.cache_write = cache_write
+
+# keyed by the provider model name, update when the providers change their pricing
+model_prices: Dict[str, ModelPrice] = {
+    "claude-3-5-sonnet-20240620": ModelPrice(3.0, 15.0, cache_read=0.30, cache_write=3.75),
+    "claude-3-haiku-20240307": ModelPrice(0.25, 1.25, cache_read=0.03, cache_write=0.30),
+    "gpt-4o-2024-08-06": ModelPrice(2.5, 10.0, cache_read=1.25),
+    "gpt-4o-mini": ModelPrice(0.15, 0.60, cache_read=0.075),
+    "gpt-3.5-turbo": ModelPrice(0.5, 1.5),
+}
+
+def Get_Model_Price(model_name: str) -> Optional[ModelPrice]:
+    if model_name in model_prices:
+        return model_prices[model_name]
+    # dated model names, ie "gpt-4o-mini-2024-07-18"
+    for name, price in model_prices.items():
+        if model_name.startswith(name):
+            return price
+    return None
+
+class LLMUsage(ISerializable):
+    """
+    Usage and timing for a single LLM call, as reported by the provider's usage blocks
+    "input_tokens" excludes cached tokens, "cache_read_tokens"/"cache_write_tokens" are the prompt cache hits/writes
+    "response_cache_hit" is set when the response was replayed from the local GLOBAL_RESPONSE_CACHE, nothing was billed
+    """
+    def __init__(self, model_name: str = ""):
+        self.model_name = model_name
+        self.node_name = ""
+        self.time_stamp = datetime.now()
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.time_to_first_token = 0.0
+        self.total_latency = 0.0
+        self.tokens_per_second = 0.0
+        self.cost = 0.0
+        self.response_cache_hit = False
+        self.retries = 0
+        self._start_time = 0.0
+        self._first_token_time = 0.0
+
+    def start(self):
+        self._start_time = time.monotonic()
+        self._first_token_time = 0.0
+
+    def mark_first_token(self):
+        if self._first_token_time == 0.0:
+            self._first_token_time = time.monotonic()
+            self.time_to_first_token = self._first_token_time - self._start_time
+
+    def finish(self):
+        now = time.monotonic()
+        self.total_latency = now - self._start_time
+        generation_time = now - self._first_token_time if self._first_token_time else 0.0
+        self.tokens_per_second = self.output_tokens / generation_time if generation_time > 0 else 0.0
+        self.cost = 0.0 if self.response_cache_hit else self.estimate_cost()
+
+    def estimate_cost(self) -> float:
+        price = Get_Model_Price(self.model_name)
+        if price is None:
+            return 0.0
+        return (self.input_tokens * price.input + self.output_tokens * price.output +
+                self.cache_read_tokens * price.cache_read + self.cache_write_tokens * price.cache_write) / 1e6
+
+    def get_total_tokens(self) -> int:
+        return self.input_tokens + self.cache_read_tokens + self.cache_write_tokens + self.output_tokens
+
+class LLMUsageSummary:
+    """
+    Totals over any number of LLMUsage records, used for the node/task/project roll ups
+    """
+    def __init__(self, usages: Iterable[LLMUsage] = ()):
+        self.calls = 0
+        self.response_cache_hits = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.cost = 0.0
+        self.total_latency = 0.0
+        self._time_to_first_token = 0.0
+        self._output_tokens_timed = 0
+        self._generation_time = 0.0
+        for usage in usages:
+            self.add(usage)
+
+    def add(self, usage: LLMUsage):
+        self.calls += 1
+        self.cost += usage.cost
+        self.total_latency += usage.total_latency
+        if usage.response_cache_hit:
+            self.response_cache_hits += 1
+            return
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        self.cache_read_tokens += usage.cache_read_tokens
+        self.cache_write_tokens += usage.cache_write_tokens
+        self._time_to_first_token += usage.time_to_first_token
+        if usage.tokens_per_second > 0:
+            self._output_tokens_timed += usage.output_tokens
+            self._generation_time += usage.output_tokens / usage.tokens_per_second
+
+    def merge(self, other: 'LLMUsageSummary'):
+        for name, value in other.__dict__.items():
+            setattr(self, name, getattr(self, name) + value)
+
+    def get_average_time_to_first_token(self) -> float:
+        live_calls = self.calls - self.response_cache_hits
+        return self._time_to_first_token / live_calls if live_calls > 0 else 0.0
+
+    def get_tokens_per_second(self) -> float:
+        return self._output_tokens_timed / self._generation_time if self._generation_time > 0 else 0.0
+
+    def get_prompt_cache_hit_rate(self) -> float:
+        prompt_tokens = self.input_tokens + self.cache_read_tokens + self.cache_write_tokens
+        return self.cache_read_tokens / prompt_tokens if prompt_tokens > 0 else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            "calls": self.calls,
+            "response_cache_hits": self.response_cache_hits,
+            "input_tokens": self.input_tokens,
+            "output_tokens": self.output_tokens,
+            "cache_read_tokens": self.cache_read_tokens,
+            "cache_write_tokens": self.cache_write_tokens,
+            "cost": round(self.cost, 6),
+            "total_latency": round(self.total_latency, 3),
+            "average_time_to_first_token": round(self.get_average_time_to_first_token(), 3),
+            "tokens_per_second": round(self.get_tokens_per_second(), 1),
+            "prompt_cache_hit_rate": round(self.get_prompt_cache_hit_rate(), 3),
+        }
+
+    def __str__(self) -> str:
+        return (f"{self.calls} calls, {self.input_tokens + self.cache_read_tokens + self.cache_write_tokens} in / {self.output_tokens} out tokens, "
+                f"${self.cost:.4f}, prompt cache {self.get_prompt_cache_hit_rate():.0%}, "
+                f"ttft {self.get_average_time_to_first_token():.2f}s, {self.get_tokens_per_second():.0f} tok/s")
+
+# "metric" for get_top_usage, how to rank nodes
+USAGE_METRICS = {
+    "cost": lambda summary: summary.cost,
+    "latency": lambda summary: summary.total_latency,
+    "tokens": lambda summary: summary.input_tokens + summary.cache_read_tokens + summary.cache_write_tokens + summary.output_tokens,
+    "time_to_first_token": lambda summary: summary.get_average_time_to_first_token(),
+}
+
+def Get_Top_Usage(summaries: List[Tuple[str, LLMUsageSummary]], metric: str = "cost", count: int = 10) -> List[Tuple[str, LLMUsageSummary]]:
+    key = USAGE_METRICS[metric]
+    return sorted(summaries, key=lambda item: key(item[1]), reverse=True)[:count]
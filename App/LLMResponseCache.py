@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+DEFAULT_CACHE_DIRECTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), ".llm_cache")
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_CACHE_MAX_ENTRIES = 4096
+
+class LLMResponseCache:
+    """
+    Content addressed, on disk store of LLM responses
+    Each entry is a json file named by the hash of the request, holding the raw provider stream and the parsed session entries
+    Eviction is least recently used, bounded by total size and entry count. Access time is the file mtime so the order survives restarts
+    """
+    def __init__(self, cache_directory: str = DEFAULT_CACHE_DIRECTORY, max_bytes: int = DEFAULT_CACHE_MAX_BYTES, max_entries: int = DEFAULT_CACHE_MAX_ENTRIES):
+        self.cache_directory = cache_directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._index: Optional[Dict[str, List]] = None # key -> [size, last_access]
+        self._total_bytes = 0
+
+    @staticmethod
+    def make_key(model: str, model_name: str, prompt: str) -> str:
+        hasher = hashlib.sha256()
+        for part in (model, model_name, prompt):
+            hasher.update(part.encode('utf-8'))
+            hasher.update(b'\0')
+        return hasher.hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_directory, f"{key}.json")
+
+    def _load_index(self):
+        # must be called with the lock held
+        if self._index is not None:
+            return
+        self._index = {}
+        self._total_bytes = 0
+        if not os.path.isdir(self.cache_directory):
+            return
+        for file_name in os.listdir(self.cache_directory):
+            if not file_name.endswith(".json"):
+                continue
+            stat = os.stat(os.path.join(self.cache_directory, file_name))
+            self._index[file_name[:-5]] = [stat.st_size, stat.st_mtime]
+            self._total_bytes += stat.st_size
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        if not self.enabled:
+            return None
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                return None
+            path = self._entry_path(key)
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                now = time.time()
+                os.utime(path, (now, now))
+                self._index[key][1] = now
+                return data
+            except Exception as e:
+                print(f"LLMResponseCache failed to read {path}: {e}")
+                self._remove(key)
+                return None
+
+    def put(self, key: str, stream: List[str], entries: List[Dict]):
+        if not self.enabled:
+            return
+        data = json.dumps({"stream": stream, "entries": entries})
+        with self._lock:
+            self._load_index()
+            os.makedirs(self.cache_directory, exist_ok=True)
+            path = self._entry_path(key)
+            temp_path = f"{path}.tmp"
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            except Exception as e:
+                print(f"LLMResponseCache failed to write {path}: {e}")
+                return
+            if key in self._index:
+                self._total_bytes -= self._index[key][0]
+            size = os.path.getsize(path)
+            self._index[key] = [size, time.time()]
+            self._total_bytes += size
+            self._evict()
+
+    def _remove(self, key: str):
+        # must be called with the lock held
+        size, _ = self._index.pop(key, (0, 0))
+        self._total_bytes -= size
+        try:
+            os.remove(self._entry_path(key))
+        except OSError:
+            pass
+
+    def _evict(self):
+        # must be called with the lock held
+        if self._total_bytes <= self.max_bytes and len(self._index) <= self.max_entries:
+            return
+        for key in sorted(self._index, key=lambda k: self._index[k][1]):
+            if self._total_bytes <= self.max_bytes and len(self._index) <= self.max_entries:
+                break
+            self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._load_index()
+            for key in list(self._index.keys()):
+                self._remove(key)
+
+# Global response cache shared by all TaskNode_LLMs
+GLOBAL_RESPONSE_CACHE = LLMResponseCache()
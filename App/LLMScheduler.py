@@ -0,0 +1,271 @@
+import asyncio
+import aiohttp
+import random
+import time
+from collections import OrderedDict, deque
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncGenerator, Callable, Deque, Dict, Optional
+
+from AsyncRuntime import ASYNC_RUNTIME
+
+DEFAULT_MAX_CONCURRENT = 4
+DEFAULT_REQUESTS_PER_MINUTE = 50
+DEFAULT_TOKENS_PER_MINUTE = 40000
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_BACKOFF = 1.0
+DEFAULT_MAX_BACKOFF = 60.0
+
+# 529 is anthropic's "overloaded"
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def estimate_tokens(text: str) -> int:
+    # rough, but close enough for rate limiting, ~4 characters per token for english and code
+    return len(text) // 4 + 1
+
+class ProviderRateLimits:
+    """
+    Limits for a single LLM provider, set these to match the account tier
+    "tokens_per_minute" counts prompt tokens plus the requested max output tokens
+    """
+    def __init__(self, requests_per_minute: float = DEFAULT_REQUESTS_PER_MINUTE, tokens_per_minute: float = DEFAULT_TOKENS_PER_MINUTE,
+                 max_concurrent: int = DEFAULT_MAX_CONCURRENT, max_retries: int = DEFAULT_MAX_RETRIES,
+                 base_backoff: float = DEFAULT_BASE_BACKOFF, max_backoff: float = DEFAULT_MAX_BACKOFF):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_concurrent = max_concurrent
+        self.max_retries = max_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+class TokenBucket:
+    """
+    Classic token bucket, holds up to "capacity" and refills continuously at "refill_per_second"
+    A request larger than the capacity is allowed once the bucket is full, otherwise it could never run
+    """
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self._last_refill = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._last_refill) * self.refill_per_second)
+        self._last_refill = now
+
+    def time_until_available(self, amount: float) -> float:
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        if self.refill_per_second <= 0:
+            return float('inf')
+        return (amount - self.tokens) / self.refill_per_second
+
+    def consume(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def refund(self, amount: float):
+        # give back an over-estimate once the real usage is known
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+class _Waiter:
+    def __init__(self, future: asyncio.Future, tokens: int):
+        self.future = future
+        self.tokens = tokens
+
+class _ProviderState:
+    def __init__(self, limits: ProviderRateLimits):
+        self.limits = limits
+        self.request_bucket = TokenBucket(max(limits.requests_per_minute / 60.0, 1.0), limits.requests_per_minute / 60.0)
+        self.token_bucket = TokenBucket(limits.tokens_per_minute, limits.tokens_per_minute / 60.0)
+        self.active = 0
+        # set from retry-after, nothing is dispatched to the provider before this time
+        self.blocked_until = 0.0
+        # one fifo per task key, the key order is the round robin order
+        self.queues: "OrderedDict[Any, Deque[_Waiter]]" = OrderedDict()
+        self.wake_handle: Optional[asyncio.TimerHandle] = None
+        self.stats = {"requests": 0, "retries": 0, "rate_limited": 0, "failed": 0}
+
+class LLMScheduler:
+    """
+    Every LLM request goes through here before it reaches the connection pool
+    Per provider: at most "max_concurrent" requests in flight, requests/min and tokens/min token buckets, and a
+    provider wide pause when the server answers with retry-after.
+    Waiting requests are queued per task key (ie per Task) and served round robin, so a graph with many ready
+    nodes can't starve another graph that is running at the same time.
+    Must be used from the ASYNC_RUNTIME loop.
+    """
+    def __init__(self):
+        self._limits: Dict[Any, ProviderRateLimits] = {}
+        self._providers: Dict[Any, _ProviderState] = {}
+
+    def configure(self, provider, limits: ProviderRateLimits):
+        self._limits[provider] = limits
+        # rebuilt lazily, requests already queued keep their place
+        state = self._providers.get(provider)
+        if state:
+            state.limits = limits
+            state.request_bucket = TokenBucket(max(limits.requests_per_minute / 60.0, 1.0), limits.requests_per_minute / 60.0)
+            state.token_bucket = TokenBucket(limits.tokens_per_minute, limits.tokens_per_minute / 60.0)
+
+    def get_limits(self, provider) -> ProviderRateLimits:
+        if provider not in self._limits:
+            self._limits[provider] = ProviderRateLimits()
+        return self._limits[provider]
+
+    def _get_state(self, provider) -> _ProviderState:
+        state = self._providers.get(provider)
+        if state is None:
+            state = _ProviderState(self.get_limits(provider))
+            self._providers[provider] = state
+        return state
+
+    def get_stats(self, provider) -> Dict[str, int]:
+        state = self._get_state(provider)
+        stats = dict(state.stats)
+        stats["active"] = state.active
+        stats["queued"] = sum(len(queue) for queue in state.queues.values())
+        return stats
+
+    async def acquire(self, provider, task_key: Any, tokens: int):
+        assert ASYNC_RUNTIME.in_runtime_thread(), "LLMScheduler must be used from the ASYNC_RUNTIME loop"
+        state = self._get_state(provider)
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), tokens)
+        state.queues.setdefault(task_key, deque()).append(waiter)
+        self._dispatch(provider)
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # granted and cancelled at the same time, hand the slot back
+                self.release(provider)
+            else:
+                self._remove_waiter(state, task_key, waiter)
+            raise
+
+    def release(self, provider):
+        state = self._get_state(provider)
+        state.active -= 1
+        self._dispatch(provider)
+
+    def refund_tokens(self, provider, tokens: int):
+        # requests are charged an estimate up front, give back the difference once the real usage is known
+        if tokens > 0:
+            self._get_state(provider).token_bucket.refund(tokens)
+            self._dispatch(provider)
+
+    def block_until(self, provider, retry_after: float):
+        state = self._get_state(provider)
+        state.blocked_until = max(state.blocked_until, time.monotonic() + retry_after)
+        state.stats["rate_limited"] += 1
+
+    def _remove_waiter(self, state: _ProviderState, task_key: Any, waiter: _Waiter):
+        queue = state.queues.get(task_key)
+        if queue and waiter in queue:
+            queue.remove(waiter)
+            if not queue:
+                del state.queues[task_key]
+
+    def _dispatch(self, provider):
+        state = self._get_state(provider)
+        if state.wake_handle:
+            state.wake_handle.cancel()
+            state.wake_handle = None
+
+        while state.active < state.limits.max_concurrent and state.queues:
+            task_key, queue = next(iter(state.queues.items()))
+            waiter = queue[0]
+            if waiter.future.done():
+                queue.popleft()
+                if not queue:
+                    del state.queues[task_key]
+                continue
+
+            wait = max(state.blocked_until - time.monotonic(),
+                       state.request_bucket.time_until_available(1),
+                       state.token_bucket.time_until_available(waiter.tokens))
+            if wait > 0:
+                if wait != float('inf'):
+                    state.wake_handle = asyncio.get_running_loop().call_later(wait, self._dispatch, provider)
+                return
+
+            queue.popleft()
+            # rotate the task to the back of the round robin
+            state.queues.move_to_end(task_key)
+            if not queue:
+                del state.queues[task_key]
+            state.request_bucket.consume(1)
+            state.token_bucket.consume(waiter.tokens)
+            state.active += 1
+            state.stats["requests"] += 1
+            waiter.future.set_result(True)
+
+    def get_retry_after(self, error: BaseException) -> Optional[float]:
+        headers = getattr(error, "headers", None)
+        if not headers:
+            return None
+        retry_after_ms = headers.get("retry-after-ms")
+        if retry_after_ms:
+            try:
+                return float(retry_after_ms) / 1000.0
+            except ValueError:
+                pass
+        retry_after = headers.get("retry-after")
+        if retry_after:
+            try:
+                return float(retry_after)
+            except ValueError:
+                try:
+                    return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+                except (TypeError, ValueError):
+                    pass
+        return None
+
+    def is_retryable(self, error: BaseException) -> bool:
+        if isinstance(error, aiohttp.ClientResponseError):
+            return error.status in RETRYABLE_STATUS_CODES
+        return isinstance(error, (asyncio.TimeoutError, aiohttp.ClientConnectionError, aiohttp.ClientPayloadError))
+
+    def get_backoff(self, provider, attempt: int) -> float:
+        # "full jitter", spreads the retries of requests that failed together
+        limits = self.get_limits(provider)
+        return random.uniform(0, min(limits.max_backoff, limits.base_backoff * (2 ** attempt)))
+
+    async def stream(self, provider, task_key: Any, tokens: int, open_stream: Callable[[], AsyncGenerator[Any, None]],
+                     on_retry: Optional[Callable[[int, float, BaseException], None]] = None) -> AsyncGenerator[Any, None]:
+        """
+        Run "open_stream" when the provider has capacity and yield what it yields
+        Failures before the first item (429, 5xx, timeouts, dropped connections) are retried with backoff,
+        once anything has been yielded the error is passed on, the caller has already consumed part of the response
+        """
+        limits = self.get_limits(provider)
+        attempt = 0
+        while True:
+            await self.acquire(provider, task_key, tokens)
+            started = False
+            try:
+                async for item in open_stream():
+                    started = True
+                    yield item
+                return
+            except Exception as e:
+                if started or attempt >= limits.max_retries or not self.is_retryable(e):
+                    self._get_state(provider).stats["failed"] += 1
+                    raise
+                retry_after = self.get_retry_after(e)
+                if retry_after is not None:
+                    self.block_until(provider, retry_after)
+                delay = max(retry_after or 0.0, self.get_backoff(provider, attempt))
+                attempt += 1
+                self._get_state(provider).stats["retries"] += 1
+                if on_retry:
+                    on_retry(attempt, delay, e)
+            finally:
+                self.release(provider)
+            await asyncio.sleep(delay)
+
+# Global scheduler, shared by every TaskNode_LLM in the process
+GLOBAL_LLM_SCHEDULER = LLMScheduler()
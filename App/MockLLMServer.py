@@ -0,0 +1,488 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+
+DEFAULT_MOCK_PORT = 8089
+
+# openai only caches prompts from this size up
+OPENAI_MIN_CACHED_TOKENS = 1024
+
+DEFAULT_MOCK_RESPONSE = """Sure, here is the implementation.
+<file app/main.py>
+import socket
+
+
+def main():
+    server_socket = socket.create_server(("localhost", 4221), reuse_port=True)
+    server_socket.accept()
+
+
+if __name__ == "__main__":
+    main()
+</file>
+And the change to the readme:
+<diff README.md>
+--- a/README.md
++++ b/README.md
+@@ -1,2 +1,3 @@
+ # Http Server
++Run with python app/main.py
+
+</diff>
+<task_graph>
+{
+    "__type__": "TaskNode.TaskNode_Container",
+    "name": "Mock Task",
+    "children": [
+        {
+            "__type__": "TaskNode_LLM.TaskNode_LLM",
+            "name": "Mock LLM Node",
+            "prompt": "Say hello",
+            "children": []
+        }
+    ]
+}
+</task_graph>
+PHASE_COMPLETE"""
+
+class MockScriptedResponse:
+    """
+    A canned response, used when "match" (a regex) is found in the prompt, or in order when match is None
+    """
+    def __init__(self, text: str, match: Optional[str] = None, status: int = 200):
+        self.text = text
+        self.match = re.compile(match, re.DOTALL) if match else None
+        self.status = status
+
+class MockLLMServer:
+    """
+    Local stand-in for the OpenAI and Anthropic chat apis, speaking the same SSE streaming formats
+    that TaskNode_LLM parses. Used for load testing and offline regression runs, point TaskNode_LLM at
+    it with Set_Provider_Base_Url or the TASKMASTER_LLM_BASE_URL environment variable.
+
+    Timing: "time_to_first_token" seconds before the first token, then "tokens_per_second"
+    Errors: each request fails with 429 / 500 / a hang (client side timeout) with the given probabilities
+    Responses: scripted responses are matched against the prompt, unmatched requests cycle through
+    the unconditional ones, falling back to DEFAULT_MOCK_RESPONSE
+    """
+    def __init__(self, host: str = "127.0.0.1", port: int = DEFAULT_MOCK_PORT,
+                 time_to_first_token: float = 0.2, tokens_per_second: float = 100.0, chars_per_token: int = 4,
+                 rate_limit_probability: float = 0.0, server_error_probability: float = 0.0, timeout_probability: float = 0.0,
+                 retry_after: float = 1.0, hang_seconds: float = 600.0, batch_delay: float = 1.0, seed: Optional[int] = None):
+        self.host = host
+        self.port = port
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.chars_per_token = chars_per_token
+        self.rate_limit_probability = rate_limit_probability
+        self.server_error_probability = server_error_probability
+        self.timeout_probability = timeout_probability
+        self.retry_after = retry_after
+        self.hang_seconds = hang_seconds
+        self.batch_delay = batch_delay
+        self.scripted_responses: List[MockScriptedResponse] = []
+        self.request_counts: Dict[str, int] = {"total": 0, "429": 0, "500": 0, "timeout": 0}
+        self._random = random.Random(seed)
+        self._next_unmatched = 0
+        # hashes of the prompt prefixes a real provider would have cached
+        self._prefix_cache = set()
+        # batch api state, uploaded/result files and batches by id
+        self._files: Dict[str, bytes] = {}
+        self._batches: Dict[str, Dict] = {}
+        self._batch_results: Dict[str, bytes] = {}
+        self._runner: Optional[web.AppRunner] = None
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    def add_scripted_response(self, text: str, match: Optional[str] = None, status: int = 200):
+        self.scripted_responses.append(MockScriptedResponse(text, match, status))
+
+    def _create_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle_openai)
+        app.router.add_post("/v1/messages", self._handle_anthropic)
+        app.router.add_post("/v1/files", self._handle_openai_file_upload)
+        app.router.add_get("/v1/files/{file_id}/content", self._handle_openai_file_content)
+        app.router.add_post("/v1/batches", self._handle_openai_batch_create)
+        app.router.add_get("/v1/batches/{batch_id}", self._handle_openai_batch_get)
+        app.router.add_post("/v1/batches/{batch_id}/cancel", self._handle_openai_batch_cancel)
+        app.router.add_post("/v1/messages/batches", self._handle_anthropic_batch_create)
+        app.router.add_get("/v1/messages/batches/{batch_id}", self._handle_anthropic_batch_get)
+        app.router.add_get("/v1/messages/batches/{batch_id}/results", self._handle_anthropic_batch_results)
+        app.router.add_post("/v1/messages/batches/{batch_id}/cancel", self._handle_anthropic_batch_cancel)
+        app.router.add_route("HEAD", "/", self._handle_head)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self._create_app())
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def _handle_head(self, request: web.Request) -> web.Response:
+        return web.Response()
+
+    def _get_prompt(self, data: Dict) -> str:
+        # flattens both plain string content and content block lists
+        parts = []
+        system = data.get("system")
+        if isinstance(system, str):
+            parts.append(system)
+        elif isinstance(system, list):
+            parts.extend(block.get("text", "") for block in system)
+        for message in data.get("messages", []):
+            content = message.get("content", "")
+            if isinstance(content, str):
+                parts.append(content)
+            else:
+                parts.extend(block.get("text", "") for block in content)
+        return "\n".join(parts)
+
+    def _select_response(self, prompt: str) -> Tuple[str, int]:
+        for response in self.scripted_responses:
+            if response.match and response.match.search(prompt):
+                return response.text, response.status
+        unmatched = [response for response in self.scripted_responses if response.match is None]
+        if unmatched:
+            response = unmatched[self._next_unmatched % len(unmatched)]
+            self._next_unmatched += 1
+            return response.text, response.status
+        return DEFAULT_MOCK_RESPONSE, 200
+
+    def _simulate_prompt_cache(self, segments: List[Tuple[str, bool]], min_tokens: int = 0) -> Tuple[int, int, int]:
+        """
+        "segments" are the prompt's text blocks in order, flagged when a cache entry can end there
+        Returns (total, cache read, cache write) tokens, a read is the longest previously seen prefix
+        """
+        prefix = hashlib.sha256()
+        total = 0
+        cache_read = 0
+        last_breakpoint = 0
+        new_keys = []
+        for text, is_breakpoint in segments:
+            prefix.update(text.encode('utf-8'))
+            prefix.update(b"\0")
+            total += len(self._tokenize(text))
+            if is_breakpoint and total >= min_tokens:
+                key = prefix.hexdigest()
+                if key in self._prefix_cache:
+                    cache_read = total
+                else:
+                    new_keys.append(key)
+                last_breakpoint = total
+        self._prefix_cache.update(new_keys)
+        cache_write = last_breakpoint - cache_read if new_keys and last_breakpoint > cache_read else 0
+        return total, cache_read, cache_write
+
+    def _get_text_blocks(self, content) -> List[Dict]:
+        if isinstance(content, str):
+            return [{"type": "text", "text": content}]
+        return content
+
+    def _tokenize(self, text: str) -> List[str]:
+        return [text[i:i+self.chars_per_token] for i in range(0, len(text), self.chars_per_token)]
+
+    async def _inject_error(self) -> Optional[web.Response]:
+        self.request_counts["total"] += 1
+        roll = self._random.random()
+        if roll < self.rate_limit_probability:
+            self.request_counts["429"] += 1
+            return web.json_response({"error": {"type": "rate_limit_error", "message": "mock rate limit"}},
+                                     status=429, headers={"retry-after": str(self.retry_after)})
+        roll -= self.rate_limit_probability
+        if roll < self.server_error_probability:
+            self.request_counts["500"] += 1
+            return web.json_response({"error": {"type": "api_error", "message": "mock server error"}}, status=500)
+        roll -= self.server_error_probability
+        if roll < self.timeout_probability:
+            self.request_counts["timeout"] += 1
+            await asyncio.sleep(self.hang_seconds)
+            return web.json_response({"error": {"type": "timeout", "message": "mock timeout"}}, status=504)
+        return None
+
+    def _get_openai_usage(self, data: Dict, tokens: List[str]) -> Dict:
+        # openai caches automatically at any message boundary
+        segments = [(f"{message.get('role')}:{json.dumps(message.get('content'))}", True) for message in data.get("messages", [])]
+        prompt_tokens, cached_tokens, _ = self._simulate_prompt_cache(segments, OPENAI_MIN_CACHED_TOKENS)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens),
+                "prompt_tokens_details": {"cached_tokens": cached_tokens}}
+
+    def _get_anthropic_usage(self, data: Dict, tokens: List[str]) -> Dict:
+        # anthropic only caches at the blocks marked with cache_control
+        segments = []
+        for block in self._get_text_blocks(data.get("system", [])):
+            segments.append((f"system:{block.get('text', '')}", "cache_control" in block))
+        for message in data.get("messages", []):
+            for block in self._get_text_blocks(message.get("content", "")):
+                segments.append((f"{message.get('role')}:{block.get('text', '')}", "cache_control" in block))
+        total_tokens, cache_read, cache_write = self._simulate_prompt_cache(segments)
+        return {"input_tokens": total_tokens - cache_read - cache_write, "output_tokens": len(tokens),
+                "cache_read_input_tokens": cache_read, "cache_creation_input_tokens": cache_write}
+
+    async def _stream_tokens(self, response: web.StreamResponse, tokens: List[str], format_token):
+        await asyncio.sleep(self.time_to_first_token)
+        delay = 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+        start = time.monotonic()
+        for index, token in enumerate(tokens):
+            await response.write(format_token(token))
+            # sleep against the schedule rather than per token so timing doesn't drift
+            wait = start + (index + 1) * delay - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+
+    async def _handle_openai(self, request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        error_response = await self._inject_error()
+        if error_response:
+            return error_response
+        text, status = self._select_response(self._get_prompt(data))
+        if status != 200:
+            return web.json_response({"error": {"message": text}}, status=status)
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        model = data.get("model", "mock")
+        tokens = self._tokenize(text)
+        usage = self._get_openai_usage(data, tokens)
+        if not data.get("stream", False):
+            await asyncio.sleep(self.time_to_first_token + len(tokens) / max(self.tokens_per_second, 1e-6))
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def format_token(token: str) -> bytes:
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": model,
+                     "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]}
+            return f"data: {json.dumps(chunk)}\n\n".encode('utf-8')
+
+        await self._stream_tokens(response, tokens, format_token)
+        if (data.get("stream_options") or {}).get("include_usage"):
+            usage_chunk = {"id": completion_id, "object": "chat.completion.chunk", "model": model, "choices": [], "usage": usage}
+            await response.write(f"data: {json.dumps(usage_chunk)}\n\n".encode('utf-8'))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def _handle_anthropic(self, request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        error_response = await self._inject_error()
+        if error_response:
+            return error_response
+        text, status = self._select_response(self._get_prompt(data))
+        if status != 200:
+            return web.json_response({"type": "error", "error": {"type": "api_error", "message": text}}, status=status)
+
+        message_id = f"msg_{uuid.uuid4().hex}"
+        model = data.get("model", "mock")
+        tokens = self._tokenize(text)
+        usage = self._get_anthropic_usage(data, tokens)
+        if not data.get("stream", False):
+            await asyncio.sleep(self.time_to_first_token + len(tokens) / max(self.tokens_per_second, 1e-6))
+            return web.json_response({
+                "id": message_id, "type": "message", "role": "assistant", "model": model,
+                "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def format_event(event_type: str, event: Dict) -> bytes:
+            event["type"] = event_type
+            return f"event: {event_type}\ndata: {json.dumps(event)}\n\n".encode('utf-8')
+
+        await response.write(format_event("message_start", {"message": {"id": message_id, "type": "message", "role": "assistant",
+                                                                        "model": model, "content": [],
+                                                                        "usage": dict(usage, output_tokens=1)}}))
+        await response.write(format_event("content_block_start", {"index": 0, "content_block": {"type": "text", "text": ""}}))
+        await self._stream_tokens(response, tokens,
+                                  lambda token: format_event("content_block_delta", {"index": 0, "delta": {"type": "text_delta", "text": token}}))
+        await response.write(format_event("content_block_stop", {"index": 0}))
+        await response.write(format_event("message_delta", {"delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": len(tokens)}}))
+        await response.write(format_event("message_stop", {}))
+        await response.write_eof()
+        return response
+
+    # batch apis, requests are answered all at once "batch_delay" seconds after the batch is created
+
+    async def _handle_openai_file_upload(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        file_id = f"file-{uuid.uuid4().hex}"
+        self._files[file_id] = upload.file.read()
+        return web.json_response({"id": file_id, "object": "file", "bytes": len(self._files[file_id]),
+                                  "filename": upload.filename, "purpose": form.get("purpose", "batch")})
+
+    async def _handle_openai_file_content(self, request: web.Request) -> web.Response:
+        file_id = request.match_info["file_id"]
+        if file_id not in self._files:
+            return web.json_response({"error": {"message": f"no such file {file_id}"}}, status=404)
+        return web.Response(body=self._files[file_id], content_type="application/jsonl")
+
+    async def _handle_openai_batch_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        if data.get("input_file_id") not in self._files:
+            return web.json_response({"error": {"message": "input file not found"}}, status=400)
+        batch = {"id": f"batch_{uuid.uuid4().hex}", "object": "batch", "endpoint": data.get("endpoint"),
+                 "input_file_id": data["input_file_id"], "completion_window": data.get("completion_window", "24h"),
+                 "status": "in_progress", "output_file_id": None, "error_file_id": None,
+                 "request_counts": {"total": 0, "completed": 0, "failed": 0}}
+        self._batches[batch["id"]] = batch
+        asyncio.ensure_future(self._process_openai_batch(batch))
+        return web.json_response(batch)
+
+    async def _process_openai_batch(self, batch: Dict):
+        await asyncio.sleep(self.batch_delay)
+        if batch["status"] != "in_progress":
+            return
+        output_lines = []
+        error_lines = []
+        for line in self._files[batch["input_file_id"]].decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            body = item.get("body", {})
+            text, status = self._select_response(self._get_prompt(body))
+            batch["request_counts"]["total"] += 1
+            if status != 200:
+                batch["request_counts"]["failed"] += 1
+                error_lines.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item.get("custom_id"),
+                                               "response": {"status_code": status, "body": {"error": {"message": text}}}, "error": None}))
+                continue
+            batch["request_counts"]["completed"] += 1
+            response_body = {"id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "model": body.get("model", "mock"),
+                             "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                             "usage": self._get_openai_usage(body, self._tokenize(text))}
+            output_lines.append(json.dumps({"id": f"batch_req_{uuid.uuid4().hex}", "custom_id": item.get("custom_id"),
+                                            "response": {"status_code": 200, "body": response_body}, "error": None}))
+        if output_lines:
+            batch["output_file_id"] = f"file-{uuid.uuid4().hex}"
+            self._files[batch["output_file_id"]] = "\n".join(output_lines).encode('utf-8')
+        if error_lines:
+            batch["error_file_id"] = f"file-{uuid.uuid4().hex}"
+            self._files[batch["error_file_id"]] = "\n".join(error_lines).encode('utf-8')
+        batch["status"] = "completed"
+
+    async def _handle_openai_batch_get(self, request: web.Request) -> web.Response:
+        batch = self._batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        return web.json_response(batch)
+
+    async def _handle_openai_batch_cancel(self, request: web.Request) -> web.Response:
+        batch = self._batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"error": {"message": "batch not found"}}, status=404)
+        if batch["status"] == "in_progress":
+            batch["status"] = "cancelled"
+        return web.json_response(batch)
+
+    async def _handle_anthropic_batch_create(self, request: web.Request) -> web.Response:
+        data = await request.json()
+        batch = {"id": f"msgbatch_{uuid.uuid4().hex}", "type": "message_batch", "processing_status": "in_progress",
+                 "request_counts": {"processing": len(data.get("requests", [])), "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0},
+                 "results_url": None}
+        self._batches[batch["id"]] = batch
+        asyncio.ensure_future(self._process_anthropic_batch(batch, data.get("requests", [])))
+        return web.json_response(batch)
+
+    async def _process_anthropic_batch(self, batch: Dict, requests: List[Dict]):
+        await asyncio.sleep(self.batch_delay)
+        counts = batch["request_counts"]
+        lines = []
+        for item in requests:
+            counts["processing"] -= 1
+            if batch["processing_status"] != "in_progress":
+                counts["canceled"] += 1
+                lines.append(json.dumps({"custom_id": item.get("custom_id"), "result": {"type": "canceled"}}))
+                continue
+            params = item.get("params", {})
+            text, status = self._select_response(self._get_prompt(params))
+            if status != 200:
+                counts["errored"] += 1
+                lines.append(json.dumps({"custom_id": item.get("custom_id"),
+                                         "result": {"type": "errored", "error": {"type": "api_error", "message": text}}}))
+                continue
+            counts["succeeded"] += 1
+            message = {"id": f"msg_{uuid.uuid4().hex}", "type": "message", "role": "assistant", "model": params.get("model", "mock"),
+                       "content": [{"type": "text", "text": text}], "stop_reason": "end_turn",
+                       "usage": self._get_anthropic_usage(params, self._tokenize(text))}
+            lines.append(json.dumps({"custom_id": item.get("custom_id"), "result": {"type": "succeeded", "message": message}}))
+        self._batch_results[batch["id"]] = "\n".join(lines).encode('utf-8')
+        batch["processing_status"] = "ended"
+        batch["results_url"] = f"{self.base_url}/v1/messages/batches/{batch['id']}/results"
+
+    async def _handle_anthropic_batch_get(self, request: web.Request) -> web.Response:
+        batch = self._batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"type": "error", "error": {"type": "not_found_error", "message": "batch not found"}}, status=404)
+        return web.json_response(batch)
+
+    async def _handle_anthropic_batch_results(self, request: web.Request) -> web.Response:
+        batch_id = request.match_info["batch_id"]
+        if batch_id not in self._batch_results:
+            return web.json_response({"type": "error", "error": {"type": "not_found_error", "message": "results not ready"}}, status=404)
+        return web.Response(body=self._batch_results[batch_id], content_type="application/jsonl")
+
+    async def _handle_anthropic_batch_cancel(self, request: web.Request) -> web.Response:
+        batch = self._batches.get(request.match_info["batch_id"])
+        if batch is None:
+            return web.json_response({"type": "error", "error": {"type": "not_found_error", "message": "batch not found"}}, status=404)
+        if batch["processing_status"] == "in_progress":
+            batch["processing_status"] = "canceling"
+        return web.json_response(batch)
+
+def main():
+    parser = argparse.ArgumentParser(description="Local OpenAI/Anthropic compatible mock inference server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_MOCK_PORT)
+    parser.add_argument("--ttft", type=float, default=0.2, help="time to first token in seconds")
+    parser.add_argument("--tps", type=float, default=100.0, help="tokens per second")
+    parser.add_argument("--rate-limit", type=float, default=0.0, help="probability of a 429 response")
+    parser.add_argument("--server-error", type=float, default=0.0, help="probability of a 500 response")
+    parser.add_argument("--timeout", type=float, default=0.0, help="probability of a request hanging")
+    parser.add_argument("--batch-delay", type=float, default=1.0, help="seconds before a batch completes")
+    parser.add_argument("--response-file", action="append", default=[], help="scripted response text file, can be repeated")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.host, args.port, args.ttft, args.tps,
+                           rate_limit_probability=args.rate_limit, server_error_probability=args.server_error,
+                           timeout_probability=args.timeout, batch_delay=args.batch_delay, seed=args.seed)
+    for response_file in args.response_file:
+        with open(response_file, 'r') as f:
+            server.add_scripted_response(f.read())
+
+    async def run():
+        await server.start()
+        print(f"MockLLMServer listening on {server.base_url}")
+        print(f"set TASKMASTER_LLM_BASE_URL={server.base_url} to use it")
+        while True:
+            await asyncio.sleep(3600)
+
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
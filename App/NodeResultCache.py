@@ -0,0 +1,110 @@
+import copy
+import hashlib
+import json
+import os
+from typing import Dict, Optional
+
+from Serializable import ISerializable
+from TaskNode import TaskNode
+from TypeDefs import TaskContext
+from VariableStack import VariableStack
+from Util import ASSET_PREFIX, is_project_file_reference, resolve_context_input, resolve_project_asset_path
+
+MAX_NODE_RESULTS = 256
+
+def Get_File_Hash(filepath: str) -> Optional[str]:
+    if not os.path.isfile(filepath):
+        return None
+    hasher = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+class NodeResultCache(ISerializable):
+    """
+    The results of TaskNodes that completed, keyed by a fingerprint of the node's definition and its resolved inputs
+    A node whose fingerprint matches an earlier run is skipped, its "output" and the variables it wrote are restored.
+    Editing a node changes its own fingerprint, and a new result from it changes the inputs, and so the fingerprints,
+    of the nodes that read it, so only the nodes downstream of a change run again. Nodes that read the same result
+    as before are still skipped.
+    Project files a node wrote are checked on a hit, if one was changed or deleted since, the node runs again.
+    Saved with the Task, entries with variables that can't be saved as json are not cached.
+    """
+    def __init__(self):
+        self.entries: Dict[str, Dict] = {}
+        self.enabled: bool = True
+        self._hits = 0
+        self._misses = 0
+
+    def make_key(self, node: TaskNode, task_context: TaskContext) -> Optional[str]:
+        # None if the node can't be cached or an input can't be resolved, the node runs and reports its own error
+        if not self.enabled or not node.is_result_cacheable():
+            return None
+        definition = {name: value for name, value in node.to_dict().items() if name not in node._exclude_from_fingerprint}
+        hasher = hashlib.sha256()
+        hasher.update(json.dumps(definition, sort_keys=True, default=str).encode('utf-8'))
+        for input in node.inputs:
+            try:
+                if is_project_file_reference(input, task_context):
+                    value = task_context.get_file_cache().get_hash(resolve_project_asset_path(input, task_context))
+                else:
+                    value = resolve_context_input(input, task_context)
+            except Exception:
+                return None
+            hasher.update(b'\0')
+            hasher.update(input.encode('utf-8'))
+            hasher.update(b'\0')
+            hasher.update(json.dumps(value, sort_keys=True, default=str).encode('utf-8'))
+        return hasher.hexdigest()
+
+    def restore(self, key: Optional[str], node: TaskNode, task_context: TaskContext) -> bool:
+        if key is None or key not in self.entries:
+            if key is not None:
+                self._misses += 1
+            return False
+        entry = self.entries[key]
+        for asset, file_hash in entry["files"].items():
+            if Get_File_Hash(resolve_project_asset_path(asset, task_context)) != file_hash:
+                self._misses += 1
+                return False
+        node.output = list(entry["output"])
+        for name, value in entry["variables"].items():
+            task_context.variable_stack[name] = copy.deepcopy(value)
+        for name in entry["removed_variables"]:
+            task_context.variable_stack.pop(name, None)
+        # most recently used last
+        self.entries[key] = self.entries.pop(key)
+        self._hits += 1
+        return True
+
+    def store(self, key: Optional[str], node: TaskNode, task_context: TaskContext, variables_before: VariableStack):
+        # variables_before is a snapshot of task_context.variable_stack from before the node ran
+        if key is None:
+            return
+        changed, removed = task_context.variable_stack.get_changes(variables_before)
+        variables = {name: value for name, (value, _) in changed.items()}
+        try:
+            json.dumps(variables)
+        except (TypeError, ValueError):
+            return
+        files = {}
+        for output in node.output:
+            if output.startswith(ASSET_PREFIX):
+                files[output] = Get_File_Hash(resolve_project_asset_path(output, task_context))
+        self.entries.pop(key, None)
+        self.entries[key] = {
+            "node": node.name,
+            "output": list(node.output),
+            "variables": copy.deepcopy(variables),
+            "removed_variables": removed,
+            "files": files,
+        }
+        while len(self.entries) > MAX_NODE_RESULTS:
+            self.entries.pop(next(iter(self.entries)))
+
+    def clear(self):
+        self.entries.clear()
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"entries": len(self.entries), "hits": self._hits, "misses": self._misses}
@@ -1,16 +1,80 @@
 import csv
 import json
+import os
+import tempfile
+import threading
 
-from Task import Task 
+from collections import OrderedDict
+from Task import Task, TaskPhase
 from Serializable import ISerializable
 from collections import namedtuple
 from typing import Any, Dict, List
-from TypeDefs import TaskNodeState
+import Globals
+from LLMMetrics import LLMUsageSummary, Get_Top_Usage
+from SessionJournal import SessionJournal, Get_Journal_Folder, GLOBAL_JOURNAL_COMPACTOR
+from AsyncRuntime import ASYNC_RUNTIME
+
+# 1: each task was a json string inside the project json
+# 2: tasks are part of the document
+# 3: a header line with the project fields and a task_index, then each task's json at the offset in the index
+PROJECT_FORMAT_VERSION = 3
+# None writes compact tasks, set to 4 for files that are easier to read and diff, the header line is always compact
+PROJECT_FILE_INDENT = None
+# tasks that haven't been used recently are unloaded past this much task json, the task on screen and running tasks stay
+MAX_LOADED_TASK_BYTES = 64 * 1024 * 1024
+
+def _migrate_v1(data: Dict[str, Any]) -> Dict[str, Any]:
+    data['tasks'] = [json.loads(task) if isinstance(task, str) else task for task in data['tasks']]
+    return data
+
+def _migrate_v2(data: Dict[str, Any]) -> Dict[str, Any]:
+    # only the file layout changed, the task_index is written on the next save
+    return data
+
+# format_version -> the function that brings data from that version to the next one
+project_migrations = {
+    1: _migrate_v1,
+    2: _migrate_v2,
+}
+
+def Migrate_Project_Data(data: Dict[str, Any]) -> Dict[str, Any]:
+    # brings the data loaded from a .project file up to PROJECT_FORMAT_VERSION, files from before versioning are 1
+    version = data.get('format_version', 1)
+    if version > PROJECT_FORMAT_VERSION:
+        raise ValueError(f"The project file is format version {version}, newer than this version supports ({PROJECT_FORMAT_VERSION})")
+    while version < PROJECT_FORMAT_VERSION:
+        data = project_migrations[version](data)
+        version += 1
+    data['format_version'] = version
+    return data
+
+class TaskSource:
+    """
+    Where the json of a task that isn't loaded is, "length" bytes at "offset" in the project file, or in "spill_file",
+    the project's temporary file for tasks unloaded with changes that haven't been saved
+    """
+    def __init__(self, file_name: str, offset: int, length: int, spill_file = None):
+        self.file_name = file_name
+        self.offset = offset
+        self.length = length
+        self.spill_file = spill_file
+
+    def read(self) -> bytes:
+        if self.spill_file is not None:
+            self.spill_file.seek(self.offset)
+            return self.spill_file.read(self.length)
+        with open(self.file_name, 'rb') as f:
+            f.seek(self.offset)
+            return f.read(self.length)
 
 class Project(ISerializable):
     """
     In essensce, the Project is a container for the list of tasks, and project specific data
     Currently only focused on any type software development using git
+    Tasks opened from a file are only their task_index entry (name, id, phase) until Task.ensure_loaded() reads their
+    session and graph, least recently loaded tasks are unloaded again past MAX_LOADED_TASK_BYTES.
+    Once the project has a file, task sessions are written to a SessionJournal next to it as they change, which is
+    replayed when the task is loaded and merged into the file when the project is saved.
     """    
     def __init__(self, name: str):
         self.name = name
@@ -27,9 +91,17 @@ class Project(ISerializable):
         self.project_data['documentation'] = []
         self.project_data['code_manifest'] = {}
         self.project_data['build_instructions'] = ""
+        # task_id -> json size, least recently used first
+        self._loaded_tasks: "OrderedDict[str, int]" = OrderedDict()
+        self._spill_file = None
+        # task_id -> the journal of the task's session
+        self._journals: Dict[str, SessionJournal] = {}
+        self._lock = threading.RLock()
 
     def add_task(self, task: Task):
         self.tasks.append(task)
+        if task.is_loaded():
+            task.LLM_interface.set_journal(self.get_journal(task))
 
     def register_new_file(self, filename: str):
         if 'files' not in self.project_data:
@@ -37,33 +109,165 @@ class Project(ISerializable):
         if filename not in self.project_data['files']:
             self.project_data['files'].append(filename)
 
+    def get_usage_summary(self) -> LLMUsageSummary:
+        summary = LLMUsageSummary()
+        for task in self.tasks:
+            task.ensure_loaded()
+            summary.merge(task.get_usage_summary())
+        return summary
+
+    def get_top_usage(self, metric: str = "cost", count: int = 10) -> List[tuple]:
+        # the most expensive/slowest nodes across all tasks, metric is one of LLMMetrics.USAGE_METRICS
+        node_usage = []
+        for task in self.tasks:
+            task.ensure_loaded()
+            node_usage.extend(task.get_node_usage())
+        return Get_Top_Usage(node_usage, metric, count)
+
     _exclude_from_properties = ['tasks']
     _exclude_from_usd = ['task_graph_root']
     _exclude_from_json = ['task_graph_root']
     
+    def _get_task_json(self, task: Task) -> bytes:
+        # tasks that aren't loaded are copied as they are
+        if not task.is_loaded():
+            return task._source.read()
+        # graphs run and responses stream on the runtime, serialized there a task isn't changed halfway through,
+        # the session is also changed from the qt thread and is guarded by its own lock, see TaskNode_LLM
+        if ASYNC_RUNTIME.is_running() and not ASYNC_RUNTIME.in_runtime_thread():
+            return ASYNC_RUNTIME.run(self._get_task_json_async(task))
+        task.LLM_interface.sync_session()
+        return json.dumps(task.to_dict(), indent=PROJECT_FILE_INDENT, default=ISerializable._json_default).encode('utf-8')
+
+    async def _get_task_json_async(self, task: Task) -> bytes:
+        return self._get_task_json(task)
+
+    def get_journal(self, task: Task):
+        # None until the project has a file
+        if not self.file_name:
+            return None
+        journal = self._journals.get(task.task_id)
+        if journal is None:
+            journal = SessionJournal(os.path.join(Get_Journal_Folder(self.file_name), f"{task.task_id}.jsonl"), self._on_journal_grow)
+            self._journals[task.task_id] = journal
+        return journal
+
+    def _on_journal_grow(self, journal: SessionJournal):
+        if GLOBAL_JOURNAL_COMPACTOR.needs_compaction(journal):
+            GLOBAL_JOURNAL_COMPACTOR.schedule(self)
+
+    def _recover_session(self, task: Task):
+        # applies what was journaled since the task was last saved, then journals the session from here on
+        journal = self.get_journal(task)
+        if journal is None:
+            return
+        applied = journal.replay(task.LLM_interface.session)
+        if applied > 0:
+            print(f"Recovered {applied} session changes for {task.name} from {journal.file_name}")
+            task.LLM_interface.invalidate_session_context()
+        task.LLM_interface.set_journal(journal)
+
+    def _get_header_line(self, tasks: List[Task], offsets: List[int], lengths: List[int]) -> bytes:
+        # the offsets and lengths are padded to a fixed width, so the line can be written before they are known and
+        # written again over itself once they are, json allows the spaces
+        header = json.dumps(self.to_json(), default=ISerializable._json_default)
+        task_index = ", ".join(
+            '{"task_id": %s, "name": %s, "task_phase": %d, "offset": %-20d, "length": %-20d}'
+            % (json.dumps(task.task_id), json.dumps(task.name), int(task.task_phase), offset, length)
+            for task, offset, length in zip(tasks, offsets, lengths))
+        return f'{header[:-1]}, "task_index": [{task_index}]}}\n'.encode('utf-8')
+
     def save_to_file(self, file_name):
-        data = self.to_json()
-        with open(file_name, 'w') as f:
-            json.dump(data, f, indent=4)
-        self.file_name = file_name
+        # written to a temporary file that replaces the old one, a failed save leaves it as it was
+        # each task is written as it is serialized, then the task_index in the header line is filled in
+        temp_file_name = f"{file_name}.tmp"
+        with self._lock:
+            tasks = list(self.tasks)
+            offsets = [0] * len(tasks)
+            lengths = [0] * len(tasks)
+            # the journals up to here are in the file once it is written, streamed text included
+            journal_sizes = {task_id: journal.get_size() for task_id, journal in self._journals.items()}
+            try:
+                with open(temp_file_name, 'wb') as f:
+                    header_line = self._get_header_line(tasks, offsets, lengths)
+                    f.write(header_line)
+                    offset = 0
+                    for index, task in enumerate(tasks):
+                        data = self._get_task_json(task)
+                        f.write(data)
+                        f.write(b'\n')
+                        offsets[index] = offset
+                        lengths[index] = len(data)
+                        offset += len(data) + 1
+                    final_header_line = self._get_header_line(tasks, offsets, lengths)
+                    if len(final_header_line) != len(header_line):
+                        raise ValueError("The project header changed size while saving")
+                    f.seek(0)
+                    f.write(final_header_line)
+                os.replace(temp_file_name, file_name)
+            finally:
+                if os.path.exists(temp_file_name):
+                    os.remove(temp_file_name)
+            same_file = self.file_name == file_name
+            self.file_name = file_name
+
+            # tasks that aren't loaded now read from the new file, the spilled ones were saved with it
+            for task, offset, length in zip(tasks, offsets, lengths):
+                if not task.is_loaded():
+                    task._source = TaskSource(file_name, len(header_line) + offset, length)
+            if self._spill_file is not None:
+                self._spill_file.close()
+                self._spill_file = None
+            self._compact_journals(journal_sizes, same_file)
     
+    def _compact_journals(self, journal_sizes: Dict[str, int], same_file: bool):
+        # must hold _lock, drops the part of each journal that was saved
+        task_ids = {task.task_id for task in self.tasks}
+        for task_id, journal in list(self._journals.items()):
+            if not same_file:
+                # saved as another file, the old file's journals stay with it
+                journal.close()
+                del self._journals[task_id]
+            elif task_id not in task_ids:
+                # removed from the project
+                journal.delete()
+                del self._journals[task_id]
+            else:
+                journal.truncate(journal_sizes.get(task_id, 0))
+        for task in self.tasks:
+            if task.is_loaded():
+                task.LLM_interface.set_journal(self.get_journal(task))
+
     @classmethod
     def load_from_file(cls, file_name):
-        with open(file_name, 'r') as f:
-            data = json.load(f)
-        project = cls.from_json(data)
+        with open(file_name, 'rb') as f:
+            header_line = f.readline()
+            try:
+                header = json.loads(header_line)
+            except ValueError:
+                # indented files from before format version 3
+                header = None
+            if isinstance(header, dict) and 'task_index' in header:
+                project = cls.from_header(header, file_name, len(header_line))
+            else:
+                f.seek(0)
+                project = cls.from_json(Migrate_Project_Data(json.load(f)))
         project.file_name = file_name
+        for task in project.tasks:
+            if task.is_loaded():
+                project._recover_session(task)
         return project
     
     def to_json(self):
+        # the project fields, the tasks are written after them, see save_to_file
         data = {
+            'format_version': PROJECT_FORMAT_VERSION,
             'name': self.name,
             'description': self.description,
             'status': self.status,
             'git_URL': self.git_URL,
             'local_git_path': self.local_git_path,
             'project_data': self.project_data,
-            'tasks': [task.to_json() for task in self.tasks]
         }
         return data
     
@@ -71,18 +275,85 @@ class Project(ISerializable):
     def from_json(cls, data):
         project = cls(data['name'])
         for key, value in data.items():
-            if key != 'tasks':
+            if key not in ['tasks', 'format_version']:
                 setattr(project, key, value)
-        project.tasks = [Task.from_json(task_data) for task_data in data['tasks']]
+        project.tasks = [Task.from_dict(task_data) for task_data in data['tasks']]
         project.post_deserialize()
         return project
+
+    @classmethod
+    def from_header(cls, header, file_name, tasks_offset):
+        # the tasks are left unloaded, see load_task
+        version = header.get('format_version', PROJECT_FORMAT_VERSION)
+        if version > PROJECT_FORMAT_VERSION:
+            raise ValueError(f"The project file is format version {version}, newer than this version supports ({PROJECT_FORMAT_VERSION})")
+        project = cls(header['name'])
+        for key, value in header.items():
+            if key not in ['task_index', 'format_version']:
+                setattr(project, key, value)
+        for entry in header['task_index']:
+            task = Task(entry['name'], project)
+            task.task_id = entry['task_id']
+            task.task_phase = TaskPhase(entry['task_phase'])
+            task._source = TaskSource(file_name, tasks_offset + entry['offset'], entry['length'])
+            project.tasks.append(task)
+        return project
  
     def post_deserialize(self):
         for task in self.tasks:
-            task.project = self
-            task.task_context.project = self
-            task.task_context.task = task
+            task.attach_to_project(self)
+
+    def load_task(self, task: Task):
+        with self._lock:
+            if task.is_loaded():
+                if task.task_id in self._loaded_tasks:
+                    self._loaded_tasks.move_to_end(task.task_id)
+                return
+            data = task._source.read()
+            task_data = json.loads(data)
+            # the fields in the task_index belong to the stub, they could have been changed since it was written
+            task_data['name'] = task.name
+            task_data['task_phase'] = int(task.task_phase)
+            task.update_from_dict(task_data)
+            task._source = None
+            task.attach_to_project(self)
+            self._recover_session(task)
+            self._loaded_tasks[task.task_id] = len(data)
+            self._unload_tasks(MAX_LOADED_TASK_BYTES)
+
+    def unload_task(self, task: Task) -> bool:
+        # False if the task is in use, its session and graph go to the spill file until it is loaded again
+        with self._lock:
+            if not task.is_loaded():
+                return True
+            if task.is_running() or task is Globals.get_session_task():
+                return False
+            data = self._get_task_json(task)
+            if self._spill_file is None:
+                self._spill_file = tempfile.TemporaryFile()
+            offset = self._spill_file.seek(0, os.SEEK_END)
+            self._spill_file.write(data)
+            task.unload(TaskSource(self.file_name, offset, len(data), self._spill_file))
+            self._loaded_tasks.pop(task.task_id, None)
+        if Globals.ProjectManagerWindow:
+            Globals.ProjectManagerWindow.projects_tree.request_refresh_taskgraph(task)
+        return True
+
+    def _unload_tasks(self, max_bytes: int):
+        loaded_bytes = sum(self._loaded_tasks.values())
+        for task_id in list(self._loaded_tasks.keys())[:-1]:
+            if loaded_bytes <= max_bytes:
+                break
+            task = next((task for task in self.tasks if task.task_id == task_id), None)
+            size = self._loaded_tasks[task_id]
+            if task is None:
+                # removed from the project
+                del self._loaded_tasks[task_id]
+                loaded_bytes -= size
+            elif self.unload_task(task):
+                loaded_bytes -= size
 
-            current_node = task.task_context.get_current_node()
-            if len(task.task_context.node_stack) == 0 and current_node.state == TaskNodeState.Queued:
-                current_node.set_state(TaskNodeState.Ready)    
+    def get_loaded_task_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"tasks": len(self.tasks), "loaded": sum(1 for task in self.tasks if task.is_loaded()),
+                    "loaded_bytes": sum(self._loaded_tasks.values())}
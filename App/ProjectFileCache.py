@@ -0,0 +1,74 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+DEFAULT_FILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+class _CachedFile:
+    def __init__(self, version: Tuple[int, int], content: str):
+        self.version = version # (mtime_ns, size)
+        self.content = content
+        self.content_hash: Optional[str] = None
+
+class ProjectFileCache:
+    """
+    The text of project files read while a task graph runs, so a file referenced by many nodes is read and decoded once
+    and every reference shares the same string.
+    Each read stats the file and reads it again if the mtime or size changed, ie a node rewrote it.
+    Least recently used files are dropped past "max_bytes". Shared by the forked contexts of a run, reads can come
+    from worker threads.
+    """
+    def __init__(self, max_bytes: int = DEFAULT_FILE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._files: "OrderedDict[str, _CachedFile]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+        self.reads = 0
+        self.hits = 0
+
+    def _get(self, filepath: str) -> _CachedFile:
+        stat = os.stat(filepath)
+        version = (stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            cached = self._files.get(filepath)
+            if cached is not None and cached.version == version:
+                self._files.move_to_end(filepath)
+                self.hits += 1
+                return cached
+
+        with open(filepath, 'r') as file:
+            cached = _CachedFile(version, file.read())
+
+        with self._lock:
+            self.reads += 1
+            previous = self._files.pop(filepath, None)
+            if previous is not None:
+                self._total_bytes -= len(previous.content)
+            self._files[filepath] = cached
+            self._total_bytes += len(cached.content)
+            while self._total_bytes > self.max_bytes and len(self._files) > 1:
+                _, evicted = self._files.popitem(last=False)
+                self._total_bytes -= len(evicted.content)
+        return cached
+
+    def read(self, filepath: str) -> str:
+        return self._get(filepath).content
+
+    def get_hash(self, filepath: str) -> Optional[str]:
+        # sha256 of the text, None if the file doesn't exist
+        if not os.path.isfile(filepath):
+            return None
+        cached = self._get(filepath)
+        if cached.content_hash is None:
+            cached.content_hash = hashlib.sha256(cached.content.encode('utf-8')).hexdigest()
+        return cached.content_hash
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+            self._total_bytes = 0
+
+    def get_stats(self) -> Dict[str, int]:
+        return {"files": len(self._files), "bytes": self._total_bytes, "reads": self.reads, "hits": self.hits}
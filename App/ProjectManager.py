@@ -9,8 +9,16 @@ from Project import *
 from Task import *
 from TaskNode import TaskNode_Container
 from NewProjectDialog import NewProjectDialog
+from LLMConnectionPool import GLOBAL_CONNECTION_POOL
+from PythonSandbox import GLOBAL_PYTHON_SANDBOX
+from AsyncRuntime import ASYNC_RUNTIME
 import Globals
 
+# open the provider connections at startup so the first request doesn't pay for the handshake
+WARM_UP_LLM_CONNECTIONS = False
+# start the python node worker processes with the app rather than on the first python node
+PREWARM_PYTHON_SANDBOX = True
+
 def create_header_widget(text):
     header_widget = QWidget()
     header_layout = QHBoxLayout(header_widget)
@@ -201,6 +209,11 @@ class MainWindow(QMainWindow):
 
 if __name__ == "__main__":
     app = QApplication(sys.argv)
+    app.aboutToQuit.connect(ASYNC_RUNTIME.shutdown)
+    if WARM_UP_LLM_CONNECTIONS:
+        GLOBAL_CONNECTION_POOL.warm_up()
+    if PREWARM_PYTHON_SANDBOX:
+        GLOBAL_PYTHON_SANDBOX.start()
     Globals.ProjectManagerWindow = MainWindow()
     Globals.ProjectManagerWindow.show()
     sys.exit(app.exec_())
\ No newline at end of file
@@ -0,0 +1,265 @@
+import json
+import os
+import queue
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from AsyncRuntime import ASYNC_RUNTIME
+
+DEFAULT_SANDBOX_WORKERS = 2
+# seconds, long enough for a pip install
+DEFAULT_PYTHON_TIMEOUT = 600.0
+DEFAULT_PYTHON_MEMORY_MB = 2048
+SANDBOX_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PythonSandboxWorker.py")
+# how long a killed worker gets to exit before we stop waiting for it
+KILL_WAIT_SECONDS = 2.0
+
+def _get_plain_fields(obj: Any) -> Dict[str, Any]:
+    # the fields of a Project/Task that can cross to the worker as they are, ie local_git_path
+    if obj is None:
+        return {}
+    return {name: value for name, value in vars(obj).items()
+            if not name.startswith('_') and isinstance(value, (str, int, float, bool))}
+
+def Get_Json_Variables(variable_stack) -> Tuple[Dict[str, Any], List[str]]:
+    # the variables that can be sent to a worker, and the names of the ones that can't
+    variables = {}
+    skipped = []
+    for name, value in variable_stack.items():
+        try:
+            variables[name] = json.loads(json.dumps(value))
+        except (TypeError, ValueError):
+            skipped.append(name)
+    return variables, skipped
+
+def Make_Sandbox_Job(code: str, task_context, node_fields: Dict[str, Any], memory_mb: int = DEFAULT_PYTHON_MEMORY_MB) -> Tuple[Dict, List[str]]:
+    """
+    A job for PythonSandbox.run, everything the code can see, as json
+    Returns the job and the names of variables that were left out because they can't be sent as json
+    """
+    variables, skipped = Get_Json_Variables(task_context.variable_stack)
+    job = {
+        "code": code,
+        "variables": variables,
+        "project": _get_plain_fields(task_context.project),
+        "task": _get_plain_fields(task_context.task),
+        "node": node_fields,
+        "memory_mb": memory_mb,
+    }
+    return job, skipped
+
+class SandboxResult:
+    """
+    What a job did, "variables" are the ones it set or changed, "output" is the node's output list if the code changed it
+    "error" is None when the code completed
+    """
+    def __init__(self):
+        self.variables: Dict[str, Any] = {}
+        self.removed_variables: List[str] = []
+        # set by the code but not json, they stay in the worker
+        self.unserializable_variables: List[str] = []
+        self.output: Optional[List[str]] = None
+        self.error: Optional[str] = None
+        self.timed_out: bool = False
+        # the whole round trip, and the time spent running the code in the worker
+        self.duration: float = 0.0
+        self.exec_time: float = 0.0
+        # the worker already had the code compiled, see CodeCache
+        self.compile_hit: bool = False
+
+    def succeeded(self) -> bool:
+        return self.error is None
+
+class _SandboxWorker:
+    def __init__(self):
+        self.process = subprocess.Popen([sys.executable, "-u", SANDBOX_WORKER_SCRIPT],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=None)
+        self.messages: "queue.Queue[Optional[Dict]]" = queue.Queue()
+        self.jobs = 0
+        self._reader = threading.Thread(target=self._read, name="PythonSandboxReader", daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        for line in self.process.stdout:
+            try:
+                self.messages.put(json.loads(line))
+            except ValueError:
+                continue
+        # the worker exited
+        self.messages.put(None)
+
+    def send(self, job: Dict):
+        self.process.stdin.write((json.dumps(job) + "\n").encode('utf-8'))
+        self.process.stdin.flush()
+        self.jobs += 1
+
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+        try:
+            self.process.wait(KILL_WAIT_SECONDS)
+        except subprocess.TimeoutExpired:
+            print(f"PythonSandbox worker {self.process.pid} did not exit")
+
+class PythonSandbox:
+    """
+    A pool of worker processes that run TaskNode_Python code, so a runaway node can't stall the app or other nodes
+    Workers are started ahead of time and reused, each runs one job at a time with its own stdout/stderr, so
+    python nodes can run in parallel. A job that goes over its timeout has its worker killed and replaced, the
+    memory limit is RLIMIT_AS in the worker (not available on windows).
+    Jobs cross to the worker as json, see Make_Sandbox_Job and PythonSandboxWorker.
+    run() blocks until the job completes, it can be called from any thread, "on_output" is called on that thread.
+    """
+    def __init__(self, max_workers: int = DEFAULT_SANDBOX_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self._idle: List[_SandboxWorker] = []
+        self._workers: Set[_SandboxWorker] = set()
+        self._busy = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.jobs = 0
+        self.timeouts = 0
+        self.workers_started = 0
+        ASYNC_RUNTIME.add_shutdown_hook(self.aclose)
+
+    def _start_worker(self) -> Optional[_SandboxWorker]:
+        try:
+            worker = _SandboxWorker()
+        except OSError as e:
+            print(f"Failed to start a PythonSandbox worker: {e}")
+            return None
+        with self._condition:
+            self._workers.add(worker)
+            self.workers_started += 1
+        return worker
+
+    def _kill_worker(self, worker: _SandboxWorker):
+        worker.kill()
+        with self._condition:
+            self._workers.discard(worker)
+
+    def start(self):
+        # prewarm, so the first python nodes don't wait for interpreters to start
+        with self._condition:
+            missing = self.max_workers - len(self._idle) - self._busy
+            self._closed = False
+        for _ in range(missing):
+            worker = self._start_worker()
+            if worker is None:
+                return
+            with self._condition:
+                self._idle.append(worker)
+                self._condition.notify()
+
+    def _acquire(self) -> Optional[_SandboxWorker]:
+        with self._condition:
+            while len(self._idle) == 0 and self._busy >= self.max_workers:
+                self._condition.wait()
+            self._busy += 1
+            while len(self._idle) > 0:
+                worker = self._idle.pop()
+                if worker.is_alive():
+                    return worker
+                self._workers.discard(worker)
+        worker = self._start_worker()
+        if worker is None:
+            self._release(None, False)
+        return worker
+
+    def _release(self, worker: Optional[_SandboxWorker], reuse: bool):
+        replacement = None
+        if worker is not None and not (reuse and worker.is_alive()):
+            self._kill_worker(worker)
+            # a replacement is started now rather than when the next job needs it
+            replacement = self._start_worker()
+        with self._condition:
+            self._busy -= 1
+            idle = worker if replacement is None else replacement
+            if idle is not None and idle.is_alive() and not self._closed:
+                self._idle.append(idle)
+            elif idle is not None:
+                self._workers.discard(idle)
+                idle.kill()
+            self._condition.notify()
+
+    def run(self, job: Dict, timeout: float = DEFAULT_PYTHON_TIMEOUT, on_output: Callable[[str, str], None] = None) -> SandboxResult:
+        """
+        Runs "job" in a worker and waits for it, no timeout if "timeout" is 0
+        "on_output" is called with ("stdout" or "stderr", text) as the code prints
+        """
+        result = SandboxResult()
+        worker = self._acquire()
+        if worker is None:
+            result.error = "No python sandbox worker could be started"
+            return result
+        with self._condition:
+            self.jobs += 1
+
+        start = time.monotonic()
+        deadline = start + timeout if timeout > 0 else None
+        reuse = False
+        try:
+            worker.send(job)
+            while True:
+                remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+                try:
+                    message = worker.messages.get(timeout=remaining)
+                except queue.Empty:
+                    result.timed_out = True
+                    result.error = f"Timed out after {timeout:.0f} seconds, the python process was stopped"
+                    with self._condition:
+                        self.timeouts += 1
+                    break
+                if message is None:
+                    try:
+                        exit_code = worker.process.wait(KILL_WAIT_SECONDS)
+                    except subprocess.TimeoutExpired:
+                        exit_code = None
+                    result.error = f"The python process exited unexpectedly (exit code {exit_code})"
+                    break
+                message_type = message.get("type")
+                if message_type in ("stdout", "stderr"):
+                    if on_output:
+                        on_output(message_type, message["text"])
+                elif message_type == "result":
+                    result.variables = message["variables"]
+                    result.removed_variables = message["removed_variables"]
+                    result.unserializable_variables = message["unserializable_variables"]
+                    result.output = message["output"]
+                    result.error = message["error"]
+                    result.compile_hit = message["compile_hit"]
+                    result.exec_time = message["exec_time"]
+                    reuse = not message["fatal"]
+                    break
+        except OSError as e:
+            result.error = f"Failed to send the job to the python process: {e}"
+        finally:
+            result.duration = time.monotonic() - start
+            self._release(worker, reuse)
+        return result
+
+    def shutdown(self):
+        # kills running jobs too, their run() calls return an error
+        with self._condition:
+            self._closed = True
+            workers = list(self._workers)
+            self._workers.clear()
+            self._idle = []
+        for worker in workers:
+            worker.kill()
+
+    async def aclose(self):
+        self.shutdown()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._condition:
+            return {"idle": len(self._idle), "busy": self._busy, "jobs": self.jobs, "timeouts": self.timeouts,
+                    "workers_started": self.workers_started}
+
+GLOBAL_PYTHON_SANDBOX = PythonSandbox()
@@ -0,0 +1,201 @@
+# The worker process for PythonSandbox, started as "python -u PythonSandboxWorker.py"
+# Only imports the standard library, so it starts quickly and doesn't pull in Qt.
+# Jobs come in on stdin and messages go out on stdout, one json object per line. stdout/stderr of the code being run
+# are sent back as "stdout"/"stderr" messages, anything written straight to the file descriptors (ie by a subprocess)
+# goes to the app's stderr.
+import io
+import json
+import os
+import sys
+import threading
+import time
+import traceback
+import types
+
+from CodeCache import GLOBAL_CODE_CACHE
+
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+# output is sent when a line completes or this many characters are buffered
+OUTPUT_CHUNK_SIZE = 4096
+
+class _Channel:
+    def __init__(self, file):
+        self._file = file
+        self._lock = threading.Lock()
+
+    def send(self, message: dict):
+        line = (json.dumps(message) + "\n").encode('utf-8')
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+class _OutputWriter(io.TextIOBase):
+    """
+    sys.stdout/sys.stderr while a job runs, forwards what is written as "stdout"/"stderr" messages
+    """
+    def __init__(self, channel: _Channel, kind: str):
+        super().__init__()
+        self._channel = channel
+        self._kind = kind
+        self._buffer = []
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        return 'utf-8'
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        with self._lock:
+            self._buffer.append(text)
+            self._size += len(text)
+            if '\n' not in text and self._size < OUTPUT_CHUNK_SIZE:
+                return len(text)
+        self.flush()
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            if self._size == 0:
+                return
+            text = "".join(self._buffer)
+            self._buffer = []
+            self._size = 0
+        self._channel.send({"type": self._kind, "text": text})
+
+class SandboxTaskContext:
+    """
+    What the code sees as "task_context", the variables plus plain copies of the project and task fields
+    """
+    def __init__(self, variables: dict, project: dict, task: dict):
+        self.variable_stack = variables
+        self.project = types.SimpleNamespace(**project)
+        self.task = types.SimpleNamespace(**task)
+
+    def set_variable(self, name: str, value):
+        self.variable_stack[name] = value
+
+    def get_variable(self, name: str):
+        if name in self.variable_stack:
+            return self.variable_stack[name]
+        raise KeyError(f"Variable '{name}' not found")
+
+def _set_memory_limit(memory_mb: int):
+    # returns the limit to restore, None if nothing was changed
+    if resource is None or memory_mb <= 0:
+        return None
+    previous = resource.getrlimit(resource.RLIMIT_AS)
+    limit = memory_mb * 1024 * 1024
+    if previous[1] != resource.RLIM_INFINITY:
+        limit = min(limit, previous[1])
+    try:
+        resource.setrlimit(resource.RLIMIT_AS, (limit, previous[1]))
+    except (ValueError, OSError):
+        return None
+    return previous
+
+def run_job(job: dict, channel: _Channel) -> bool:
+    # returns False if the worker should exit after the job, ie it ran out of memory
+    variables = job["variables"]
+    before = {name: json.dumps(value, sort_keys=True) for name, value in variables.items()}
+    task_context = SandboxTaskContext(variables, job["project"], job["task"])
+    node = types.SimpleNamespace(**job["node"])
+    output_before = list(getattr(node, "output", []))
+    namespace = GLOBAL_CODE_CACHE.make_namespace({"task_context": task_context, "self": node})
+
+    stdout = _OutputWriter(channel, "stdout")
+    stderr = _OutputWriter(channel, "stderr")
+    old_stdout, old_stderr = sys.stdout, sys.stderr
+    cwd = os.getcwd()
+    error = None
+    keep_worker = True
+    compile_hit = False
+    exec_time = 0.0
+    start = time.monotonic()
+    previous_limit = _set_memory_limit(job.get("memory_mb", 0))
+    sys.stdout, sys.stderr = stdout, stderr
+    try:
+        code, compile_hit = GLOBAL_CODE_CACHE.get(job["code"], f"<{job['node'].get('name', 'python')}>")
+        exec_start = time.perf_counter()
+        try:
+            exec(code, namespace, namespace)
+        finally:
+            exec_time = time.perf_counter() - exec_start
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error = f"SystemExit: {e.code}"
+    except MemoryError:
+        error = f"MemoryError: the code went over the {job.get('memory_mb', 0)}MB limit"
+        keep_worker = False
+    except BaseException:
+        error = traceback.format_exc()
+    finally:
+        sys.stdout, sys.stderr = old_stdout, old_stderr
+        if previous_limit is not None:
+            resource.setrlimit(resource.RLIMIT_AS, previous_limit)
+        stdout.flush()
+        stderr.flush()
+        try:
+            os.chdir(cwd)
+        except OSError:
+            pass
+
+    changed = {}
+    unserializable = []
+    for name, value in task_context.variable_stack.items():
+        try:
+            encoded = json.dumps(value, sort_keys=True)
+        except (TypeError, ValueError):
+            unserializable.append(name)
+            continue
+        if before.get(name) != encoded:
+            changed[name] = value
+    removed = [name for name in before if name not in task_context.variable_stack]
+
+    output = getattr(node, "output", output_before)
+    if not isinstance(output, list) or output == output_before:
+        output = None
+    else:
+        output = [str(item) for item in output]
+
+    channel.send({
+        "type": "result",
+        "variables": changed,
+        "removed_variables": removed,
+        "unserializable_variables": unserializable,
+        "output": output,
+        "error": error,
+        "duration": time.monotonic() - start,
+        "compile_hit": compile_hit,
+        "exec_time": exec_time,
+        "fatal": not keep_worker,
+    })
+    return keep_worker
+
+def main():
+    # keep the protocol pipes to ourselves, code that prints to fd 1 or reads stdin can't corrupt them
+    channel = _Channel(os.fdopen(os.dup(1), 'wb'))
+    jobs = os.fdopen(os.dup(0), 'rb')
+    os.dup2(2, 1)
+    devnull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devnull, 0)
+    os.close(devnull)
+    sys.stdin = open(os.devnull, 'r')
+
+    GLOBAL_CODE_CACHE.preimport()
+    channel.send({"type": "ready", "pid": os.getpid()})
+    for line in jobs:
+        if not line.strip():
+            continue
+        if not run_job(json.loads(line), channel):
+            break
+
+if __name__ == "__main__":
+    main()
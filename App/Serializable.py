@@ -1,11 +1,17 @@
 import importlib
 import json
-from typing import Any, Dict, Type, TypeVar, List
+from enum import Enum
+from typing import Any, Callable, Dict, FrozenSet, Type, TypeVar, List
 from pxr import Usd, Sdf
 import datetime
 
 T = TypeVar('T', bound='ISerializable')
 
+# datetimes and enums that aren't a field's own value (ie in a list or dict) are written as {DATETIME_TAG: iso string}
+# and {ENUM_TAG: "module.Class", "value": value}, fields get their type from the class schema
+DATETIME_TAG = '__datetime__'
+ENUM_TAG = '__enum__'
+
 class SerializationError(Exception):
     """Custom exception for serialization errors"""
     pass
@@ -43,30 +49,34 @@ class ISerializable:
         pass
 
     def to_dict(self) -> Dict[str, Any]:
+        schema = Get_Class_Schema(self.__class__)
         data = {
             key: self._serialize_value(value) for key, value in self.__dict__.items()
-            if not key.startswith('_') and key not in self._exclude_from_json
+            if key[0] != '_' and key not in schema.excluded
         }
-        data['__type__'] = f"{self.__class__.__module__}.{self.__class__.__name__}"
+        data['__type__'] = schema.type_name
         return data
 
     @classmethod
     def from_dict(cls: Type[T], data: Dict[str, Any]) -> T:
+        class_type = cls
         if '__type__' in data:
             class_type = cls._get_class(data['__type__'])
-            if not issubclass(class_type, cls):
+            if class_type is not cls and not issubclass(class_type, cls):
                 raise TypeError(f"Class {data['__type__']} is not a subclass of {cls.__name__}")
-            instance = class_type()
-        else:
-            instance = cls()
-        
-        for name, value in data.items():
-            if name != '__type__' and not name.startswith('_') and name not in cls._exclude_from_json:
-                setattr(instance, name, cls._deserialize_value(value))
+        instance = class_type()
+        instance.update_from_dict(data)
+        return instance
 
-        instance.post_deserialize()
+    def update_from_dict(self, data: Dict[str, Any]):
+        # sets the fields in "data" on an existing instance, fields the class doesn't have (anymore) are skipped
+        decoders = Get_Class_Schema(self.__class__).get_decoders()
+        for name, value in data.items():
+            decoder = decoders.get(name)
+            if decoder is not None:
+                setattr(self, name, decoder(value))
 
-        return instance
+        self.post_deserialize()
 
     def to_json(self) -> str:
         return json.dumps(self.to_dict(), default=self._json_default)
@@ -124,29 +134,45 @@ class ISerializable:
 
     @staticmethod
     def _serialize_value(value: Any) -> Any:
+        # a field's value, its schema knows if it is a datetime or an enum
         if isinstance(value, ISerializable):
             return value.to_dict()
         elif isinstance(value, list):
-            return [ISerializable._serialize_value(item) for item in value]
+            return [ISerializable._serialize_item(item) for item in value]
         elif isinstance(value, datetime.datetime):
             return value.isoformat()
         return value
 
+    @staticmethod
+    def _serialize_item(value: Any) -> Any:
+        # a value inside a list, datetimes and enums are tagged
+        if isinstance(value, ISerializable):
+            return value.to_dict()
+        elif isinstance(value, list):
+            return [ISerializable._serialize_item(item) for item in value]
+        elif isinstance(value, datetime.datetime):
+            return {DATETIME_TAG: value.isoformat()}
+        elif isinstance(value, Enum):
+            return {ENUM_TAG: f"{value.__class__.__module__}.{value.__class__.__name__}", "value": value.value}
+        return value
+
     @staticmethod
     def _deserialize_value(value: Any) -> Any:
-        if isinstance(value, dict) and '__type__' in value:
-            class_type = ISerializable._get_class(value['__type__'])
-            if issubclass(class_type, ISerializable):
-                return class_type.from_dict(value)
+        # strings are left as they are, only "__type__" and the tags are decoded
+        if isinstance(value, dict):
+            if '__type__' in value:
+                class_type = ISerializable._get_class(value['__type__'])
+                if issubclass(class_type, ISerializable):
+                    return class_type.from_dict(value)
+            elif DATETIME_TAG in value:
+                return datetime.datetime.fromisoformat(value[DATETIME_TAG])
+            elif ENUM_TAG in value:
+                return _decode_enum(ISerializable._get_class(value[ENUM_TAG]), value["value"])
+            else:
+                # a plain dict (ie SessionEntry.metadata), its values can hold tags and objects too
+                return {key: ISerializable._deserialize_value(item) for key, item in value.items()}
         elif isinstance(value, list):
             return [ISerializable._deserialize_value(item) for item in value]
-        elif isinstance(value, str):
-            # TODO: There has to be a better way to do this
-            # Check if this is an ISO formatted datetime string
-            try:
-                return datetime.datetime.fromisoformat(value)
-            except ValueError:
-                return value
         return value
 
     @staticmethod
@@ -154,7 +180,7 @@ class ISerializable:
         if isinstance(obj, ISerializable):
             return obj.to_dict()
         elif isinstance(obj, datetime.datetime):
-            return obj.isoformat()
+            return {DATETIME_TAG: obj.isoformat()}
         raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
     def _set_usd_attribute(self, prim: Usd.Prim, name: str, value: Any):
@@ -221,4 +247,70 @@ class ISerializable:
                 return datetime.datetime.fromisoformat(value)
             except ValueError:
                 return value
-        return value
\ No newline at end of file
+        return value
+
+
+def _decode_datetime(value: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return datetime.datetime.fromisoformat(value)
+        except ValueError:
+            return value
+    return ISerializable._deserialize_value(value)
+
+def _decode_enum(enum_type: Type[Enum], value: Any) -> Any:
+    try:
+        return enum_type(value)
+    except ValueError:
+        # a member that was removed, or an IntEnum saved as a string
+        try:
+            return enum_type(int(value))
+        except (ValueError, TypeError):
+            return value
+
+def _decode_scalar(value: Any) -> Any:
+    if value.__class__ in (str, int, float, bool):
+        return value
+    return ISerializable._deserialize_value(value)
+
+def _make_decoder(default: Any) -> Callable[[Any], Any]:
+    # picks how a field is decoded from the value it has in a default instance
+    if isinstance(default, datetime.datetime):
+        return _decode_datetime
+    if isinstance(default, Enum):
+        enum_type = default.__class__
+        return lambda value: value if value.__class__ is enum_type else _decode_enum(enum_type, value)
+    if default.__class__ in (str, int, float, bool):
+        return _decode_scalar
+    return ISerializable._deserialize_value
+
+class ClassSchema:
+    """
+    The json fields of an ISerializable class and how each one is decoded, built once per class, see Get_Class_Schema
+    The decoders come from a default instance (cls()), the same one from_dict starts from, so datetime and enum fields
+    are decoded as such without looking at the strings, and fields the class doesn't have are skipped.
+    """
+    def __init__(self, class_type: Type[ISerializable]):
+        self.class_type = class_type
+        self.type_name = f"{class_type.__module__}.{class_type.__name__}"
+        self.excluded: FrozenSet[str] = frozenset(class_type._exclude_from_json)
+        self._decoders: Dict[str, Callable[[Any], Any]] = None
+
+    def get_decoders(self) -> Dict[str, Callable[[Any], Any]]:
+        # only classes that are loaded need a default instance
+        if self._decoders is None:
+            default = self.class_type()
+            self._decoders = {
+                name: _make_decoder(value) for name, value in vars(default).items()
+                if name[0] != '_' and name not in self.excluded
+            }
+        return self._decoders
+
+_class_schemas: Dict[type, ClassSchema] = {}
+
+def Get_Class_Schema(class_type: Type[ISerializable]) -> ClassSchema:
+    schema = _class_schemas.get(class_type)
+    if schema is None:
+        schema = ClassSchema(class_type)
+        _class_schemas[class_type] = schema
+    return schema
@@ -0,0 +1,128 @@
+from typing import Callable, Dict, List, Optional, Tuple
+
+from TypeDefs import SessionEntry, ResponseEntryType
+
+# both apis need the conversation to start and end on a user turn, these fill the gap when the session doesn't
+SESSION_START_PROMPT = "Follow the instructions in the system prompt."
+SESSION_CONTINUE_PROMPT = "Continue."
+
+def Get_Entry_Response_Text(entry: SessionEntry) -> str:
+    # files are shown to the model the way it wrote them
+    if entry.entry_type == ResponseEntryType.FILE and entry.metadata:
+        embedded_type = entry.metadata.get("type", "file")
+        filename = entry.metadata.get("filename", "")
+        opening = f"<{embedded_type}>" if embedded_type == "task_graph" else f"<{embedded_type} {filename}>"
+        return f"{opening}{entry.content}</{embedded_type}>"
+    return entry.content
+
+def Append_Message(messages: List[Dict], role: str, content: str):
+    # consecutive entries from the same side are one turn, kept as separate parts so earlier parts never change
+    if len(messages) > 0 and messages[-1]["role"] == role:
+        messages[-1]["content"].append(content)
+    else:
+        messages.append({"role": role, "content": [content]})
+
+class _EntryRecord:
+    def __init__(self, entry: SessionEntry, checkpoint: Tuple[int, int, int]):
+        self.entry = entry
+        # (system blocks, messages, parts in the last message) before this entry was added, used to roll back
+        self.checkpoint = checkpoint
+        self.included = False
+
+class SessionContextBuilder:
+    """
+    Keeps the system blocks and user/assistant messages for a session up to date as entries are added,
+    instead of walking the whole session on every request.
+    Each entry is filtered and rendered once. sync() only looks at entries added since the last call, plus any
+    entry reported with mark_dirty() (ie a response that was still streaming), which rolls the messages back to
+    just before that entry and replays from there. invalidate() forces a full rebuild, ie when the filter
+    changes because the Task moved to another phase.
+    """
+    def __init__(self):
+        self.system_blocks: List[str] = []
+        self.messages: List[Dict] = []
+        self._records: List[_EntryRecord] = []
+        self._index: Dict[int, int] = {} # id(entry) -> record index
+        self._session: Optional[List[SessionEntry]] = None
+        self._dirty_from: Optional[int] = None
+        self.filter_calls = 0
+
+    def invalidate(self):
+        self._dirty_from = 0
+
+    def mark_dirty(self, entry: SessionEntry):
+        index = self._index.get(id(entry))
+        if index is not None and (self._dirty_from is None or index < self._dirty_from):
+            self._dirty_from = index
+
+    def sync(self, session: List[SessionEntry], filter_callback: Optional[Callable[[SessionEntry], bool]] = None):
+        if session is not self._session:
+            self._session = session
+            self._dirty_from = 0
+        elif len(session) < len(self._records):
+            # entries removed, cheap when it was the tail (ie an empty response entry), otherwise rebuild
+            keep = len(session)
+            if keep > 0 and session[keep-1] is not self._records[keep-1].entry:
+                keep = 0
+            if self._dirty_from is None or keep < self._dirty_from:
+                self._dirty_from = keep
+        elif len(self._records) > 0 and session[len(self._records)-1] is not self._records[-1].entry:
+            self._dirty_from = 0
+
+        if self._dirty_from is not None:
+            self._truncate(self._dirty_from)
+            self._dirty_from = None
+
+        for entry in session[len(self._records):]:
+            self._add_entry(entry, filter_callback)
+
+    def _truncate(self, index: int):
+        if index >= len(self._records):
+            return
+        num_system, num_messages, num_parts = self._records[index].checkpoint
+        del self.system_blocks[num_system:]
+        del self.messages[num_messages:]
+        if num_messages > 0:
+            del self.messages[-1]["content"][num_parts:]
+        for record in self._records[index:]:
+            self._index.pop(id(record.entry), None)
+        del self._records[index:]
+
+    def _add_entry(self, entry: SessionEntry, filter_callback: Optional[Callable[[SessionEntry], bool]]):
+        num_parts = len(self.messages[-1]["content"]) if len(self.messages) > 0 else 0
+        record = _EntryRecord(entry, (len(self.system_blocks), len(self.messages), num_parts))
+        self._index[id(entry)] = len(self._records)
+        self._records.append(record)
+
+        if not entry.include_in_context:
+            return
+        if filter_callback:
+            self.filter_calls += 1
+            if filter_callback(entry):
+                return
+        if len(entry.content) == 0 or entry.content.isspace():
+            return
+        record.included = True
+
+        if entry.entry_type == ResponseEntryType.INSTRUCTION:
+            if len(self.messages) == 0:
+                self.system_blocks.append(entry.content)
+            else:
+                Append_Message(self.messages, "user", entry.content)
+        elif entry.sender == "System":
+            if len(self.messages) == 0:
+                # the turn that produced this response was SESSION_START_PROMPT
+                Append_Message(self.messages, "user", SESSION_START_PROMPT)
+            Append_Message(self.messages, "assistant", Get_Entry_Response_Text(entry))
+        else:
+            Append_Message(self.messages, "user", entry.content)
+
+    def get_messages(self) -> List[Dict]:
+        # a copy that can be appended to without touching the cached messages, parts are shared
+        messages = list(self.messages)
+        if len(messages) > 0:
+            messages[-1] = {"role": messages[-1]["role"], "content": list(messages[-1]["content"])}
+        return messages
+
+    def get_included_entries(self) -> List[SessionEntry]:
+        return [record.entry for record in self._records if record.included]
@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+import time
+from typing import Callable, Dict, List
+
+from Serializable import ISerializable
+from TypeDefs import SessionEntry
+
+# streamed text is written once this much is pending for an entry, a crash loses at most this much of a response
+JOURNAL_CHUNK_CHARS = 4096
+# a journal this large, or this old, is merged into the project file in the background
+JOURNAL_COMPACT_BYTES = 1024 * 1024
+JOURNAL_COMPACT_SECONDS = 120.0
+
+def Get_Journal_Folder(project_file_name: str) -> str:
+    return f"{project_file_name}.journal"
+
+class SessionJournal:
+    """
+    An append only log of a task session, one json object per line, so a crash doesn't lose what wasn't saved
+    "entry" records are new SessionEntries, "append" records are streamed text with the offset it goes at in the
+    entry's content, "remove" records are entries that were taken out again and "clear" empties the session.
+    Writes cost the size of the new data, not of the session.
+    replay() applies the log to a session loaded from the project file, records that are already in it are skipped,
+    so the log doesn't have to be cut at exactly the point the project was saved.
+    "on_grow" is called with the journal after it is written to, see SessionJournalCompactor.
+    Writes can come from any thread.
+    """
+    def __init__(self, file_name: str, on_grow: Callable[['SessionJournal'], None] = None):
+        self.file_name = file_name
+        self._on_grow = on_grow
+        self._file = None
+        self._lock = threading.Lock()
+        # entry_id -> [offset of the first pending character, pending text chunks, pending length]
+        self._pending: Dict[str, list] = {}
+        self._size = os.path.getsize(file_name) if os.path.exists(file_name) else 0
+        self.created = time.monotonic()
+
+    def _write(self, record: Dict):
+        # must hold _lock
+        if self._file is None:
+            os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+            self._file = open(self.file_name, 'ab')
+        line = (json.dumps(record, default=ISerializable._json_default) + "\n").encode('utf-8')
+        self._file.write(line)
+        self._file.flush()
+        self._size += len(line)
+
+    def _grew(self):
+        if self._on_grow is not None:
+            self._on_grow(self)
+
+    def add_entry(self, entry: SessionEntry):
+        with self._lock:
+            self._write({"op": "entry", "entry": entry.to_dict()})
+        self._grew()
+
+    def append(self, entry: SessionEntry, offset: int, text: str):
+        # "text" goes at "offset" in the entry's content
+        with self._lock:
+            pending = self._pending.get(entry.entry_id)
+            if pending is None:
+                pending = [offset, [], 0]
+                self._pending[entry.entry_id] = pending
+            pending[1].append(text)
+            pending[2] += len(text)
+            if pending[2] < JOURNAL_CHUNK_CHARS:
+                return
+            self._write_pending(entry.entry_id)
+        self._grew()
+
+    def _write_pending(self, entry_id: str):
+        # must hold _lock
+        pending = self._pending.pop(entry_id, None)
+        if pending is not None and pending[2] > 0:
+            self._write({"op": "append", "id": entry_id, "offset": pending[0], "text": "".join(pending[1])})
+
+    def finish_entry(self, entry: SessionEntry):
+        # the entry is complete, write what is pending
+        with self._lock:
+            self._write_pending(entry.entry_id)
+        self._grew()
+
+    def remove_entry(self, entry: SessionEntry):
+        with self._lock:
+            self._pending.pop(entry.entry_id, None)
+            self._write({"op": "remove", "id": entry.entry_id})
+        self._grew()
+
+    def clear(self):
+        with self._lock:
+            self._pending.clear()
+            self._write({"op": "clear"})
+        self._grew()
+
+    def get_size(self) -> int:
+        return self._size
+
+    def truncate(self, size: int):
+        # drops the first "size" bytes, they were merged into the project file, anything written since is kept
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            if not os.path.exists(self.file_name):
+                self._size = 0
+                return
+            with open(self.file_name, 'rb') as f:
+                f.seek(size)
+                remaining = f.read()
+            if len(remaining) == 0:
+                os.remove(self.file_name)
+            else:
+                temp_file_name = f"{self.file_name}.tmp"
+                with open(temp_file_name, 'wb') as f:
+                    f.write(remaining)
+                os.replace(temp_file_name, self.file_name)
+            self._size = len(remaining)
+            self.created = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            for entry_id in list(self._pending.keys()):
+                self._write_pending(entry_id)
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def delete(self):
+        self.close()
+        with self._lock:
+            if os.path.exists(self.file_name):
+                os.remove(self.file_name)
+            self._size = 0
+
+    def replay(self, session: List[SessionEntry]) -> int:
+        # applies the log to "session", returns the number of records that changed it
+        if not os.path.exists(self.file_name):
+            return 0
+        entries = {entry.entry_id: entry for entry in session}
+        applied = 0
+        with open(self.file_name, 'rb') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # the last line of a crashed write
+                    continue
+                op = record.get("op")
+                if op == "entry":
+                    entry = SessionEntry.from_dict(record["entry"])
+                    if entry.entry_id not in entries:
+                        session.append(entry)
+                        entries[entry.entry_id] = entry
+                        applied += 1
+                elif op == "append":
+                    entry = entries.get(record["id"])
+                    if entry is None:
+                        continue
+                    offset, text = record["offset"], record["text"]
+                    content_length = len(entry.content)
+                    if offset + len(text) <= content_length:
+                        continue
+                    if offset > content_length:
+                        print(f"SessionJournal {self.file_name}: text missing before offset {offset} of entry {entry.entry_id}")
+                        continue
+                    entry.content += text[content_length - offset:]
+                    applied += 1
+                elif op == "remove":
+                    entry = entries.pop(record["id"], None)
+                    if entry is not None and entry in session:
+                        session.remove(entry)
+                        applied += 1
+                elif op == "clear":
+                    if len(session) > 0:
+                        session.clear()
+                        entries.clear()
+                        applied += 1
+        return applied
+
+class SessionJournalCompactor:
+    """
+    Merges journals into their project file in the background, by saving the project, when one gets large or old
+    A project is only saved by one compaction at a time, one asked for while it runs is run after it, see
+    Project.save_to_file for how the journals are cut.
+    """
+    def __init__(self, max_bytes: int = JOURNAL_COMPACT_BYTES, max_seconds: float = JOURNAL_COMPACT_SECONDS):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._running = set()
+        # projects that grew past the limits again while being compacted
+        self._rerun = set()
+        self._lock = threading.Lock()
+        self.compactions = 0
+
+    def needs_compaction(self, journal: SessionJournal) -> bool:
+        size = journal.get_size()
+        return size >= self.max_bytes or (size > 0 and time.monotonic() - journal.created >= self.max_seconds)
+
+    def schedule(self, project):
+        from AsyncRuntime import ASYNC_RUNTIME
+        with self._lock:
+            if not project.file_name:
+                return
+            if id(project) in self._running:
+                self._rerun.add(id(project))
+                return
+            self._running.add(id(project))
+
+        async def compact():
+            import asyncio
+            try:
+                await asyncio.to_thread(project.save_to_file, project.file_name)
+                with self._lock:
+                    self.compactions += 1
+            except Exception as e:
+                print(f"Failed to merge the session journals into {project.file_name}: {e}")
+            finally:
+                with self._lock:
+                    self._running.discard(id(project))
+                    rerun = id(project) in self._rerun
+                    self._rerun.discard(id(project))
+                if rerun:
+                    self.schedule(project)
+
+        ASYNC_RUNTIME.submit(compact())
+
+GLOBAL_JOURNAL_COMPACTOR = SessionJournalCompactor()
@@ -0,0 +1,137 @@
+from enum import Enum
+from typing import List, NamedTuple, Optional
+
+class MarkupEventType(str,Enum):
+    CHAT = 1
+    FILE_START = 2
+    FILE_DATA = 3
+    FILE_END = 4
+
+class MarkupEvent(NamedTuple):
+    event_type: MarkupEventType
+    # chat text, file data, or the full opening tag for FILE_START
+    text: str = ""
+    embedded_type: Optional[str] = None
+
+class StreamMarkupParser:
+    """
+    Incremental parser for LLM responses with embedded blocks, ie
+        some chat text
+        <file app/main.py>
+        ...file contents...
+        </file>
+        more chat text
+    feed() takes the newly arrived text and returns the events it completes. Only the new text is scanned,
+    the only state carried between calls is a partial opening tag (bounded by MAX_TAG_LENGTH) or the last few
+    characters that could be the start of a closing tag, so the cost is linear in the size of the response.
+    An opening tag is only recognised once its closing ">\\n" arrives, anything that can't be one of the
+    embedded tags (or isn't closed on the same line) is passed through as chat text.
+    """
+    MAX_TAG_LENGTH = 1024
+
+    _CHAT = 0
+    _TAG = 1
+    _EMBEDDED = 2
+
+    def __init__(self, embedded_types: List[str]):
+        self._embedded_types = list(embedded_types)
+        self.reset()
+
+    def reset(self):
+        self._state = self._CHAT
+        self._tag = ""
+        self._embedded_type: Optional[str] = None
+        self._end_tag = ""
+        self._carry = ""
+
+    def feed(self, text: str) -> List[MarkupEvent]:
+        events: List[MarkupEvent] = []
+        data = text
+        pos = 0
+        while pos < len(data):
+            if self._state == self._CHAT:
+                split_index = data.find('<', pos)
+                if split_index == -1:
+                    events.append(MarkupEvent(MarkupEventType.CHAT, data[pos:]))
+                    pos = len(data)
+                else:
+                    if split_index > pos:
+                        events.append(MarkupEvent(MarkupEventType.CHAT, data[pos:split_index]))
+                    self._state = self._TAG
+                    self._tag = ""
+                    pos = split_index
+
+            elif self._state == self._TAG:
+                # a tag can't span lines, so the first new line decides whether this is an opening tag
+                scan_from = len(self._tag)
+                consumed = min(len(data) - pos, self.MAX_TAG_LENGTH - len(self._tag))
+                self._tag += data[pos:pos + consumed]
+                newline_index = self._tag.find('\n', scan_from)
+                if newline_index != -1 and self._tag[newline_index-1] == '>' and self._could_be_embedded_tag(self._tag[:newline_index]):
+                    markup = self._tag[:newline_index]
+                    # push back everything after the tag, including the new line
+                    data, pos = self._tag[newline_index:] + data[pos + consumed:], 0
+                    self._tag = ""
+                    embedded_type = self._get_embedded_type(markup)
+                    events.append(MarkupEvent(MarkupEventType.FILE_START, markup, embedded_type))
+                    self._state = self._EMBEDDED
+                    self._embedded_type = embedded_type
+                    self._end_tag = f"</{embedded_type}>"
+                    self._carry = ""
+                elif newline_index != -1 or not self._could_be_embedded_tag(self._tag) or len(self._tag) >= self.MAX_TAG_LENGTH:
+                    # not one of ours, the '<' is plain chat text, rescan what followed it
+                    events.append(MarkupEvent(MarkupEventType.CHAT, '<'))
+                    data, pos = self._tag[1:] + data[pos + consumed:], 0
+                    self._tag = ""
+                    self._state = self._CHAT
+                else:
+                    pos += consumed
+
+            elif self._state == self._EMBEDDED:
+                segment = self._carry + data[pos:]
+                pos = len(data)
+                split_index = segment.find(self._end_tag)
+                if split_index != -1:
+                    if split_index > 0:
+                        events.append(MarkupEvent(MarkupEventType.FILE_DATA, segment[:split_index], self._embedded_type))
+                    events.append(MarkupEvent(MarkupEventType.FILE_END, "", self._embedded_type))
+                    data, pos = segment[split_index + len(self._end_tag):], 0
+                    self._state = self._CHAT
+                    self._embedded_type = None
+                    self._carry = ""
+                else:
+                    # hold back just enough characters to catch a closing tag split across chunks
+                    keep = len(self._end_tag) - 1
+                    if len(segment) > keep:
+                        events.append(MarkupEvent(MarkupEventType.FILE_DATA, segment[:-keep], self._embedded_type))
+                        self._carry = segment[-keep:]
+                    else:
+                        self._carry = segment
+        return events
+
+    def close(self) -> List[MarkupEvent]:
+        # flush whatever is held back at the end of the stream, an unterminated block is left open
+        events: List[MarkupEvent] = []
+        if self._state == self._TAG and self._tag:
+            events.append(MarkupEvent(MarkupEventType.CHAT, self._tag))
+        elif self._state == self._EMBEDDED and self._carry:
+            events.append(MarkupEvent(MarkupEventType.FILE_DATA, self._carry, self._embedded_type))
+        self.reset()
+        return events
+
+    def _get_embedded_type(self, markup: str) -> Optional[str]:
+        for embedded_type in self._embedded_types:
+            opening = f"<{embedded_type}"
+            if markup.startswith(opening) and markup[len(opening)] in " \t>":
+                return embedded_type
+        return None
+
+    def _could_be_embedded_tag(self, tag: str) -> bool:
+        for embedded_type in self._embedded_types:
+            opening = f"<{embedded_type}"
+            if len(tag) <= len(opening):
+                if opening.startswith(tag):
+                    return True
+            elif tag.startswith(opening) and tag[len(opening)] in " \t>":
+                return True
+        return False
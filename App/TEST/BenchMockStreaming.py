@@ -0,0 +1,64 @@
+# run from the App directory: python TEST/BenchMockStreaming.py
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from AsyncRuntime import ASYNC_RUNTIME
+from MockLLMServer import MockLLMServer
+from StreamMarkupParser import StreamMarkupParser
+from TaskNode_LLM import TaskNode_LLM, LLM_Model
+
+FILE_LINES = 2000
+CONCURRENT_REQUESTS = 20
+
+def make_large_response(lines: int) -> str:
+    body = "\n".join(f"    value_{i} = compute({i}) # some generated code" for i in range(lines))
+    return f"Here is the file\n<file app/generated.py>\ndef generated():\n{body}\n</file>\nPHASE_COMPLETE"
+
+def bench_parser(text: str, chunk_size: int = 4):
+    parser = StreamMarkupParser(TaskNode_LLM._supported_embedded_types)
+    chunks = [text[i:i+chunk_size] for i in range(0, len(text), chunk_size)]
+    start = time.perf_counter()
+    event_count = 0
+    for chunk in chunks:
+        event_count += len(parser.feed(chunk))
+    event_count += len(parser.close())
+    elapsed = time.perf_counter() - start
+    print(f"parser: {len(text)/1e6:.2f} MB in {len(chunks)} chunks, {event_count} events, {elapsed*1000:.1f} ms, {len(text)/1e6/elapsed:.1f} MB/s")
+
+async def bench_end_to_end(text: str, model: LLM_Model):
+    server = MockLLMServer(time_to_first_token=0.05, tokens_per_second=100000)
+    server.add_scripted_response(text)
+    await server.start()
+    try:
+        nodes = []
+        for i in range(CONCURRENT_REQUESTS):
+            node = TaskNode_LLM()
+            node.name = f"bench_{i}"
+            node.llm_model = model
+            node.llm_base_url_override = server.base_url
+            node.use_response_cache = False
+            node.prompt = f"benchmark request {i}"
+            node._compose_final_prompt()
+            nodes.append(node)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[node._async_execute() for node in nodes])
+        elapsed = time.perf_counter() - start
+        total = sum(len(node._full_response) for node in nodes)
+        print(f"{model.name}: {CONCURRENT_REQUESTS} concurrent requests, {total/1e6:.2f} MB streamed in {elapsed:.2f} s")
+    finally:
+        await server.stop()
+
+def main():
+    text = make_large_response(FILE_LINES)
+    bench_parser(text)
+    for model in (LLM_Model.Chat_GPT_4_o, LLM_Model.Claude3_5_Sonnet):
+        ASYNC_RUNTIME.run(bench_end_to_end(text, model))
+    ASYNC_RUNTIME.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# run from the App directory: python TEST/TestGraphScheduler.py
+import asyncio
+import os
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from AsyncRuntime import ASYNC_RUNTIME
+from Task import Task
+from TaskNode import TaskNode, TaskNode_Container
+from TaskGraphScheduler import TaskGraphScheduler
+from TypeDefs import TaskContext, TaskNodeState
+
+NODE_COUNT = 10
+NODE_SECONDS = 0.2
+
+class SleepNode(TaskNode):
+    # stands in for an llm node generating a file
+    def __init__(self):
+        super().__init__()
+        self._log = []
+
+    def execute(self, task_context : TaskContext):
+        pass
+
+    async def execute_async(self, task_context : TaskContext):
+        self.set_state(TaskNodeState.Executing)
+        self._log.append(("start", self.name, time.monotonic()))
+        await asyncio.sleep(NODE_SECONDS)
+        for output in self.output:
+            task_context.variable_stack[output] = f"{self.name}{self.description} {[task_context.variable_stack.get(input) for input in self.inputs]}"
+        self._log.append(("end", self.name, time.monotonic()))
+        self.set_state(TaskNodeState.Complete)
+
+def make_task(node_specs, log):
+    task = Task("graph scheduler test")
+    root = TaskNode_Container()
+    root.name = "root"
+    for name, inputs, output in node_specs:
+        node = SleepNode()
+        node.name = name
+        node.inputs = inputs
+        node.output = output
+        node._log = log
+        root.add_child(node)
+    task.task_graph_root = root
+    task.graph_workers = NODE_COUNT
+    return task
+
+def test_independent_nodes():
+    log = []
+    task = make_task([(f"file_{i}", [], [f"file_{i}"]) for i in range(NODE_COUNT)], log)
+    start = time.monotonic()
+    ASYNC_RUNTIME.run(task.play_taskgraph_async())
+    elapsed = time.monotonic() - start
+    assert all(node.state == TaskNodeState.Complete for node in task.task_graph_root.children)
+    assert elapsed < NODE_SECONDS * 3, elapsed
+    print(f"{NODE_COUNT} independent nodes: {elapsed:.2f}s (sequential would be {NODE_COUNT * NODE_SECONDS:.2f}s)")
+
+def test_dependencies():
+    log = []
+    task = make_task([("a", [], ["x"]), ("b", [], ["y"]), ("c", ["x", "y"], ["z"]), ("d", ["node_output://a"], [])], log)
+    scheduler = TaskGraphScheduler(task)
+    nodes = {graph_node.node.name: graph_node for graph_node in scheduler.build()}
+    assert {dependency.node.name for dependency in nodes["c"].dependencies} == {"root", "a", "b"}
+    assert {dependency.node.name for dependency in nodes["d"].dependencies} == {"root", "a"}
+
+    ASYNC_RUNTIME.run(task.play_taskgraph_async())
+    times = {(kind, name): stamp for kind, name, stamp in log}
+    assert times[("start", "c")] >= max(times[("end", "a")], times[("end", "b")])
+    assert times[("start", "d")] >= times[("end", "a")]
+    assert task.task_context.variable_stack["z"] == "c ['a []', 'b []']", task.task_context.variable_stack
+    print("dependencies ok")
+
+def test_memoization():
+    log = []
+    task = make_task([("a", [], ["x"]), ("b", [], ["y"]), ("c", ["x", "y"], ["z"]), ("d", ["x"], ["w"])], log)
+    ASYNC_RUNTIME.run(task.play_taskgraph_async())
+
+    # only b and what reads it run again
+    log.clear()
+    task.task_graph_root.children[1].description = " edited"
+    task.rewind_taskgraph()
+    ASYNC_RUNTIME.run(task.play_taskgraph_async())
+    started = sorted(name for kind, name, _ in log if kind == "start")
+    assert started == ["b", "c"], started
+    assert all(node.state == TaskNodeState.Complete for node in task.task_graph_root.children)
+    assert task.task_context.variable_stack["w"] == "d ['a []']", task.task_context.variable_stack
+    assert task.task_context.variable_stack["z"] == "c ['a []', 'b edited []']", task.task_context.variable_stack
+    print(f"memoization ok, {task.node_results.get_stats()}")
+
+def main():
+    test_independent_nodes()
+    test_dependencies()
+    test_memoization()
+    ASYNC_RUNTIME.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+# run from the App directory: python TEST/TestMockBatch.py
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from AsyncRuntime import ASYNC_RUNTIME
+from LLMBatchRunner import LLMBatchRunner
+from MockLLMServer import MockLLMServer
+from TaskNode_LLM import TaskNode_LLM, LLM_Model
+
+NODE_COUNT = 10
+
+async def run_batch(model: LLM_Model):
+    server = MockLLMServer(batch_delay=0.5)
+    for i in range(NODE_COUNT):
+        server.add_scripted_response(f"Here is file {i}\n<file gen/file_{i}.py>\nvalue = {i}\n</file>\n", match=f"generate file {i}$")
+    await server.start()
+    try:
+        nodes = []
+        for i in range(NODE_COUNT):
+            node = TaskNode_LLM()
+            node.name = f"batch_{i}"
+            node.llm_model = model
+            node.llm_base_url_override = server.base_url
+            node.prompt = f"generate file {i}"
+            node._compose_final_prompt()
+            nodes.append(node)
+
+        results = await LLMBatchRunner(poll_interval=0.2).run(nodes)
+        for i, result in enumerate(results):
+            assert "error" not in result, result
+            assert f"<file gen/file_{i}.py>" in result["text"], result["text"]
+            assert result["usage"], result
+        print(f"{model.name}: {len(results)} batch results ok")
+    finally:
+        await server.stop()
+
+def main():
+    for model in (LLM_Model.Chat_GPT_4_o, LLM_Model.Claude3_5_Sonnet):
+        ASYNC_RUNTIME.run(run_batch(model))
+    ASYNC_RUNTIME.shutdown()
+
+if __name__ == "__main__":
+    main()
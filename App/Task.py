@@ -1,10 +1,19 @@
+import asyncio
+import uuid
 from PyQt5.QtWidgets import QApplication
 from Serializable import ISerializable
 from TaskNode import TaskNode, TaskNode_Container
-from TaskNode_LLM import TaskNode_LLM 
+from TaskNode_LLM import TaskNode_LLM, Get_Model_Context_Budget, MAX_INSTRUCTION_BUDGET_FRACTION
+from ContextPacker import GLOBAL_CONTEXT_PACKER, ContextBlock, PRIORITY_INSTRUCTION
 from enum import IntEnum
 from typing import Any, Dict, List
 from TypeDefs import SessionEntry, ResponseEntryType, TaskContext, TaskNodeState
+from AsyncRuntime import ASYNC_RUNTIME
+from LLMMetrics import LLMUsageSummary, Get_Top_Usage
+from LLMBatchRunner import GLOBAL_BATCH_RUNNER
+from Util import NODE_OUTPUT_PREFIX, validate_node_output_references
+from NodeResultCache import NodeResultCache
+from TaskGraphScheduler import TaskGraphScheduler, GraphBuildError, DEFAULT_GRAPH_WORKERS
 
 import Globals
 
@@ -47,6 +56,8 @@ class Task(ISerializable):
     def __init__(self, name: str = "NO NAME", project = None):
         self.name: str = name
         self.project = project
+        # identifies the task in the project file's task_index
+        self.task_id: str = uuid.uuid4().hex
         self.initial_prompt_tags: List[str] = ["HttpServerTestPrompt"]# ["identity", "conversation style", "User info", "project description", "project manifest"]
         self.task_phase: TaskPhase = TaskPhase.Spec
         self.branch_name: str = "DEFAULT_BRANCH_NAME"
@@ -56,28 +67,91 @@ class Task(ISerializable):
         self.content_version: str = "" #for when the graph data changes
         self.graph_version: str = "" #for when the code changes
         self.task_graph_root: TaskNode = None
+        # play runs independent nodes concurrently, see TaskGraphScheduler, off runs them one at a time in order
+        self.parallel_execution: bool = True
+        self.graph_workers: int = DEFAULT_GRAPH_WORKERS
+        self.node_results: NodeResultCache = NodeResultCache()
         self.LLM_interface: TaskNode_LLM = TaskNode_LLM()
         self.LLM_interface.name = f"{self.name}_tasksession"
-        self.LLM_interface.set_session_callback(self.session_callback)
-        self.LLM_interface.set_session_filter_callback(self.session_filter_callback)
+        self._bind_interface()
 
         self.task_context: TaskContext = TaskContext(self.project, self)
+        self._execution_future = None
+        # where the session/graph are read from when the task isn't loaded yet, see Project.load_task
+        self._source = None
 
         self.initialize_phase()
                 
-    _exclude_from_properties = ['project', 'task_graph_root', 'commit_id', 'LLM_interface']
-    _readonly_properties = ['name','task_phase', 'branch_name', 'content_version', 'graph_version']    
-    _exclude_from_usd = ['project']
+    _exclude_from_properties = ['project', 'task_graph_root', 'commit_id', 'LLM_interface', 'node_results']
+    _readonly_properties = ['name','task_phase', 'branch_name', 'content_version', 'graph_version', 'task_id']    
+    _exclude_from_usd = ['project', 'node_results']
     _exclude_from_json = ['project']
 
+    def _bind_interface(self):
+        self.LLM_interface.set_session_callback(self.session_callback)
+        self.LLM_interface.set_session_filter_callback(self.session_filter_callback)
+
+    def post_deserialize(self):
+        # the session and context were loaded on their own, point them back at this task
+        self._bind_interface()
+        self.task_context.task = self
+
+    def attach_to_project(self, project):
+        self.project = project
+        self.task_context.project = project
+        self.task_context.task = self
+
+        current_node = self.task_context.get_current_node()
+        if current_node is not None and len(self.task_context.node_stack) == 0 and current_node.state == TaskNodeState.Queued:
+            current_node.set_state(TaskNodeState.Ready)
+
+    def is_loaded(self) -> bool:
+        return self._source is None
+
+    def ensure_loaded(self):
+        # call before using the session, graph or results, a task opened from a file only has its index entry until then
+        if self.project is not None:
+            self.project.load_task(self)
+
+    def is_running(self) -> bool:
+        return self._execution_future is not None and not self._execution_future.done()
+
+    def unload(self, source):
+        """
+        Drops the session, graph and results, they are read back from "source" by Project.load_task
+        The name, id and phase stay, so the task can still be listed
+        """
+        self.task_graph_root = None
+        self.node_results = NodeResultCache()
+        self.LLM_interface = TaskNode_LLM()
+        self.LLM_interface.name = f"{self.name}_tasksession"
+        self._bind_interface()
+        self.task_context = TaskContext(self.project, self)
+        self._source = source
+
     def get_display_name(self):
         return f"{self.name}[{self.task_phase}]"
 
     def add_prompts_by_tags(self, tags: List[str]) -> int:
+        # the prompts sent to the llm are packed like TaskNode_LLM's additional prompts, most specific first if they don't all fit
         context_prompts_added = 0
         discovered_prompts = Globals.find_prompts(tags)
+        blocks = [ContextBlock(prompt.summary, prompt.prompt, PRIORITY_INSTRUCTION + len(prompt.tags), kind="instruction")
+                  for prompt in discovered_prompts if prompt.include_in_context]
+        budget = int(Get_Model_Context_Budget(self.LLM_interface.llm_model) * MAX_INSTRUCTION_BUDGET_FRACTION)
+        packed, manifest = GLOBAL_CONTEXT_PACKER.pack(blocks, budget)
+        if manifest.has_omissions():
+            print(f"{self.name} prompt packing: {manifest}")
+        # packed keeps the order of the prompts, the ones left out are skipped, truncated ones are added as packed
+        packed_index = 0
         for prompt in discovered_prompts:
-            self.LLM_interface.add_session_entry("System", prompt.prompt, 
+            text = prompt.prompt
+            if prompt.include_in_context:
+                if packed_index >= len(packed) or packed[packed_index].name != prompt.summary:
+                    continue
+                text = packed[packed_index].text
+                packed_index += 1
+            self.LLM_interface.add_session_entry("System", text, 
                                                  prompt.include_in_context, 
                                                  prompt.include_in_display, 
                                                  entry_type=ResponseEntryType.INSTRUCTION,  
@@ -97,6 +171,8 @@ class Task(ISerializable):
     def advance_phase(self):
         if self.task_phase < TaskPhase.Complete:
             self.task_phase = TaskPhase(self.task_phase.value + 1)
+            # entries from the previous phase are filtered out of the session context now
+            self.LLM_interface.invalidate_session_context()
             Globals.ProjectManagerWindow.projects_tree.request_refresh_taskgraph(self)
             context_additions = self.add_phase_prompt()
 
@@ -107,28 +183,184 @@ class Task(ISerializable):
                 self._continue_session = True
 
     def step_tasknode(self):
+        # execution happens on the async runtime so the UI stays responsive
         current_node : TaskNode = self.task_context.get_current_node()
         if current_node != None and current_node.state == TaskNodeState.Ready:
-            current_node.execute(self.task_context)
-            self.task_context.advance_node()
-            current_node : TaskNode = self.task_context.get_current_node()
-            current_node.set_state(TaskNodeState.Ready)
+            self._execution_future = ASYNC_RUNTIME.submit(self.step_tasknode_async(), on_done=self._on_execution_done)
         else:
             print(f"Unexpected error stepping tasknode: {current_node}")
 
     def play_taskgraph(self):
         current_node : TaskNode = self.task_context.get_current_node()                    
         if current_node and current_node.state == TaskNodeState.Ready:
-            while(True):
-                self.step_tasknode()
-                current_node : TaskNode = self.task_context.get_current_node()
-                if current_node == None or current_node != TaskNodeState.Complete:
-                    break
+            self._execution_future = ASYNC_RUNTIME.submit(self.play_taskgraph_async(), on_done=self._on_execution_done)
+
+    def rewind_taskgraph(self):
+        # back to the start of the graph, nodes whose definition and inputs haven't changed are restored from node_results when played
+        if self.task_graph_root is None:
+            return
+        self.stop_execution()
+        pending = [self.task_graph_root]
+        while pending:
+            node = pending.pop()
+            self.task_context.clear_node_variables(node)
+            node.set_state(TaskNodeState.Queued)
+            pending.extend(node.children)
+        self.task_context.set_node_stack([])
+        self.task_graph_root.set_state(TaskNodeState.Ready)
+
+    def stop_execution(self):
+        if self._execution_future and not self._execution_future.done():
+            self._execution_future.cancel()
+
+    async def step_tasknode_async(self) -> bool:
+        # returns True if the executed node completed and there is another node to run
+        current_node : TaskNode = self.task_context.get_current_node()
+        batch_nodes = self.get_batch_nodes()
+        if len(batch_nodes) > 0:
+            # the cursor is left on the last node of the batch
+            await self.execute_batch_async(batch_nodes)
+            completed = all(node.state == TaskNodeState.Complete for node in batch_nodes)
+        else:
+            await self.execute_node_async(current_node, self.task_context)
+            completed = current_node.state == TaskNodeState.Complete
+        advanced = self.task_context.advance_node()
+        next_node : TaskNode = self.task_context.get_current_node()
+        next_node.set_state(TaskNodeState.Ready)
+        return advanced and completed
+
+    def get_batch_nodes(self) -> List[TaskNode_LLM]:
+        """
+        The current node and the siblings that directly follow it, as long as they are leaf TaskNode_LLMs flagged
+        with use_batch_api and don't read anything an earlier node in the run produces
+        """
+        node_stack = self.task_context.node_stack
+        current_node = self.task_context.get_current_node()
+        if len(node_stack) == 0 or not self._is_batchable(current_node):
+            return []
+
+        parent_node = self.task_context.get_node(node_stack[:-1])
+        batch_nodes = []
+        produced_variables = set()
+        produced_nodes = set()
+        for node in parent_node.children[node_stack[-1]:]:
+            if not self._is_batchable(node):
+                break
+            depends_on_batch = False
+            for input in node.inputs:
+                if input in produced_variables:
+                    depends_on_batch = True
+                elif input.startswith(NODE_OUTPUT_PREFIX) and input.rstrip('/').split('/')[-1] in produced_nodes:
+                    depends_on_batch = True
+            if depends_on_batch:
+                break
+            batch_nodes.append(node)
+            produced_variables.add(node.response_variable_stack_name)
+            produced_nodes.add(node.name)
+        return batch_nodes
+
+    def _is_batchable(self, node: TaskNode) -> bool:
+        return isinstance(node, TaskNode_LLM) and node.use_batch_api and len(node.children) == 0
+
+    async def execute_node_async(self, node: TaskNode, task_context: TaskContext):
+        # run the node, or restore its result if it ran before with the same definition and inputs
+        key = await asyncio.to_thread(self.node_results.make_key, node, task_context)
+        if self.node_results.restore(key, node, task_context):
+            node.set_state(TaskNodeState.Complete)
+            return
+        variables_before = task_context.variable_stack.snapshot()
+        await node.execute_async(task_context)
+        if node.state == TaskNodeState.Complete:
+            self.node_results.store(key, node, task_context, variables_before)
+
+    async def execute_batch_async(self, batch_nodes: List[TaskNode_LLM], task_contexts: List[TaskContext] = None):
+        # compose each node's request with the cursor on that node, so inputs resolve as they would when stepping,
+        # unless each node comes with its own context
+        move_cursor = task_contexts is None
+        if move_cursor:
+            task_contexts = [self.task_context] * len(batch_nodes)
+
+        requests = []
+        for index, (node, task_context) in enumerate(zip(batch_nodes, task_contexts)):
+            if move_cursor and index > 0:
+                self.task_context.advance_node()
+            key = await asyncio.to_thread(self.node_results.make_key, node, task_context)
+            if self.node_results.restore(key, node, task_context):
+                node.set_state(TaskNodeState.Complete)
+                continue
+            node.prepare_request(task_context)
+            requests.append((node, task_context, key))
+        if len(requests) == 0:
+            return
+        request_nodes = [node for node, _, _ in requests]
+
+        try:
+            for node in request_nodes:
+                await node.reduce_context()
+            results = await GLOBAL_BATCH_RUNNER.run(request_nodes)
+        except asyncio.CancelledError:
+            for node in request_nodes:
+                node.set_state(TaskNodeState.Error)
+                node.error_message = "[batch]Cancelled"
+            raise
+        except Exception as e:
+            results = [{"error": f"Unexpected error: {e}"} for _ in request_nodes]
+
+        for (node, task_context, key), result in zip(requests, results):
+            variables_before = task_context.variable_stack.snapshot()
+            await node.complete_batch_request(task_context, result)
+            if node.state == TaskNodeState.Complete:
+                self.node_results.store(key, node, task_context, variables_before)
+
+    async def play_taskgraph_async(self):
+        # project files are read once per run, see ProjectFileCache
+        self.task_context.get_file_cache().clear()
+        if self.parallel_execution:
+            try:
+                await TaskGraphScheduler(self, self.graph_workers).run()
+                return
+            except GraphBuildError as e:
+                print(f"Task {self.name} graph can't run in parallel, running in order: {e}")
+        while(True):
+            if not await self.step_tasknode_async():
+                break
+
+    def get_llm_nodes(self) -> List[TaskNode_LLM]:
+        # the task session followed by every llm node in the graph, depth first
+        nodes = [self.LLM_interface]
+        pending = [self.task_graph_root] if self.task_graph_root else []
+        while pending:
+            node = pending.pop()
+            if isinstance(node, TaskNode_LLM):
+                nodes.append(node)
+            pending.extend(reversed(node.children))
+        return nodes
+
+    def get_node_usage(self) -> List[tuple]:
+        # (display name, LLMUsageSummary) for every llm node that has made a request
+        return [(f"{self.name}/{node.name}", node.get_usage_summary()) for node in self.get_llm_nodes() if len(node.usage_history) > 0]
+
+    def get_usage_summary(self) -> LLMUsageSummary:
+        summary = LLMUsageSummary()
+        for node in self.get_llm_nodes():
+            summary.merge(node.get_usage_summary())
+        return summary
+
+    def get_top_usage(self, metric: str = "cost", count: int = 10) -> List[tuple]:
+        return Get_Top_Usage(self.get_node_usage(), metric, count)
+
+    def _on_execution_done(self, future):
+        # called on the Qt thread
+        if future.cancelled():
+            print(f"Task {self.name} execution cancelled")
+        elif future.exception():
+            print(f"Unexpected error executing task {self.name}: {future.exception()}")
 
     def handle_session_response(self, response_session_entries: List[SessionEntry]) -> bool:
         if self.task_phase < TaskPhase.Complete:
             can_proceed = False
             retry = False
+            retry_reason = ""
             response_handled = False
 
             if self.task_phase == TaskPhase.BuildGraph:
@@ -141,6 +373,9 @@ class Task(ISerializable):
                         can_proceed = True
                         try:
                             self.task_graph_root = TaskNode_Container.from_json(session_entry.content)
+                            reference_errors = validate_node_output_references(self.task_context)
+                            if len(reference_errors) > 0:
+                                raise Exception("invalid node_output references: " + ", ".join(reference_errors))
                             self.task_graph_root.set_state(TaskNodeState.Ready)
                             retry = False
                             Globals.ProjectManagerWindow.projects_tree.request_refresh_taskgraph(self)
@@ -148,13 +383,14 @@ class Task(ISerializable):
                         except Exception as e:
                             can_proceed = False
                             retry = True
+                            retry_reason = str(e)
                             print(f"Unexpected error serializing task_graph: {e}")
                         break                            
 
             if can_proceed:
                 self.advance_phase()
             elif retry:
-                self.LLM_interface.add_session_entry("task_manager", "something went wrong please try again", True, False,  metadata={"task_phase": self.task_phase})
+                self.LLM_interface.add_session_entry("task_manager", f"something went wrong please try again\n{retry_reason}".strip(), True, False,  metadata={"task_phase": self.task_phase})
                 QApplication.processEvents()  # Force UI redraw
                 self._continue_session = True
 
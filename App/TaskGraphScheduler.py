@@ -0,0 +1,244 @@
+import asyncio
+from typing import Dict, List, Optional, Set, Tuple
+
+from TaskNode import TaskNode, TaskNode_Container
+from TaskNode_LLM import TaskNode_LLM
+from TypeDefs import TaskContext, TaskNodeState
+from CompiledGraph import NodeReferenceError
+from VariableStack import VariableStack
+from Util import ASSET_PREFIX, NODE_OUTPUT_PREFIX
+
+DEFAULT_GRAPH_WORKERS = 4
+
+class GraphBuildError(Exception):
+    pass
+
+class _GraphNode:
+    def __init__(self, node: TaskNode, path: List[int], parent: Optional['_GraphNode']):
+        self.node = node
+        # child indexes from the root down
+        self.path = path
+        self.parent = parent
+        self.children: List['_GraphNode'] = []
+        self.order = 0 # depth first order, the order the sequential mode runs nodes in
+        self.dependencies: Set['_GraphNode'] = set()
+        self.dependents: Set['_GraphNode'] = set()
+
+    def get_node_stack(self) -> List[int]:
+        return list(self.path)
+
+    def get_subtree(self) -> List['_GraphNode']:
+        nodes = [self]
+        for child in self.children:
+            nodes.extend(child.get_subtree())
+        return nodes
+
+class TaskGraphScheduler:
+    """
+    Runs a Task's graph as a dependency DAG instead of one node at a time, up to "max_workers" nodes at once
+    Dependencies come from what the nodes declare:
+        a child runs after its parent, like it does when stepping
+        "inputs" read asset:// files, node_output:// results of other nodes or variables
+        "output" and TaskNode_LLM.response_variable_stack_name are what a node writes
+        a read runs after the last earlier writer, a write after the earlier readers and writers, so the result is the
+        same as running in order
+    Files an llm node writes that it did not declare in "output" can't be seen ahead of time, so reads of undeclared
+    files also wait for the earlier llm nodes that declare no files. Nodes that declare nothing and aren't llm nodes or
+    containers (ie python nodes) could touch anything, they are barriers between everything before and after them.
+    Each node runs with its own TaskContext, a copy of the task's variables with the node stack pointing at the node,
+    its variable changes are applied to the task's context when it completes.
+    Node state changes go through TaskNode.set_state, which is delivered on the GUI thread.
+    """
+    def __init__(self, task, max_workers: int = DEFAULT_GRAPH_WORKERS):
+        self.task = task
+        self.max_workers = max(1, max_workers)
+        self.nodes: List[_GraphNode] = []
+
+    def build(self) -> List[_GraphNode]:
+        self.nodes = []
+        root = self.task.task_graph_root
+        if root is None:
+            return self.nodes
+        self._add_node(root, [], None)
+
+        last_writers: Dict[Tuple[str, str], _GraphNode] = {}
+        readers_since_write: Dict[Tuple[str, str], List[_GraphNode]] = {}
+        undeclared_file_writers: List[_GraphNode] = []
+        since_barrier: List[_GraphNode] = []
+        barrier: Optional[_GraphNode] = None
+
+        for graph_node in self.nodes:
+            node = graph_node.node
+            if graph_node.parent is not None:
+                self._add_dependency(graph_node, graph_node.parent)
+
+            if self._is_barrier(node):
+                for earlier in since_barrier:
+                    self._add_dependency(graph_node, earlier)
+                if barrier is not None:
+                    self._add_dependency(graph_node, barrier)
+                barrier = graph_node
+                since_barrier = []
+                continue
+            if barrier is not None:
+                self._add_dependency(graph_node, barrier)
+            since_barrier.append(graph_node)
+
+            for key in self._get_reads(graph_node):
+                if key[0] == "node":
+                    for target in self._resolve_node_output(graph_node, key[1]).get_subtree():
+                        if target is not graph_node:
+                            self._add_dependency(graph_node, target)
+                    continue
+                if key in last_writers:
+                    self._add_dependency(graph_node, last_writers[key])
+                elif key[0] == "asset":
+                    for writer in undeclared_file_writers:
+                        self._add_dependency(graph_node, writer)
+                readers_since_write.setdefault(key, []).append(graph_node)
+
+            writes = self._get_writes(graph_node)
+            for key in writes:
+                if key in last_writers:
+                    self._add_dependency(graph_node, last_writers[key])
+                for reader in readers_since_write.pop(key, []):
+                    if reader is not graph_node:
+                        self._add_dependency(graph_node, reader)
+                last_writers[key] = graph_node
+            if isinstance(node, TaskNode_LLM) and not any(key[0] == "asset" for key in writes):
+                undeclared_file_writers.append(graph_node)
+
+        return self.nodes
+
+    def _add_node(self, node: TaskNode, path: List[int], parent: Optional[_GraphNode]):
+        graph_node = _GraphNode(node, path, parent)
+        graph_node.order = len(self.nodes)
+        self.nodes.append(graph_node)
+        if parent is not None:
+            parent.children.append(graph_node)
+        for index, child in enumerate(node.children):
+            self._add_node(child, path + [index], graph_node)
+
+    def _add_dependency(self, graph_node: _GraphNode, dependency: _GraphNode):
+        graph_node.dependencies.add(dependency)
+        dependency.dependents.add(graph_node)
+
+    def _is_barrier(self, node: TaskNode) -> bool:
+        if isinstance(node, (TaskNode_LLM, TaskNode_Container)):
+            return False
+        return len(node.inputs) == 0 and len(node.output) == 0
+
+    def _get_key(self, name: str) -> Tuple[str, str]:
+        if name.startswith(ASSET_PREFIX):
+            return ("asset", name[len(ASSET_PREFIX):])
+        if name.startswith(NODE_OUTPUT_PREFIX):
+            return ("node", name[len(NODE_OUTPUT_PREFIX):])
+        return ("variable", name)
+
+    def _get_reads(self, graph_node: _GraphNode) -> List[Tuple[str, str]]:
+        return [self._get_key(input) for input in graph_node.node.inputs]
+
+    def _get_writes(self, graph_node: _GraphNode) -> List[Tuple[str, str]]:
+        writes = [self._get_key(output) for output in graph_node.node.output if not output.startswith(NODE_OUTPUT_PREFIX)]
+        if isinstance(graph_node.node, TaskNode_LLM) and len(graph_node.node.response_variable_stack_name) > 0:
+            writes.append(("variable", graph_node.node.response_variable_stack_name))
+        return writes
+
+    def _resolve_node_output(self, graph_node: _GraphNode, node_path: str) -> _GraphNode:
+        # the same lookup as Util.get_node_output, both graphs are in depth first order so the indexes match
+        try:
+            return self.nodes[self.task.task_context.get_graph().resolve_reference(graph_node.order, node_path)]
+        except NodeReferenceError as e:
+            raise GraphBuildError(f"{e} in {node_path} from {graph_node.node.name}")
+
+    def fork_context(self, graph_node: _GraphNode) -> TaskContext:
+        return self.task.task_context.fork(graph_node.get_node_stack())
+
+    def merge_context(self, forked_context: TaskContext, snapshot: VariableStack):
+        # only the frames the node wrote to are compared
+        changed, removed = forked_context.variable_stack.get_changes(snapshot)
+        self.task.task_context.variable_stack.apply_changes(changed, removed)
+
+    async def run(self) -> bool:
+        """
+        Runs every node that isn't Complete yet, returns True if they all completed
+        After a failure no new nodes are started, the running ones finish, and the task's cursor is left on the first
+        node that failed so it can be stepped again
+        """
+        self.build()
+        pending = [graph_node for graph_node in self.nodes if graph_node.node.state != TaskNodeState.Complete]
+        remaining = {graph_node: sum(1 for dependency in graph_node.dependencies if dependency.node.state != TaskNodeState.Complete) for graph_node in pending}
+        ready = sorted((graph_node for graph_node in pending if remaining[graph_node] == 0), key=lambda graph_node: graph_node.order)
+        for graph_node in ready:
+            graph_node.node.set_state(TaskNodeState.Ready)
+
+        running: Dict[asyncio.Task, _GraphNode] = {}
+        failed: List[_GraphNode] = []
+        try:
+            while len(ready) > 0 or len(running) > 0:
+                while len(ready) > 0 and len(running) < self.max_workers and len(failed) == 0:
+                    group = self._take_batch(ready)
+                    running[asyncio.ensure_future(self._execute(group))] = group[0]
+
+                if len(running) == 0:
+                    break
+                done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    running.pop(future)
+                    for graph_node in future.result():
+                        if graph_node.node.state != TaskNodeState.Complete:
+                            failed.append(graph_node)
+                            continue
+                        for dependent in graph_node.dependents:
+                            if dependent in remaining:
+                                remaining[dependent] -= 1
+                                if remaining[dependent] == 0:
+                                    dependent.node.set_state(TaskNodeState.Ready)
+                                    ready.append(dependent)
+                ready.sort(key=lambda graph_node: graph_node.order)
+        except asyncio.CancelledError:
+            for future in running:
+                future.cancel()
+            await asyncio.gather(*running.keys(), return_exceptions=True)
+            raise
+
+        if len(failed) > 0:
+            first_failed = min(failed, key=lambda graph_node: graph_node.order)
+            self.task.task_context.set_node_stack(first_failed.get_node_stack())
+            first_failed.node.set_state(TaskNodeState.Ready)
+            return False
+
+        for graph_node in reversed(self.nodes):
+            self.task.task_context.clear_node_variables(graph_node.node)
+        self.task.task_context.set_node_stack([])
+        return all(graph_node.node.state == TaskNodeState.Complete for graph_node in pending)
+
+    def _take_batch(self, ready: List[_GraphNode]) -> List[_GraphNode]:
+        # ready batch api nodes go out together as one provider batch, anything else runs on its own
+        graph_node = ready.pop(0)
+        if not self.task._is_batchable(graph_node.node):
+            return [graph_node]
+        group = [graph_node] + [other for other in ready if self.task._is_batchable(other.node)]
+        for other in group[1:]:
+            ready.remove(other)
+        return group
+
+    async def _execute(self, group: List[_GraphNode]) -> List[_GraphNode]:
+        contexts = [self.fork_context(graph_node) for graph_node in group]
+        snapshots = [context.variable_stack.snapshot() for context in contexts]
+        try:
+            if len(group) > 1 or self.task._is_batchable(group[0].node):
+                await self.task.execute_batch_async([graph_node.node for graph_node in group], contexts)
+            else:
+                await self.task.execute_node_async(group[0].node, contexts[0])
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            for graph_node in group:
+                if graph_node.node.state != TaskNodeState.Error:
+                    graph_node.node.set_state(TaskNodeState.Error)
+            print(f"Unexpected error executing {[graph_node.node.name for graph_node in group]}: {e}")
+        for graph_node, context, snapshot in zip(group, contexts, snapshots):
+            if graph_node.node.state == TaskNodeState.Complete:
+                self.merge_context(context, snapshot)
+        return group
@@ -1,11 +1,17 @@
 from Serializable import ISerializable
 from abc import ABC, abstractmethod
 from enum import Enum
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional
 from PyQt5.QtWidgets import QPushButton
-from TypeDefs import TaskContext, TaskNodeState
+from TypeDefs import SessionEntry, TaskContext, TaskNodeState
+from AsyncRuntime import post_to_qt
+from CodeCache import GLOBAL_CODE_CACHE
+from CompiledGraph import Mark_Graph_Edited
+from PythonSandbox import GLOBAL_PYTHON_SANDBOX, DEFAULT_PYTHON_MEMORY_MB, DEFAULT_PYTHON_TIMEOUT, Make_Sandbox_Job
 from io import StringIO
+import asyncio
 import sys
+import time
 #============================================================================
 class TaskNode(ABC, ISerializable):
     """
@@ -34,21 +40,34 @@ class TaskNode(ABC, ISerializable):
         self.inputs: List[str] = []
         # inputs specifiy the data produced by the node, to be specified during graph construction
         self.output: List[str] = []
+        # skip the node when it runs again with the same definition and inputs, see NodeResultCache
+        self.cache_result: bool = True
 
         self._rewind_button: QPushButton = None
         self._step_button: QPushButton = None
         self._play_button: QPushButton = None
     
     def add_child(self, child: 'TaskNode'): 
+        # edits to children outside add_child should call Mark_Graph_Edited too
         self.children.append(child)
+        Mark_Graph_Edited()
 
     @abstractmethod
     def execute(self, task_context : TaskContext):
         pass
 
+    # runs on the ASYNC_RUNTIME loop, nodes with native async work should override this
+    async def execute_async(self, task_context : TaskContext):
+        await asyncio.to_thread(self.execute, task_context)
+
+    def is_result_cacheable(self) -> bool:
+        # containers are cheap to run and their children are cached on their own
+        return self.cache_result and len(self.children) == 0
+
     def set_state(self, new_state: TaskNodeState):
         self.state = new_state
-        self.update_button_state(new_state)
+        # nodes execute off the GUI thread, buttons can only be touched from it
+        post_to_qt(self.update_button_state, new_state)
 
     def set_buttons(self, rewind_button, step_button, play_button):
         self._rewind_button = rewind_button
@@ -77,6 +96,8 @@ class TaskNode(ABC, ISerializable):
     _readonly_properties = ['name', 'type','inputs', 'output']
     _exclude_from_usd = ['type', 'scoped_variables']
     _exclude_from_json = ['type', 'scoped_variables']
+    # execution state rather than definition, left out of NodeResultCache keys
+    _exclude_from_fingerprint = ['state', 'scoped_variables', 'children', 'output', 'cache_result']
 
 #============================================================================
 class TaskNode_Container(TaskNode):
@@ -119,21 +140,78 @@ class TaskNode_Python(TaskNode):
     def __init__(self):
         super().__init__()
         self.python_code = ""
+        # run in a GLOBAL_PYTHON_SANDBOX worker process, off runs the code in the app's process like it used to
+        self.use_sandbox: bool = True
+        self.timeout: float = DEFAULT_PYTHON_TIMEOUT
+        self.memory_limit_mb: int = DEFAULT_PYTHON_MEMORY_MB
+        # what the code printed, and any error
+        self.session: List[SessionEntry] = []
+        self.error_message: Optional[str] = None
+
+    _exclude_from_fingerprint = TaskNode._exclude_from_fingerprint + ['session', 'error_message', 'timeout', 'memory_limit_mb', 'use_sandbox']
+
+    def is_result_cacheable(self) -> bool:
+        # code that declares nothing could read or write anything
+        return super().is_result_cacheable() and (len(self.inputs) > 0 or len(self.output) > 0)
+
+    def add_session_entry(self, sender: str, content: str):
+        # consecutive output from the same stream goes in one entry
+        if len(self.session) > 0 and self.session[-1].sender == sender:
+            self.session[-1].content += content
+        else:
+            self.session.append(SessionEntry(sender, content))
 
     def execute(self, task_context : TaskContext):
         self.set_state(TaskNodeState.Executing)
-        print(f"calling exec() with self.python_code:\n{self.python_code}")
+        self.session = []
+        self.error_message = None
+        if not self.use_sandbox:
+            self._execute_in_process(task_context)
+            return
+
+        node_fields = {name: value for name, value in self.to_dict().items() if name not in ['children', 'session']}
+        job, skipped = Make_Sandbox_Job(self.python_code, task_context, node_fields, self.memory_limit_mb)
+        if len(skipped) > 0:
+            self.add_session_entry("sandbox", f"Variables that can't be sent to the python process were left out: {', '.join(skipped)}\n")
+        result = GLOBAL_PYTHON_SANDBOX.run(job, self.timeout, self.add_session_entry)
+
+        # changes made before an error are kept, like they were when the code ran in process
+        for name, value in result.variables.items():
+            task_context.variable_stack[name] = value
+        for name in result.removed_variables:
+            task_context.variable_stack.pop(name, None)
+        if result.output is not None:
+            self.output = result.output
+        if len(result.unserializable_variables) > 0:
+            self.add_session_entry("sandbox", f"Variables that aren't json were not returned: {', '.join(result.unserializable_variables)}\n")
+        self.add_session_entry("sandbox", f"{'cached' if result.compile_hit else 'compiled'} code, ran in {result.exec_time * 1000.0:.3f}ms "
+                                          f"({result.duration * 1000.0:.1f}ms with the sandbox round trip)\n")
+
+        if not result.succeeded():
+            self.error_message = result.error
+            self.add_session_entry("error", result.error)
+            print(f"Error executing python code in {self.name}: {result.error}")
+            self.set_state(TaskNodeState.Error)
+            return
+        self.set_state(TaskNodeState.Complete)
+
+    def _execute_in_process(self, task_context : TaskContext):
         old_stdout = sys.stdout
         sys.stdout = mystdout = StringIO()
         try:
-            # https://stackoverflow.com/questions/2904274/globals-and-locals-in-python-exec
-            d = dict(locals(), **globals())
-            exec(self.python_code, d, d)
+            code, compile_hit = GLOBAL_CODE_CACHE.get(self.python_code, f"<{self.name}>")
+            # one dict for globals and locals so functions defined by the code can see each other
+            namespace = GLOBAL_CODE_CACHE.make_namespace({"task_context": task_context, "self": self})
+            exec_start = time.perf_counter()
+            exec(code, namespace, namespace)
+            exec_time = time.perf_counter() - exec_start
             output = mystdout.getvalue()
-            # the output should go into a chat session entry or something eventually
-            print(output)
+            if len(output) > 0:
+                self.add_session_entry("stdout", output)
+            self.add_session_entry("sandbox", f"{'cached' if compile_hit else 'compiled'} code, ran in {exec_time * 1000.0:.3f}ms in process\n")
         except Exception as e:
             sys.stdout = old_stdout
+            self.error_message = str(e)
             self.set_state(TaskNodeState.Error)
             
             print(f"Error executing python code: {e}")
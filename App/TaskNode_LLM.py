@@ -4,9 +4,9 @@ import json
 import re
 import Globals
 import os
+import threading
 from typing import Optional, AsyncGenerator, List, Dict, Union, Callable
 from enum import Enum
-from concurrent.futures import ThreadPoolExecutor
 
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtCore import QObject, pyqtSignal
@@ -14,6 +14,33 @@ from PyQt5.QtCore import QObject, pyqtSignal
 from TaskNode import TaskNode
 from TypeDefs import SessionEntry, ResponseEntryType, TaskContext, TaskNodeState
 from Util import llm_input_context_resolver, ASSET_PREFIX
+from LLMConnectionPool import GLOBAL_CONNECTION_POOL
+from LLMScheduler import GLOBAL_LLM_SCHEDULER, estimate_tokens
+from AsyncRuntime import ASYNC_RUNTIME
+from LLMResponseCache import GLOBAL_RESPONSE_CACHE
+from StreamMarkupParser import StreamMarkupParser, MarkupEvent, MarkupEventType
+from UpdateCoalescer import UpdateCoalescer
+from LLMMetrics import LLMUsage, LLMUsageSummary
+from SessionContext import SessionContextBuilder, Append_Message, Get_Entry_Response_Text, SESSION_START_PROMPT, SESSION_CONTINUE_PROMPT
+from ContextReducer import GLOBAL_CONTEXT_REDUCER
+from ContextPacker import GLOBAL_CONTEXT_PACKER, ContextBlock, ContextManifest, TruncatePolicy, PRIORITY_INPUT, PRIORITY_INSTRUCTION
+
+# print how many streaming ui updates were merged at the end of each response
+DEBUG_STREAMING_UPDATES = False
+
+# both providers bill batch requests at half price
+BATCH_PRICE_MULTIPLIER = 0.5
+
+# used for rate limiting when the request doesn't set max_tokens
+DEFAULT_EXPECTED_OUTPUT_TOKENS = 1024
+
+# anthropic allows 4 cache breakpoints per request, we use up to 3, end of system + last two user turns
+ANTHROPIC_CACHE_CONTROL = {"type": "ephemeral"}
+
+# share of the model's context budget that prompts found by additional_prompt_tags may use
+MAX_INSTRUCTION_BUDGET_FRACTION = 0.25
+# inputs always get at least this share of the budget, a long session is reduced to make room, see ContextReducer
+MIN_INPUT_BUDGET_FRACTION = 0.5
 
 class LLM_Interface(str,Enum):
     OpenAI = 0
@@ -25,12 +52,14 @@ class LLM_Model(str,Enum):
     Chat_GPT_3_5_Turbo = 1
     Chat_GPT_4_o = 2
     DeepSeek = 3
+    Claude3_Haiku = 4
 
 model_names = {
     LLM_Model.Claude3_5_Sonnet: "claude-3-5-sonnet-20240620",
     LLM_Model.Chat_GPT_3_5_Turbo: "gpt-3.5-turbo",
     LLM_Model.Chat_GPT_4_o: "gpt-4o-2024-08-06",
     LLM_Model.DeepSeek: "",
+    LLM_Model.Claude3_Haiku: "claude-3-haiku-20240307",
 }
 
 model_interfaces = {
@@ -38,20 +67,50 @@ model_interfaces = {
     LLM_Model.Chat_GPT_3_5_Turbo: LLM_Interface.OpenAI,
     LLM_Model.Chat_GPT_4_o: LLM_Interface.OpenAI,
     LLM_Model.DeepSeek: LLM_Interface.OogaBooga,
+    LLM_Model.Claude3_Haiku: LLM_Interface.Anthropic,
+}
+
+# estimated prompt tokens above which the session is reduced before sending, below the real context windows
+# to leave room for the response and for estimate_tokens being approximate
+model_context_budgets = {
+    LLM_Model.Claude3_5_Sonnet: 150000,
+    LLM_Model.Chat_GPT_3_5_Turbo: 12000,
+    LLM_Model.Chat_GPT_4_o: 100000,
+    LLM_Model.DeepSeek: 12000,
+    LLM_Model.Claude3_Haiku: 150000,
 }
 
 def Get_Model_Interface(model: LLM_Model):
     return model_interfaces[model]
 
+def Get_Model_Context_Budget(model: LLM_Model) -> int:
+    return model_context_budgets[model]
+
+# set to point every provider at another server, ie a local MockLLMServer
+LLM_BASE_URL_ENVIRONMENT_VARIABLE = "TASKMASTER_LLM_BASE_URL"
+
+provider_base_urls = {
+    LLM_Interface.OpenAI: "https://api.openai.com",
+    LLM_Interface.Anthropic: "https://api.anthropic.com",
+}
+
+def Set_Provider_Base_Url(interface: LLM_Interface, base_url: str):
+    provider_base_urls[interface] = base_url.rstrip('/')
+    GLOBAL_CONNECTION_POOL.configure(interface, base_url=provider_base_urls[interface])
+
+def Get_Provider_Base_Url(interface: LLM_Interface) -> str:
+    return provider_base_urls[interface]
+
+# one pooled, keep-alive session per provider
+for _interface in list(provider_base_urls.keys()):
+    Set_Provider_Base_Url(_interface, os.environ.get(LLM_BASE_URL_ENVIRONMENT_VARIABLE, provider_base_urls[_interface]))
+
 class LLMError(Exception):
     def __init__(self, message: str, details: Optional[str] = None):
         self.message = message
         self.details = details
         super().__init__(self.message)
 
-# Global ThreadPoolExecutor
-GLOBAL_EXECUTOR = ThreadPoolExecutor(max_workers=4)  # Adjust max_workers as needed
-
 class TaskNode_LLM(TaskNode):
     """
     TaskNode_LLM wraps requests to a collection of supported REST apis to major llm inference providers
@@ -65,19 +124,49 @@ class TaskNode_LLM(TaskNode):
     _session_callback : Callable = None
     _session_filter_callback : Callable = None
 
+    _exclude_from_fingerprint = TaskNode._exclude_from_fingerprint + ['session', 'usage_history', 'error_message', 'streaming', 'timeout',
+                                                                      'use_response_cache', 'use_batch_api']
+
     class _TaskNodeLLMQObject(QObject):
         streaming_update = pyqtSignal()
 
     def __init__(self):
         super().__init__()
+        # the request as a stable prefix, system instructions then prior turns then the new turn
+        self._composed_system: List[str] = []
+        self._composed_messages: List[Dict] = []
+        self._composed_new_turn = ""
+        # what was packed/truncated/dropped for the last composed request, see ContextPacker
+        self._context_manifest = ContextManifest()
+        self._instruction_manifest: Optional[ContextManifest] = None
+        # flattened _composed_messages, used for cache keys and token estimates
         self._composed_prompt = ""
+        # the session as system blocks + messages, updated as entries are added rather than rebuilt per request
+        self._session_context = SessionContextBuilder()
         self._qobject = self._TaskNodeLLMQObject()
+        self._update_coalescer = UpdateCoalescer(self._emit_streaming_update)
         self._stop_response = False
         self._stream_complete = True
         self._response_session_entries: List[SessionEntry] = []
         self._full_response = ""
+        self._response_chunks: List[str] = []
+        self._streaming_entry: Optional[SessionEntry] = None
+        self._streaming_chunks: List[str] = []
+        self._streaming_length = 0
+        # how many of _streaming_chunks are already in the entry's content
+        self._streaming_synced = 0
+        self._streaming_has_text = False
+        # the session is written to this as it changes when set, see SessionJournal
+        self._journal = None
+        # held while the session is changed or saved, it is changed from the qt thread and the runtime and saved
+        # from the journal compaction, see Project.save_to_file
+        self._session_lock = threading.RLock()
+        self._response_cacheable = True
         self._lock = asyncio.Lock()
         self._running_task = None
+        # requests are queued fairly between schedule keys, one per Task
+        self._schedule_key = None
+        self._usage: Optional[LLMUsage] = None
 
         self.llm_model: LLM_Model = LLM_Model.Claude3_5_Sonnet
         self.llm_model_name_override = ""
@@ -89,12 +178,38 @@ class TaskNode_LLM(TaskNode):
         self.state: TaskNodeState = TaskNodeState.Queued
         self.error_message: Optional[str] = None
         self.timeout: float = 60.0
+        # replay identical requests from GLOBAL_RESPONSE_CACHE instead of calling the provider
+        self.use_response_cache: bool = True
+        # send requests for this node to another server, ie a MockLLMServer, instead of the provider default
+        self.llm_base_url_override: str = ""
+        # submit through the provider's batch api when run as part of a graph, cheaper but not streamed
+        self.use_batch_api: bool = False
+        # summarise/evict older session entries with a cheaper model when the prompt is over the model's budget
+        self.use_context_reduction: bool = True
+        self.context_summary_model: LLM_Model = LLM_Model.Claude3_Haiku
+        # how inputs are packed when they don't all fit, keyed by input, defaults are PRIORITY_INPUT and
+        # TopN for project files, Head for everything else
+        self.input_priorities: Dict[str, int] = {}
+        self.input_truncation: Dict[str, TruncatePolicy] = {}
+        # one LLMUsage per request made by this node, saved with the project
+        self.usage_history: List[LLMUsage] = []
 
     def set_session_callback(self, callback: Callable[[str], None]):
         self._session_callback = callback
 
     def set_session_filter_callback(self, callback: Callable[[str], None]):
         self._session_filter_callback = callback        
+        self.invalidate_session_context()
+
+    def set_journal(self, journal):
+        self._journal = journal
+
+    def get_journal(self):
+        return self._journal
+
+    def invalidate_session_context(self):
+        # call when the session filter would give different answers, ie the task phase changed
+        self._session_context.invalidate()
 
     def connect_streaming_update(self, slot):
         self._qobject.streaming_update.connect(slot)
@@ -103,65 +218,114 @@ class TaskNode_LLM(TaskNode):
         self._qobject.streaming_update.disconnect(slot)
 
     def notify_streaming_update(self):
+        # rate limited, the ui only needs to redraw at frame rate, not per token
+        self._update_coalescer.mark_dirty()
+
+    def flush_streaming_update(self):
+        self._update_coalescer.flush()
+
+    def get_streaming_update_stats(self) -> Dict[str, int]:
+        return self._update_coalescer.get_stats()
+
+    def _emit_streaming_update(self):
+        self._sync_streaming_entry()
         self._qobject.streaming_update.emit()
 
     def add_session_entry(self, sender: str, content: str, include_in_context: bool = True, include_in_display: bool = True, entry_type: ResponseEntryType = ResponseEntryType.CHAT, metadata: Optional[Dict] = None):
         entry = SessionEntry(sender, content, entry_type, metadata)
         entry.include_in_context = include_in_context
         entry.include_in_display = include_in_display
-        self.session.append(entry)
+        with self._session_lock:
+            self.session.append(entry)
+            if self._journal is not None:
+                self._journal.add_entry(entry)
         self.notify_streaming_update()
 
-    async def make_request(self) -> AsyncGenerator[str, None]:
-        headers = {}
-        data = {}
-        url = ""
-        model_name = model_names[self.llm_model]
-        if len(self.llm_model_name_override) > 0:
-            model_name = self.llm_model_name_override
-        
-        model_interface = Get_Model_Interface(self.llm_model)
+    def to_dict(self):
+        with self._session_lock:
+            return super().to_dict()
 
-        assert self._composed_prompt, "Prompt is empty"
+    def _get_base_url(self) -> str:
+        if len(self.llm_base_url_override) > 0:
+            return self.llm_base_url_override.rstrip('/')
+        return Get_Provider_Base_Url(Get_Model_Interface(self.llm_model))
 
+    def get_request_headers(self) -> Dict[str, str]:
+        model_interface = Get_Model_Interface(self.llm_model)
         if model_interface == LLM_Interface.OpenAI:
-            url = "https://api.openai.com/v1/chat/completions"
             api_key = "YOUR_API_KEY"
-            headers = {
+            return {
                         "Content-Type": "application/json", 
                         "Authorization": f"Bearer {api_key}"
                     }
-            data = {
-                        "model": model_name, 
-                        "messages": [{"role": "user", "content": self._composed_prompt}],
-                        "stream" : self.streaming
-                    }
         elif model_interface == LLM_Interface.Anthropic:
-            url = "https://api.anthropic.com/v1/messages"
             api_key = "YOUR_API_KEY"
-            headers = {
+            return {
                         'Content-Type': 'application/json',
                         'X-API-Key': api_key,
                         'anthropic-version': '2023-06-01',
+                        'anthropic-beta': 'prompt-caching-2024-07-31',
                     }
+        raise LLMError(f"get_request_headers unhandled interface")
+
+    def get_request_body(self, streaming: bool) -> Dict:
+        # the json body for the composed prompt, also used as the per request params of a batch
+        model_name = self._get_model_name()
+        model_interface = Get_Model_Interface(self.llm_model)
+
+        assert self._composed_prompt, "Prompt is empty"
+
+        if model_interface == LLM_Interface.OpenAI:
+            data = {
+                        "model": model_name, 
+                        "messages": self._get_openai_messages(),
+                        "stream" : streaming
+                    }
+            if streaming:
+                # adds a final chunk with the usage block
+                data["stream_options"] = {"include_usage": True}
+        elif model_interface == LLM_Interface.Anthropic:
             data = {
                         "model": model_name, 
                         "max_tokens": 2048, 
-                        "messages": [{"role": "user", "content": self._composed_prompt}],
-                        "stream" : self.streaming
+                        "messages": self._get_anthropic_messages(),
+                        "stream" : streaming
                     }
+            if len(self._composed_system) > 0:
+                data["system"] = self._get_anthropic_system()
+        else:
+            raise LLMError(f"get_request_body unhandled interface")
+        return data
+
+    async def make_request(self) -> AsyncGenerator[str, None]:
+        model_interface = Get_Model_Interface(self.llm_model)
+        base_url = self._get_base_url()
+        if model_interface == LLM_Interface.OpenAI:
+            url = f"{base_url}/v1/chat/completions"
+        elif model_interface == LLM_Interface.Anthropic:
+            url = f"{base_url}/v1/messages"
         else:
             raise LLMError(f"make_request unhandled interface")                
+        headers = self.get_request_headers()
+        data = self.get_request_body(self.streaming)
+
+        def open_stream():
+            return GLOBAL_CONNECTION_POOL.stream_post(model_interface, url, headers, data, self.timeout)
 
+        def on_retry(attempt: int, delay: float, error: BaseException):
+            print(f"[make_request] {self.name} retry {attempt} in {delay:.1f}s after: {error}")
+            if self._usage:
+                self._usage.retries = attempt
+
+        # 429s, 5xx and timeouts before the first line are retried by the scheduler
+        tokens = estimate_tokens(self._composed_prompt) + data.get("max_tokens", DEFAULT_EXPECTED_OUTPUT_TOKENS)
+        stream = GLOBAL_LLM_SCHEDULER.stream(model_interface, self._get_schedule_key(), tokens, open_stream, on_retry)
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data, timeout=self.timeout) as response:
-                    response.raise_for_status()
-                    async for line in response.content:
-                        if self._stop_response:
-                            break                        
-                        if line:
-                            yield line.decode('utf-8')
+            async for line in stream:
+                if self._stop_response:
+                    break                        
+                if line:
+                    yield line.decode('utf-8')
 
         except asyncio.TimeoutError:
             raise LLMError(f"[make_request]Request timed out after {self.timeout} seconds")
@@ -169,109 +333,145 @@ class TaskNode_LLM(TaskNode):
             raise LLMError(f"[make_request]Network error: {str(e)}", details=str(e))
         except Exception as e:
             raise LLMError(f"[make_request]Unexpected error: {str(e)}", details=str(e))
-
-    async def process_stream(self, stream: AsyncGenerator[str, None]) -> None:
-        current_entry = None
+        finally:
+            # hand the provider slot back straight away rather than when the generator is collected
+            await stream.aclose()
+            if self._usage and self._usage.get_total_tokens() > 0:
+                # the estimate was charged up front, give back whatever wasn't used
+                GLOBAL_LLM_SCHEDULER.refund_tokens(model_interface, tokens - self._usage.get_total_tokens())
+
+    def _get_schedule_key(self):
+        return self._schedule_key if self._schedule_key is not None else id(self)
+
+    def _set_schedule_key(self, task_context : TaskContext):
+        if task_context is not None and task_context.task is not None:
+            self._schedule_key = id(task_context.task)
+
+    async def process_stream(self, stream: AsyncGenerator[str, None], parse_chunk: Optional[Callable[[str], str]] = None) -> None:
+        # "parse_chunk" turns raw stream data into response text, defaults to the provider's streaming format
+        parse_chunk = parse_chunk or self.parse_chunk
         self._stream_complete = False
         self._response_session_entries = []
-        identifying_markup = False
-        markup_buffer = ""
-        current_embedded_type = None
-        embedded_buffer = ""
-
-        def create_new_entry(entry_type: ResponseEntryType, metadata: Optional[Dict] = None):
-            nonlocal current_entry
-            self.add_session_entry("System", "", entry_type=entry_type, metadata=metadata)
-            current_entry = self.session[-1]
-            self._response_session_entries.append(current_entry)
+        self._response_chunks = []
+        self._update_coalescer.reset_stats()
+        parser = StreamMarkupParser(self._supported_embedded_types)
 
         # start the first reponse entry in chat mode
-        create_new_entry(ResponseEntryType.CHAT)
+        self._start_streaming_entry(ResponseEntryType.CHAT)
 
         try:
             async for raw_data in stream:
-                chunk = self.parse_chunk(raw_data)
+                chunk = parse_chunk(raw_data)
                 if chunk:
-                    self._full_response += chunk
-                    chunk_list = [chunk]                    
-                    while chunk_list:
-                        current_chunk = chunk_list.pop(0)
-
-                        if identifying_markup:
-                            markup_buffer += current_chunk
-                            split_index = markup_buffer.find(">\n")
-                            if split_index != -1:
-                                identifying_markup = False
-                                markup, remaining = markup_buffer[:split_index+1], markup_buffer[split_index+1:]
-                                markup_buffer = ""
-                                embedded_type = self._get_embedded_type(markup)
-                                if embedded_type:
-                                    # if there is an empty session context when embedded content is detected, delete it
-                                    if len(self.session) > 0 and (str.isspace(self.session[-1].content) or len(self.session[-1].content) == 0):
-                                        del self.session[-1]
-                                        self.notify_streaming_update()
-                                    current_embedded_type = embedded_type
-                                    filename = self._extract_filename_from_markup(markup)
-                                    if filename:
-                                        create_new_entry(ResponseEntryType.FILE, {"filename": filename, "type": current_embedded_type})
-                                    embedded_buffer = ""
-                                else:
-                                    if not current_entry or current_entry.entry_type != ResponseEntryType.CHAT:
-                                        create_new_entry(ResponseEntryType.CHAT)
-                                    remaining = markup_buffer
-                                if not str.isspace(remaining):
-                                    chunk_list = [remaining]
-
-                        elif current_entry.entry_type == ResponseEntryType.CHAT:
-                            split_index = current_chunk.find('<')
-                            if split_index != -1:
-                                session_content, remaining = current_chunk[:split_index], current_chunk[split_index:]
-                                current_entry.content += session_content
-                                identifying_markup = True
-                                if not str.isspace(remaining):
-                                    chunk_list = [remaining]
-                            else:
-                                if len(current_entry.content) == 0:
-                                    current_chunk = current_chunk.lstrip('\n')
-                                current_entry.content += current_chunk
-                                if not str.isspace(current_entry.content):
-                                    self.notify_streaming_update()
-
-                        elif current_entry.entry_type == ResponseEntryType.FILE:
-                            embedded_buffer += current_chunk
-                            end_tag = f"</{current_embedded_type}>"
-                            split_index = embedded_buffer.find(end_tag)
-                            if split_index != -1:
-                                content, remaining = embedded_buffer[:split_index], embedded_buffer[split_index + len(end_tag):]
-                                current_entry.content = content
-                                self.notify_streaming_update()
-                                create_new_entry(ResponseEntryType.CHAT)
-                                current_embedded_type = None
-                                embedded_buffer = ""
-                                if not str.isspace(remaining):
-                                    chunk_list.append(remaining)
-                            else:
-                                current_entry.content = embedded_buffer
-                                self.notify_streaming_update()
-
+                    if self._usage:
+                        self._usage.mark_first_token()
+                    self._response_chunks.append(chunk)
+                    self._handle_markup_events(parser.feed(chunk))
                 if self._stream_complete:
                     break
 
+            self._handle_markup_events(parser.close())
+            self._finish_streaming_entry()
+
             # if there is an empty session context at the end, delete it
-            if len(self.session) > 0 and (str.isspace(self.session[-1].content) or len(self.session[-1].content) == 0):
-                del self.session[-1]
-                self.notify_streaming_update()
+            self._remove_empty_response_entry()
 
         except Exception as e:
             raise LLMError(f"[process_stream]Error processing stream: {str(e)}", details=str(e))
+        finally:
+            self._full_response = "".join(self._response_chunks)
+            self.flush_streaming_update()
+            if DEBUG_STREAMING_UPDATES:
+                print(f"[DEBUG] {self.name} streaming updates {self.get_streaming_update_stats()}")
         
         #print(f"***{self._full_response}")
 
-    def _get_embedded_type(self, markup: str) -> Optional[str]:
-        for embedded_type in self._supported_embedded_types:
-            if markup.startswith(f'<{embedded_type}'):
-                return embedded_type
-        return None
+    def _handle_markup_events(self, events: List[MarkupEvent]):
+        for event in events:
+            if event.event_type == MarkupEventType.CHAT:
+                if self._streaming_entry is None or self._streaming_entry.entry_type != ResponseEntryType.CHAT:
+                    self._finish_streaming_entry()
+                    self._start_streaming_entry(ResponseEntryType.CHAT)
+                text = event.text
+                if self._streaming_length == 0:
+                    text = text.lstrip('\n')
+                self._append_streaming_content(text)
+                if self._streaming_has_text:
+                    self.notify_streaming_update()
+
+            elif event.event_type == MarkupEventType.FILE_START:
+                self._finish_streaming_entry()
+                # if there is an empty session context when embedded content is detected, delete it
+                self._remove_empty_response_entry()
+                filename = self._extract_filename_from_markup(event.text)
+                self._start_streaming_entry(ResponseEntryType.FILE, {"filename": filename, "type": event.embedded_type})
+
+            elif event.event_type == MarkupEventType.FILE_DATA:
+                self._append_streaming_content(event.text)
+                self.notify_streaming_update()
+
+            elif event.event_type == MarkupEventType.FILE_END:
+                self._finish_streaming_entry()
+                self.notify_streaming_update()
+                self._start_streaming_entry(ResponseEntryType.CHAT)
+
+    def _start_streaming_entry(self, entry_type: ResponseEntryType, metadata: Optional[Dict] = None):
+        with self._session_lock:
+            self._streaming_entry = None
+            self._streaming_chunks = []
+            self._streaming_length = 0
+            self._streaming_synced = 0
+            self._streaming_has_text = False
+            self.add_session_entry("System", "", entry_type=entry_type, metadata=metadata)
+            self._streaming_entry = self.session[-1]
+        self._response_session_entries.append(self._streaming_entry)
+
+    def _append_streaming_content(self, text: str):
+        # content is kept as a chunk list, the chunks are added to the entry when someone needs to look at it
+        if text:
+            with self._session_lock:
+                self._streaming_chunks.append(text)
+                if self._journal is not None and self._streaming_entry is not None:
+                    self._journal.append(self._streaming_entry, self._streaming_length, text)
+                self._streaming_length += len(text)
+            if not self._streaming_has_text and not text.isspace():
+                self._streaming_has_text = True
+
+    def _sync_streaming_entry(self):
+        # only the chunks added since the last sync are joined
+        with self._session_lock:
+            if self._streaming_entry is not None and self._streaming_synced < len(self._streaming_chunks):
+                new_chunks = self._streaming_chunks[self._streaming_synced:]
+                self._streaming_synced += len(new_chunks)
+                self._streaming_entry.content += "".join(new_chunks)
+                self._session_context.mark_dirty(self._streaming_entry)
+
+    def sync_session(self):
+        """
+        Brings the content of the entry being streamed up to date, it can be called from other threads, ie a save
+        Text the journal has written for the entry is in its content afterwards.
+        """
+        self._sync_streaming_entry()
+
+    def _finish_streaming_entry(self):
+        with self._session_lock:
+            self._sync_streaming_entry()
+            if self._journal is not None and self._streaming_entry is not None:
+                self._journal.finish_entry(self._streaming_entry)
+            self._streaming_entry = None
+            self._streaming_chunks = []
+            self._streaming_synced = 0
+
+    def _remove_empty_response_entry(self):
+        with self._session_lock:
+            if len(self.session) == 0 or not (str.isspace(self.session[-1].content) or len(self.session[-1].content) == 0):
+                return
+            entry = self.session.pop()
+            if self._journal is not None:
+                self._journal.remove_entry(entry)
+        if entry in self._response_session_entries:
+            self._response_session_entries.remove(entry)
+        self.notify_streaming_update()
 
     def _write_embedded_content(self, embedded_type: str, filename: str, content: str, task_context : TaskContext):
         filepath = os.path.join(task_context.project.local_git_path, filename)
@@ -327,6 +527,8 @@ class TaskNode_LLM(TaskNode):
             json_str = chunk[6:]
             try:
                 data = json.loads(json_str)
+                if data.get('usage'):
+                    self._record_openai_usage(data['usage'])
                 if 'choices' in data and len(data['choices']) > 0:
                     delta = data['choices'][0].get('delta', {})
                     return delta.get('content', '')
@@ -340,27 +542,112 @@ class TaskNode_LLM(TaskNode):
     def parse_anthropic_chunk(self, chunk: str) -> str:
         try:
             event = json.loads(chunk.strip('data: '))
-            if event['type'] == 'content_block_stop':
+            if event['type'] == 'message_stop':
                 self._stream_complete = True
                 return ""
             elif event['type'] == 'content_block_delta':
                 return event['delta']['text']
+            elif event['type'] == 'message_start':
+                self._record_anthropic_usage(event['message'].get('usage', {}))
+                return ""
+            elif event['type'] == 'message_delta':
+                # output_tokens is cumulative
+                self._record_anthropic_usage(event.get('usage', {}))
+                return ""
             elif event['type'] == 'error':
                 print(event['error'])
+                self._response_cacheable = False
                 self._stream_complete = True
                 return ""
             return ""
         except json.JSONDecodeError:
             pass  # Ignore non-JSON lines
 
+    def _record_openai_usage(self, usage: Dict):
+        if self._usage is None:
+            return
+        cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+        self._usage.input_tokens = usage.get('prompt_tokens', 0) - cached_tokens
+        self._usage.cache_read_tokens = cached_tokens
+        self._usage.output_tokens = usage.get('completion_tokens', 0)
+
+    def _record_anthropic_usage(self, usage: Dict):
+        if self._usage is None:
+            return
+        if 'input_tokens' in usage:
+            self._usage.input_tokens = usage['input_tokens']
+        if 'output_tokens' in usage:
+            self._usage.output_tokens = usage['output_tokens']
+        if usage.get('cache_read_input_tokens') is not None:
+            self._usage.cache_read_tokens = usage['cache_read_input_tokens']
+        if usage.get('cache_creation_input_tokens') is not None:
+            self._usage.cache_write_tokens = usage['cache_creation_input_tokens']
+
+    def get_usage_summary(self) -> LLMUsageSummary:
+        return LLMUsageSummary(self.usage_history)
+
+    def get_last_usage(self) -> Optional[LLMUsage]:
+        return self.usage_history[-1] if len(self.usage_history) > 0 else None
+
     def _compose_final_prompt(self, task_context : TaskContext = None):
-        self._composed_prompt = self.get_session_context()
-        if len(self.inputs) > 0:
-            self._composed_prompt += "/n"
-            self._composed_prompt += self.get_inputs_context(task_context)
+        # everything but the new turn is rebuilt identically on every request, so provider prompt caches can hit
+        self._context_manifest = ContextManifest()
+        if self._instruction_manifest is not None:
+            self._context_manifest.merge(self._instruction_manifest)
+
+        system_blocks, messages = self.get_session_messages()
+
+        new_turn = []
+        if len(self.inputs) > 0 and task_context is not None:
+            new_turn.append(self.get_inputs_context(task_context))
         if len(self.prompt) > 0:
-            self._composed_prompt += "/n"
-            self._composed_prompt += self.prompt
+            new_turn.append(self.prompt)
+        self._composed_new_turn = "\n".join(new_turn)
+
+        self._compose_messages(system_blocks, messages)
+
+    def _compose_messages(self, system_blocks: List[str], messages: List[Dict]):
+        self._composed_system, self._composed_messages = system_blocks, messages
+        if len(self._composed_new_turn) > 0:
+            Append_Message(self._composed_messages, "user", self._composed_new_turn)
+
+        if len(self._composed_messages) > 0 and self._composed_messages[-1]["role"] != "user":
+            Append_Message(self._composed_messages, "user", SESSION_CONTINUE_PROMPT)
+        elif len(self._composed_messages) == 0 and len(self._composed_system) > 0:
+            Append_Message(self._composed_messages, "user", SESSION_START_PROMPT)
+
+        flattened = [f"system: {block}" for block in self._composed_system]
+        flattened += [f"{message['role']}: " + "\n".join(message['content']) for message in self._composed_messages]
+        self._composed_prompt = "\n".join(flattened)
+
+    def get_session_messages(self):
+        """
+        The session as system instruction blocks and alternating user/assistant messages, see SessionContextBuilder
+        Instructions before the first conversation entry are the system prompt, later ones are part of a user turn
+        """
+        self._session_context.sync(self.session, self._session_filter_callback)
+        return list(self._session_context.system_blocks), self._session_context.get_messages()
+
+    def _get_openai_messages(self) -> List[Dict]:
+        # openai caches any repeated prefix automatically, the system message has to stay first and unchanged
+        messages = []
+        if len(self._composed_system) > 0:
+            messages.append({"role": "system", "content": "\n".join(self._composed_system)})
+        messages.extend({"role": message["role"], "content": "\n".join(message["content"])} for message in self._composed_messages)
+        return messages
+
+    def _get_anthropic_system(self) -> List[Dict]:
+        system = [{"type": "text", "text": block} for block in self._composed_system]
+        system[-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL
+        return system
+
+    def _get_anthropic_messages(self) -> List[Dict]:
+        messages = [{"role": message["role"], "content": [{"type": "text", "text": part} for part in message["content"]]} for message in self._composed_messages]
+        # the new turn writes the cache for the next request, the previous user turn reads what the last request wrote
+        user_indices = [index for index, message in enumerate(messages) if message["role"] == "user"]
+        for index in user_indices[-2:]:
+            messages[index]["content"][-1]["cache_control"] = ANTHROPIC_CACHE_CONTROL
+        return messages
 
     def _handle_response_ebedded_files(self, task_context : TaskContext):
         # deal with any files that were embedded in the response
@@ -377,59 +664,201 @@ class TaskNode_LLM(TaskNode):
                 self.output.append(asset_path)  
 
     def execute(self, task_context : TaskContext):
+        # synchronous entry point, blocks the caller until the request completes on the runtime
+        ASYNC_RUNTIME.run(self.execute_async(task_context))
+
+    async def execute_async(self, task_context : TaskContext):
+        self.prepare_request(task_context)
+        try:
+            await self._async_execute()
+            self.complete_request(task_context)
+        except LLMError as e:
+            self.set_state(TaskNodeState.Error)
+            self.error_message = str(e)
+            if e.details:
+                print(f"Error details: {e.details}")
+        except asyncio.CancelledError:
+            self.set_state(TaskNodeState.Error)
+            self.error_message = "[execute]Cancelled"
+            raise
+        except Exception as e:
+            self.set_state(TaskNodeState.Error)
+            self.error_message = f"[execute]Unexpected error: {str(e)}"
+            print(self.error_message)
+            raise LLMError(self.error_message) 
+
+    def prepare_request(self, task_context : TaskContext):
         self.set_state(TaskNodeState.Executing)
         self.error_message = None
+        self._stop_response = False
+        self._set_schedule_key(task_context)
 
         # clear the session
-        self.session = []
+        with self._session_lock:
+            self.session = []
+            if self._journal is not None:
+                self._journal.clear()
 
-        # add the additional prompt tags
+        # add the additional prompt tags, the most specific prompts first if they don't all fit
+        self._instruction_manifest = None
         if len(self.additional_prompt_tags) > 0:
             prompts = Globals.find_prompts(self.additional_prompt_tags)
-            for prompt in prompts:
-                self.add_session_entry("System", prompt.prompt, entry_type=ResponseEntryType.INSTRUCTION)
-
-        # TODO: try to just call request_llm_response_async
+            blocks = [ContextBlock(prompt.summary, prompt.prompt, PRIORITY_INSTRUCTION + len(prompt.tags), kind="instruction") for prompt in prompts]
+            budget = int(Get_Model_Context_Budget(self.llm_model) * MAX_INSTRUCTION_BUDGET_FRACTION)
+            packed, self._instruction_manifest = GLOBAL_CONTEXT_PACKER.pack(blocks, budget)
+            for block in packed:
+                self.add_session_entry("System", block.text, entry_type=ResponseEntryType.INSTRUCTION)
 
         # build the promp to submit with all the required data
         self._compose_final_prompt(task_context)
 
-        try:
-            asyncio.run(self._async_execute())
-            if len(self.response_variable_stack_name) > 0:
-                task_context.variable_stack[self.response_variable_stack_name] = self._full_response
-                
-            self._handle_response_ebedded_files(task_context)
-
-            self.set_state(TaskNodeState.Complete)
-        except LLMError as e:
+    def complete_request(self, task_context : TaskContext):
+        if len(self.response_variable_stack_name) > 0:
+            task_context.variable_stack[self.response_variable_stack_name] = self._full_response
+            
+        self._handle_response_ebedded_files(task_context)
+
+        self.set_state(TaskNodeState.Complete)
+
+    async def complete_batch_request(self, task_context : TaskContext, result: Dict):
+        """
+        Finish a request that was submitted through LLMBatchRunner
+        "result" holds either "text" and "usage" (the provider's usage block) or "error"
+        The text goes through the same parser and embedded file handling as a streamed response
+        """
+        if "error" in result:
             self.set_state(TaskNodeState.Error)
-            self.error_message = str(e)
-            if e.details:
-                print(f"Error details: {e.details}")
+            self.error_message = f"[batch]{result['error']}"
+            print(self.error_message)
+            return
+
+        self._usage = LLMUsage(self._get_model_name())
+        self._usage.node_name = self.name
+        self._usage.start()
+        try:
+            if Get_Model_Interface(self.llm_model) == LLM_Interface.OpenAI:
+                self._record_openai_usage(result.get("usage") or {})
+            else:
+                self._record_anthropic_usage(result.get("usage") or {})
+            await self.process_stream(self._replay_stream([result["text"]]), parse_chunk=lambda text: text)
+            self.complete_request(task_context)
         except Exception as e:
             self.set_state(TaskNodeState.Error)
-            self.error_message = f"[execute]Unexpected error: {str(e)}"
+            self.error_message = f"[batch]Unexpected error: {str(e)}"
             print(self.error_message)
-            raise LLMError(self.error_message) 
+        finally:
+            self._usage.finish()
+            self._usage.cost *= BATCH_PRICE_MULTIPLIER
+            self.usage_history.append(self._usage)
+            self._usage = None
+            self.notify_streaming_update()
 
     def get_error_info(self) -> Optional[str]:
         if self.state == TaskNodeState.Error and self.error_message:
             return f"Error in {self.llm_model} request: {self.error_message}"
         return None
 
+    async def reduce_context(self):
+        """
+        If the composed prompt is over the budget for llm_model, recompose it from a reduced copy of the session,
+        see ContextReducer. The session itself is left as is, only what is sent changes.
+        """
+        if not self.use_context_reduction or estimate_tokens(self._composed_prompt) <= Get_Model_Context_Budget(self.llm_model):
+            return
+
+        entries = self._session_context.get_included_entries()
+        # the new turn is sent whatever happens, the instructions are in "entries" and counted by the reducer,
+        # which never drops them, so they aren't taken off the budget here as well
+        budget = max(0, Get_Model_Context_Budget(self.llm_model) - estimate_tokens(self._composed_new_turn))
+        reduced = await GLOBAL_CONTEXT_REDUCER.reduce(entries, budget, self._summarize)
+
+        # the reduced entries already passed the filter
+        reduced_context = SessionContextBuilder()
+        reduced_context.sync(reduced)
+        self._compose_messages(list(reduced_context.system_blocks), reduced_context.get_messages())
+
+    async def _summarize(self, text: str) -> str:
+        summary_node = TaskNode_LLM()
+        summary_node.name = f"{self.name}[context_reduction]"
+        summary_node.llm_model = self.context_summary_model
+        summary_node.llm_base_url_override = self.llm_base_url_override
+        summary_node.use_context_reduction = False
+        summary_node._schedule_key = self._schedule_key
+        summary_node.prompt = text
+        summary_node._compose_final_prompt()
+        try:
+            await summary_node._async_execute()
+        finally:
+            # the summary is billed to this node
+            self.usage_history.extend(summary_node.usage_history)
+        return summary_node._full_response.strip()
+
     async def _async_execute(self):
+        await self.reduce_context()
+
+        self._usage = LLMUsage(self._get_model_name())
+        self._usage.node_name = self.name
+        self._usage.start()
+        try:
+            await self._async_execute_request()
+        finally:
+            self._usage.finish()
+            self.usage_history.append(self._usage)
+            self._usage = None
+            # let the session view pick up the new totals
+            self.notify_streaming_update()
+
+    async def _async_execute_request(self):
+        cache_key = None
+        if self.use_response_cache:
+            cache_key = self._get_response_cache_key()
+            cached_response = await asyncio.to_thread(GLOBAL_RESPONSE_CACHE.get, cache_key)
+            if cached_response:
+                self._usage.response_cache_hit = True
+                # replay through process_stream so the session/ui behave as if it was a live response
+                await self.process_stream(self._replay_stream(cached_response["stream"]))
+                return
+
+        self._response_cacheable = True
+        recorded_stream = []
         stream = self.make_request()
+        if cache_key:
+            stream = self._record_stream(stream, recorded_stream)
         await self.process_stream(stream)
 
+        if cache_key and self._response_cacheable and not self._stop_response:
+            entries = [entry.to_dict() for entry in self._response_session_entries]
+            await asyncio.to_thread(GLOBAL_RESPONSE_CACHE.put, cache_key, recorded_stream, entries)
+
+    def _get_model_name(self) -> str:
+        return self.llm_model_name_override if len(self.llm_model_name_override) > 0 else model_names[self.llm_model]
+
+    def _get_response_cache_key(self) -> str:
+        model_name = self._get_model_name()
+        # the server is part of the key so responses from a mock server never replay against a real provider
+        return GLOBAL_RESPONSE_CACHE.make_key(f"{LLM_Model(self.llm_model).value}@{self._get_base_url()}", model_name, self._composed_prompt)
+
+    async def _record_stream(self, stream: AsyncGenerator[str, None], recorded_stream: List[str]) -> AsyncGenerator[str, None]:
+        async for raw_data in stream:
+            recorded_stream.append(raw_data)
+            yield raw_data
+
+    async def _replay_stream(self, recorded_stream: List[str]) -> AsyncGenerator[str, None]:
+        for raw_data in recorded_stream:
+            yield raw_data
+            # let other tasks on the runtime run between chunks
+            await asyncio.sleep(0)
+
     async def request_llm_response_async(self, task_context : TaskContext = None):
         async with self._lock:
+            self._set_schedule_key(task_context)
 
             while(True):
                 self._compose_final_prompt(task_context)
 
                 await self._async_execute()
 
+                continue_session = False
                 if self._session_callback:
                     continue_session = await asyncio.to_thread(self._session_callback, self._response_session_entries)
                 if not continue_session:
@@ -443,42 +872,72 @@ class TaskNode_LLM(TaskNode):
             #raise LLMError("A request is already in progress. Please wait for it to complete.")
             return
 
-        def run_in_thread():
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+        async def run_request():
             try:
-                return loop.run_until_complete(self.request_llm_response_async(task_context))
+                await self.request_llm_response_async(task_context)
+            except asyncio.CancelledError:
+                raise
             except Exception as e:
                 self.set_state(TaskNodeState.Error)
                 self.error_message = f"[request_llm_response] Unexpected error: {str(e)}"
                 print(self.error_message)
                 raise LLMError(self.error_message)
-            finally:
-                loop.close()
 
-        self._running_task = GLOBAL_EXECUTOR.submit(run_in_thread)
+        self._stop_response = False
+        self._running_task = ASYNC_RUNTIME.submit(run_request())
+
+    def cancel_request(self):
+        # stop streaming and cancel the running request, if any
+        self._stop_response = True
+        if self._running_task and not self._running_task.done():
+            self._running_task.cancel()
 
     def get_session_context(self) -> str:
-        #return "\n".join([f"{entry.sender}: {entry.content}" for entry in self.session if entry.include_in_context])
-        session_context = ""
-        for entry in self.session:
-            filter = False
-            if self._session_filter_callback:
-                filter = self._session_filter_callback(entry)
-            if entry.include_in_context and not filter:
-                session_context += f"{entry.sender}: {entry.content}\n"
-        return session_context
+        self._session_context.sync(self.session, self._session_filter_callback)
+        return "".join(f"{entry.sender}: {entry.content}\n" for entry in self._session_context.get_included_entries())
     
     def get_inputs_context(self, task_context : TaskContext = None) -> str:
+        """
+        The resolved inputs, packed with the session into the model's context budget, see ContextPacker
+        Inputs that had to be truncated or dropped are listed at the end so the model knows what it is missing
+        """
         input_context = ""
         if task_context != None:
             input_context = "=================================="
             input_context += "input key values from task_context"
             input_context += "=================================="
-            resolved_inputs = llm_input_context_resolver(self.inputs, task_context)
-            for resolved_input in resolved_inputs:              
-                input_context += resolved_input 
-        return input_context                            
+
+            # the session is only counted here, ContextReducer shrinks it when it is over budget
+            self._session_context.sync(self.session, self._session_filter_callback)
+            session_tokens = sum(estimate_tokens(Get_Entry_Response_Text(entry)) for entry in self._session_context.get_included_entries())
+            blocks = []
+            for input in self.inputs:
+                text = "".join(llm_input_context_resolver([input], task_context))
+                blocks.append(ContextBlock(input, text, self.input_priorities.get(input, PRIORITY_INPUT), self._get_input_truncation(input)))
+
+            # what the session leaves, but at least the share kept for inputs, and never more than the model has
+            total_budget = Get_Model_Context_Budget(self.llm_model)
+            available = max(0, total_budget - estimate_tokens(self.prompt))
+            budget = min(available, max(available - session_tokens, int(total_budget * MIN_INPUT_BUDGET_FRACTION)))
+            packed, manifest = GLOBAL_CONTEXT_PACKER.pack(blocks, budget, self.prompt)
+            self._context_manifest.merge(manifest)
+            if manifest.has_omissions():
+                print(f"{self.name} context packing: {manifest}")
+
+            for block in packed:
+                if block.kind == "input":
+                    input_context += block.text
+            if manifest.has_omissions():
+                input_context += f"\n({manifest.get_omission_note()})"
+        return input_context
+
+    def _get_input_truncation(self, input: str) -> TruncatePolicy:
+        if input in self.input_truncation:
+            return TruncatePolicy(self.input_truncation[input])
+        return TruncatePolicy.TopN if input.startswith(ASSET_PREFIX) else TruncatePolicy.Head
+
+    def get_context_manifest(self) -> ContextManifest:
+        return self._context_manifest
     
 class TaskNode_Disaggregator(TaskNode_LLM):
     """
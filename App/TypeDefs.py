@@ -1,7 +1,11 @@
+import uuid
 from datetime import datetime
 from typing import Any, Dict, List, Optional
 from enum import Enum
 from Serializable import ISerializable
+from CompiledGraph import CompiledGraph, NO_NODE, Get_Graph_Edits
+from ProjectFileCache import ProjectFileCache
+from VariableStack import VariableStack
 
 class TaskNodeState(str,Enum):
     Queued = 0
@@ -24,66 +28,133 @@ class SessionEntry(ISerializable):
         self.time_stamp = datetime.now()
         self.include_in_context = True
         self.include_in_display = True
+        # identifies the entry in a SessionJournal
+        self.entry_id = uuid.uuid4().hex
 
 class TaskContext(ISerializable):
     """
     The "TaskContext" is a container for the current state of the task graph execution
-    "node_stack" is a list of indexes that represent the current node in the task graph
-    "variable_stack" is a dictionary of variables that in scoped 
+    "node_stack" is a list of indexes that represent the current node in the task graph, the child index at each level from the root down
+    "variable_stack" is a dictionary of variables that in scoped, a VariableStack of copy on write frames, one per node scope
+    Lookups go through a CompiledGraph of the task graph, the current node is kept as an index into it alongside node_stack
     """    
     def __init__(self, project: 'Project'=None, task: 'Task'=None):
         self.project: 'Project' = project
         self.task: 'Task' = task
         self.node_stack: List[int] = []
-        self.variable_stack: Dict[str, Any] = {} # node scoped varaible stack
+        self.variable_stack: VariableStack = VariableStack() # node scoped varaible stack
+        self._graph: Optional[CompiledGraph] = None
+        self._cursor: int = NO_NODE
+        self._cursor_stack: Optional[List[int]] = None # the node_stack list _cursor was computed for
+        self._file_cache = ProjectFileCache()
 
     _exclude_from_properties = ['project', 'task']
     _readonly_properties = ['node_stack', 'variable_stack']
     _exclude_from_usd = ['project', 'task']
     _exclude_from_json = ['project', 'task']
 
-    # because the node stack is a list of indexes, we need to walk the graph to get the current node
+    def to_dict(self) -> Dict[str, Any]:
+        data = super().to_dict()
+        data['variable_stack'] = self.variable_stack.to_dict()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> 'TaskContext':
+        instance = super().from_dict(data)
+        if not isinstance(instance.variable_stack, VariableStack):
+            instance.variable_stack = VariableStack(instance.variable_stack)
+        return instance
+
+    def get_graph(self) -> CompiledGraph:
+        # compiled the first time it's needed after the task's graph is loaded, generated or edited
+        root = self.task.task_graph_root
+        if self._graph is None or self._graph.root is not root or self._graph.edits != Get_Graph_Edits():
+            self._graph = CompiledGraph(root)
+            self._cursor = NO_NODE
+        return self._graph
+
+    def invalidate_graph(self):
+        # the graph is compiled again when next needed, edits through TaskNode.add_child do this for every context
+        self._graph = None
+
+    def _get_cursor(self) -> int:
+        graph = self.get_graph()
+        cursor = self._cursor
+        # node_stack is loaded with the project and can be replaced or popped from outside, resync when it was
+        if (cursor == NO_NODE or self.node_stack is not self._cursor_stack or graph.depth[cursor] != len(self.node_stack)
+                or (cursor > 0 and graph.child_index[cursor] != self.node_stack[-1])):
+            cursor = graph.get_index_from_stack(self.node_stack)
+            self._set_cursor(cursor)
+        return cursor
+
+    def _set_cursor(self, cursor: int):
+        self._cursor = cursor
+        self._cursor_stack = self.node_stack
+
+    def set_node_stack(self, node_stack: List[int]):
+        self.node_stack = list(node_stack)
+
+    def fork(self, node_stack: List[int]) -> 'TaskContext':
+        # a context for running one node on its own, with a branch of the variables, the compiled graph is shared
+        task_context = TaskContext(self.project, self.task)
+        task_context.node_stack = list(node_stack)
+        task_context.variable_stack = self.variable_stack.branch()
+        task_context._graph = self.get_graph()
+        task_context._file_cache = self._file_cache
+        return task_context
+
+    def get_file_cache(self) -> ProjectFileCache:
+        # project files read by inputs, shared with forked contexts
+        return self._file_cache
+
+    def get_current_index(self) -> int:
+        # the current node's index in get_graph()
+        return self._get_cursor()
+
     def get_current_node(self):# -> TaskNode:
-        result = self.task.task_graph_root
-        for node_index in reversed(self.node_stack):
-            result = result.children[node_index]
-        return result
+        graph = self.get_graph()
+        if len(graph) == 0:
+            return None
+        return graph.nodes[self._get_cursor()]
     
     def get_node(self, node_stack: List[int]):
-        result = self.task.task_graph_root
-        for node_index in reversed(node_stack):
-            result = result.children[node_index]
-        return result
+        graph = self.get_graph()
+        if len(graph) == 0:
+            return None
+        return graph.nodes[graph.get_index_from_stack(node_stack)]
 
-    # this function will advance the node stack to the next node
+    # this function will advance the node stack to the next node, depth first
     def advance_node(self) -> bool:
-        if len(self.node_stack) >= 0:
-            current_node = self.get_current_node()
-            if len(current_node.children):
-                self.node_stack.append(0)
+        graph = self.get_graph()
+        if len(graph) == 0:
+            return False
+        cursor = self._get_cursor()
+        if graph.first_child[cursor] != NO_NODE:
+            self.node_stack.append(0)
+            self._set_cursor(graph.first_child[cursor])
+            return True
+        while cursor != 0:
+            self.node_stack.pop()
+            sibling = graph.next_sibling[cursor]
+            if sibling != NO_NODE:
+                self.node_stack.append(graph.child_index[sibling])
+                self._set_cursor(sibling)
+                # Ensure scoped_variables is empty
+                self.release_node_variables(graph.nodes[sibling])
                 return True
-            while(len(self.node_stack) > 0):
-                current_node = self.get_current_node()
-                child_index = self.node_stack.pop()
-                parent_node = self.get_current_node()
-                if (child_index+1) < len(parent_node.children):
-                    child_index += 1
-                    self.node_stack.append(child_index)
-                    # Ensure scoped_variables is empty
-                    new_node = self.get_current_node()
-                    new_node.scoped_variables.clear() 
-                    return True
-                else:
-                    # Clear variables owned by this node
-                    self.clear_node_variables(current_node)
+            # Clear variables owned by this node
+            self.clear_node_variables(graph.nodes[cursor])
+            cursor = graph.parent[cursor]
+        self._set_cursor(0)
         return False
 
     def set_variable(self, name: str, value: Any):
         current_node = self.get_current_node()
         if current_node:
-            if name not in self.variable_stack:
+            if self.variable_stack.set_scoped(name, value, current_node):
                 current_node.scoped_variables.append(name)
-        self.variable_stack[name] = value
+        else:
+            self.variable_stack[name] = value
 
     def get_variable(self, name: str) -> Any:
         if name in self.variable_stack:
@@ -91,7 +162,10 @@ class TaskContext(ISerializable):
         raise KeyError(f"Variable '{name}' not found")
 
     def clear_node_variables(self, node):# : TaskNode):
-        for var_name in node.scoped_variables:
-            if var_name in self.variable_stack:
-                del self.variable_stack[var_name]
+        self.variable_stack.pop_scope(node)
+        node.scoped_variables.clear()
+
+    def release_node_variables(self, node):# : TaskNode):
+        # the node no longer owns its variables, they stay set
+        self.variable_stack.release_scope(node)
         node.scoped_variables.clear()            
\ No newline at end of file
@@ -0,0 +1,67 @@
+import threading
+import time
+from typing import Callable, Dict
+
+from AsyncRuntime import ASYNC_RUNTIME
+
+STREAMING_UPDATES_PER_SECOND = 30
+
+class UpdateCoalescer:
+    """
+    Merges bursts of "something changed" notifications into at most "max_rate" deliveries per second
+    The first notification after a quiet period is delivered immediately, the rest are held and delivered
+    once by a timer on the ASYNC_RUNTIME loop. flush() delivers anything still pending, ie at the end of a stream.
+    mark_dirty() can be called from any thread, "deliver" is called on whichever thread triggers it.
+    """
+    def __init__(self, deliver: Callable[[], None], max_rate: float = STREAMING_UPDATES_PER_SECOND):
+        self._deliver = deliver
+        self._interval = 1.0 / max_rate if max_rate > 0 else 0.0
+        self._lock = threading.Lock()
+        self._last_delivery = 0.0
+        self._pending = False
+        self._timer_scheduled = False
+        self.requested = 0
+        self.delivered = 0
+
+    def mark_dirty(self):
+        deliver_now = False
+        with self._lock:
+            self.requested += 1
+            delay = self._interval - (time.monotonic() - self._last_delivery)
+            if delay <= 0 and not self._timer_scheduled:
+                deliver_now = True
+            else:
+                self._pending = True
+                if not self._timer_scheduled:
+                    self._timer_scheduled = True
+                    loop = ASYNC_RUNTIME.loop
+                    loop.call_soon_threadsafe(loop.call_later, max(delay, 0.0), self._on_timer)
+        if deliver_now:
+            self._do_deliver()
+
+    def flush(self):
+        with self._lock:
+            pending = self._pending
+        if pending:
+            self._do_deliver()
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer_scheduled = False
+        self.flush()
+
+    def _do_deliver(self):
+        with self._lock:
+            self._pending = False
+            self._last_delivery = time.monotonic()
+            self.delivered += 1
+        self._deliver()
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"requested": self.requested, "delivered": self.delivered, "merged": self.requested - self.delivered}
+
+    def reset_stats(self):
+        with self._lock:
+            self.requested = 0
+            self.delivered = 0
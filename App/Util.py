@@ -18,8 +18,7 @@ def load_project_file(asset_path : str, task_context : TaskContext,) -> str :
     filepath = resolve_project_asset_path(asset_path, task_context)
     if not os.path.isfile(filepath):
         raise Exception(f"File not found: {filepath}")
-    with open(filepath, 'r') as file:
-        return file.read()
+    return task_context.get_file_cache().read(filepath)
     
 def is_node_output_reference(input : str) -> bool :    
     return input.startswith(NODE_OUTPUT_PREFIX)
@@ -29,39 +28,13 @@ def get_node_output(input : str, task_context : TaskContext) -> List[str] :
     # a node reference can look like this: "node_output://TaskNode1"
     # or this: "node_output://task1/TaskNode1"
     # or this: "node_output://../TaskNode1"
-    
-    # for each ../ in the path, pop the last node off the stack
-    # only allow the leading ../ to pop nodes off the stack, at any other point in the path, is an error
-    node_stack = task_context.node_stack
-    node_stack.pop()# pop to start at the parent of the current node
-    path_parts = node_path.split('/')
-    pop_count = 0
-    for part in path_parts:
-        if part == "..":
-            if len(node_stack) > 0:
-                node_stack.pop()
-                pop_count += 1
-            else:
-                raise Exception(f"Invalid node path: {node_path}")
-        else:
-            break
-    
-    # remove the path parts that were popped off the stack
-    path_parts = path_parts[pop_count:]
-
-    # now get the node from the path and find the node that matches by name
-    search_node = task_context.get_node(node_stack)
-    for search_name in path_parts:
-        found = False
-        for child in search_node.children:
-            if child.name == search_name:
-                search_node = child
-                found = True
-                break
-        if not found:
-            raise Exception(f"Node not found: {search_name}")
-        
-    return search_node.output
+    # names are looked up from the parent of the current node, only leading ../ go up a level, see CompiledGraph.resolve_reference
+    graph = task_context.get_graph()
+    return graph.nodes[graph.resolve_reference(task_context.get_current_index(), node_path)].output
+
+def validate_node_output_references(task_context : TaskContext) -> List[str] :
+    # a message for every node_output:// input in the task graph that doesn't resolve
+    return task_context.get_graph().validate_references(NODE_OUTPUT_PREFIX)
 
 def resolve_context_input( input: str, task_context : TaskContext) -> Any : 
     # This function should be used by TaskNodes to resolve context input values
@@ -84,25 +57,20 @@ def resolve_context_input( input: str, task_context : TaskContext) -> Any :
     return value
 
 def llm_input_context_resolver( inputs: List[str], task_context : TaskContext) -> List[str] : 
+    # one tagged block per input, or per output of a referenced node, project files come from the context's file cache
     context = []
     for input in inputs:
-        value = resolve_context_input(input, task_context)
-        context.append(str(value))
         if is_project_file_reference(input, task_context):
             value = load_project_file(input, task_context)
-            value_context = f"<project_file {input}>{value}</project_file>"
-            context.append(value_context)            
+            context.append(f"<project_file {input}>{value}</project_file>")
         elif is_node_output_reference(input):
-            node_output_list = get_node_output(input, task_context)
-            for output in node_output_list:
-                value = llm_input_context_resolver(output, task_context)
-                value_context = f"<node_output node={input} output={output}>{value}</node_output>"
-                context.append(value_context)
+            for output in get_node_output(input, task_context):
+                value = resolve_context_input(output, task_context)
+                context.append(f"<node_output node={input} output={output}>{value}</node_output>")
         elif input in task_context.variable_stack:
             # add the input key and value to the input context
             value = task_context.variable_stack[input]
-            value_context = f"<input {input}>{value}</input>"
-            context.append(value_context)
+            context.append(f"<input {input}>{value}</input>")
         else:
             raise Exception(f"failed to resolve input {input}")
     return context
@@ -0,0 +1,161 @@
+from collections.abc import MutableMapping
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+class VariableFrame:
+    """
+    The variables owned by one scope, "owner" is the TaskNode that set them, None for the unscoped frame at the bottom
+    A frame shared by more than one VariableStack is frozen and copied by whichever stack writes to it first.
+    """
+    __slots__ = ('owner', 'values', 'frozen')
+
+    def __init__(self, owner: Any = None, values: Optional[Dict[str, Any]] = None):
+        self.owner = owner
+        self.values: Dict[str, Any] = values if values is not None else {}
+        self.frozen = False
+
+    def copy(self) -> 'VariableFrame':
+        # shallow, the values themselves (ie large llm responses) are shared
+        return VariableFrame(self.owner, dict(self.values))
+
+class VariableStack(MutableMapping):
+    """
+    The TaskContext variables as a chain of copy on write frames, used like a dict
+    A name lives in exactly one frame. Setting a name that exists updates it where it is, new names set with [] go in
+    the unscoped bottom frame and new names set with set_scoped() go in the frame of the node that owns them.
+    push()/pop_scope() add and drop a node's frame, dropping its variables with it, release_scope() keeps them unscoped.
+    snapshot() and branch() share the frames instead of copying them, a frame is copied the first time either side
+    writes to it, so rewinding to a snapshot or running sibling branches on their own views doesn't copy the values.
+    get_changes()/apply_changes() carry what a branch did back to the stack it came from.
+    Serializes as the flat {name: value} dict it replaced.
+    """
+    def __init__(self, values: Optional[Dict[str, Any]] = None):
+        self._frames: List[VariableFrame] = [VariableFrame(None, dict(values) if values else {})]
+
+    def _find(self, name: str) -> int:
+        for index in range(len(self._frames) - 1, -1, -1):
+            if name in self._frames[index].values:
+                return index
+        return -1
+
+    def _writable(self, index: int) -> VariableFrame:
+        frame = self._frames[index]
+        if frame.frozen:
+            frame = frame.copy()
+            self._frames[index] = frame
+        return frame
+
+    def __getitem__(self, name: str) -> Any:
+        index = self._find(name)
+        if index < 0:
+            raise KeyError(name)
+        return self._frames[index].values[name]
+
+    def __setitem__(self, name: str, value: Any):
+        index = self._find(name)
+        self._writable(index if index >= 0 else 0).values[name] = value
+
+    def __delitem__(self, name: str):
+        index = self._find(name)
+        if index < 0:
+            raise KeyError(name)
+        del self._writable(index).values[name]
+
+    def __contains__(self, name: object) -> bool:
+        return self._find(name) >= 0
+
+    def __iter__(self) -> Iterator[str]:
+        for frame in self._frames:
+            yield from list(frame.values)
+
+    def __len__(self) -> int:
+        return sum(len(frame.values) for frame in self._frames)
+
+    def __repr__(self) -> str:
+        return repr(self.to_dict())
+
+    def set_scoped(self, name: str, value: Any, owner: Any) -> bool:
+        # returns True if the name is new and now owned by "owner"
+        index = self._find(name)
+        if index >= 0:
+            self._writable(index).values[name] = value
+            return False
+        frame_index = self._find_scope(owner)
+        if frame_index < 0:
+            self.push(owner)
+            frame_index = len(self._frames) - 1
+        self._writable(frame_index).values[name] = value
+        return True
+
+    def _find_scope(self, owner: Any) -> int:
+        for index in range(len(self._frames) - 1, 0, -1):
+            if self._frames[index].owner is owner:
+                return index
+        return -1
+
+    def push(self, owner: Any):
+        self._frames.append(VariableFrame(owner))
+
+    def pop_scope(self, owner: Any):
+        # drops the frame owned by "owner" and its variables, usually the top frame
+        index = self._find_scope(owner)
+        if index > 0:
+            del self._frames[index]
+
+    def release_scope(self, owner: Any):
+        # moves the variables owned by "owner" to the unscoped frame, they outlive the node
+        index = self._find_scope(owner)
+        if index > 0:
+            values = self._frames[index].values
+            del self._frames[index]
+            if len(values) > 0:
+                self._writable(0).values.update(values)
+
+    def get_scope_names(self, owner: Any) -> List[str]:
+        index = self._find_scope(owner)
+        return list(self._frames[index].values) if index > 0 else []
+
+    def snapshot(self) -> 'VariableStack':
+        for frame in self._frames:
+            frame.frozen = True
+        stack = VariableStack.__new__(VariableStack)
+        stack._frames = list(self._frames)
+        return stack
+
+    def branch(self) -> 'VariableStack':
+        # an isolated view for a node running alongside others, same as a snapshot
+        return self.snapshot()
+
+    def get_changes(self, base: 'VariableStack') -> Tuple[Dict[str, Tuple[Any, Any]], List[str]]:
+        """
+        What was set ({name: (value, owner)}) and removed since "base", a snapshot this stack shares frames with
+        Frames both still share are unchanged and skipped, so this costs the size of the frames that were written to
+        """
+        shared = set(id(frame) for frame in base._frames) & set(id(frame) for frame in self._frames)
+        changed: Dict[str, Tuple[Any, Any]] = {}
+        for frame in self._frames:
+            if id(frame) in shared:
+                continue
+            for name, value in frame.values.items():
+                if base._find(name) < 0 or base[name] is not value:
+                    changed[name] = (value, frame.owner)
+        removed = []
+        for frame in base._frames:
+            if id(frame) in shared:
+                continue
+            removed.extend(name for name in frame.values if name not in self)
+        return changed, removed
+
+    def apply_changes(self, changed: Dict[str, Tuple[Any, Any]], removed: List[str]):
+        for name, (value, owner) in changed.items():
+            if owner is None:
+                self[name] = value
+            else:
+                self.set_scoped(name, value, owner)
+        for name in removed:
+            self.pop(name, None)
+
+    def to_dict(self) -> Dict[str, Any]:
+        values = {}
+        for frame in self._frames:
+            values.update(frame.values)
+        return values
@@ -55,6 +55,7 @@ class ProjectTreeWidget(QTreeWidget):
         self.reset_icon = QIcon("icons/control/rewind.svg")
         self.itemChanged.connect(self.on_item_changed)
         self.itemClicked.connect(self.on_item_clicked)
+        self.itemExpanded.connect(self.on_item_expanded)
         self.setEditTriggers(QTreeWidget.SelectedClicked | QTreeWidget.EditKeyPressed)
         self.setStyleSheet("""
             QTreeWidget {
@@ -76,6 +77,12 @@ class ProjectTreeWidget(QTreeWidget):
         # Connect the new signal to the refresh slot
         self._refresh_taskgraph_requested.connect(self._refresh_taskgraph)
         
+    def on_rewind_tasknode_button(self, tasknode_item):
+        # the whole graph goes back to the start, nodes that haven't changed are restored from node_results on replay
+        task = tasknode_item.data(0, Qt.UserRole+1)
+        task.ensure_loaded()
+        task.rewind_taskgraph()
+
     def add_project_buttons(self, project_item):
         button_widget = QWidget()
         button_layout = QHBoxLayout(button_widget)
@@ -115,7 +122,14 @@ class ProjectTreeWidget(QTreeWidget):
             self.add_task_item(project_item, task)
         if ENABLE_NEW_TASK_TEXT_FIELD:            
             self.add_new_task_field(project_item)
+        # tasks that aren't loaded stay collapsed, they load when expanded
+        self._updating += 1
         self.expandAll()
+        for i in range(project_item.childCount()):
+            task = project_item.child(i).data(0, Qt.UserRole)
+            if isinstance(task, Task) and not task.is_loaded():
+                project_item.child(i).setExpanded(False)
+        self._updating -= 1
         
         # Add the project to the global list
         Globals.add_project(project)
@@ -168,9 +182,25 @@ class ProjectTreeWidget(QTreeWidget):
         # Add task graphs to the task item
         if task.task_graph_root:
             self.add_task_node_item(task, task_item, task.task_graph_root)        
+        self.update_task_item_indicator(task_item, task)
 
         return task_item
 
+    def update_task_item_indicator(self, task_item, task: Task):
+        # a task that isn't loaded doesn't know if it has a graph yet, show it as expandable
+        if task.is_loaded():
+            task_item.setChildIndicatorPolicy(QTreeWidgetItem.DontShowIndicatorWhenChildless)
+        else:
+            task_item.setChildIndicatorPolicy(QTreeWidgetItem.ShowIndicator)
+            task_item.setExpanded(False)
+
+    def on_item_expanded(self, item: QTreeWidgetItem):
+        if self._updating == 0:
+            task = item.data(0, Qt.UserRole)
+            if isinstance(task, Task) and not task.is_loaded():
+                task.ensure_loaded()
+                self._refresh_taskgraph(task)
+
     def add_task_node_item(self, task, parent_item: Task, task_node: TaskNode):
         graph_item = QTreeWidgetItem(parent_item, [task_node.name])
         #graph_item.setIcon(0, self.task_graph_icon)
@@ -195,7 +225,7 @@ class ProjectTreeWidget(QTreeWidget):
         rewind_button = QPushButton(QIcon("icons/control/rewind.svg"), "")
         rewind_button.setFixedSize(TREEVIEW_ICON_SIZE, TREEVIEW_ICON_SIZE)
         rewind_button.setToolTip("Rewind Task")
-        #rewind_button.clicked.connect(lambda: self.on_rewind_task_button(tasknode_item))
+        rewind_button.clicked.connect(lambda: self.on_rewind_tasknode_button(tasknode_item))
         
         step_button = QPushButton(QIcon("icons/control/step.svg"), "")
         step_button.setFixedSize(TREEVIEW_ICON_SIZE, TREEVIEW_ICON_SIZE)
@@ -304,6 +334,8 @@ class ProjectTreeWidget(QTreeWidget):
 
     def on_task_action(self, task_item):
         task = task_item.data(0, Qt.UserRole)
+        # the task's state is changed below, a task that isn't loaded would get it back from the file when it is
+        task.ensure_loaded()
         if task.task_phase == 0:#only allow delete if the task has not started?
             reply = QMessageBox.question(self, 'Delete Task', 
                                          f"Are you sure you want to delete the task '{task.name}'?",
@@ -327,6 +359,7 @@ class ProjectTreeWidget(QTreeWidget):
                 reset_started = False
                 for task in project.tasks:
                     if reset_started or task == task_item.data(0, Qt.UserRole):
+                        task.ensure_loaded()
                         task.task_phase = 0
                         reset_started = True
                 
@@ -365,6 +398,9 @@ class ProjectTreeWidget(QTreeWidget):
             self.add_task_node_item(task, task_item, task.task_graph_root)
             task_item.setExpanded(True)  # Expand the root task node
 
+        self._updating += 1
+        self.update_task_item_indicator(task_item, task)
+        self._updating -= 1
         self.update_task_item(task_item)
 
     def resizeEvent(self, event):
@@ -533,13 +569,20 @@ class SessionWidget(QWidget):
         input_layout.addWidget(self.input_area)
         input_layout.addWidget(self.send_button)
 
+        # token/cost totals for the node shown in this session
+        self.usage_label = QLabel("")
+        self.usage_label.setStyleSheet("color: #808080;")
+
         self.layout.addWidget(self.scroll_area)
+        self.layout.addWidget(self.usage_label)
         self.layout.addLayout(input_layout)
 
         self.view_model = None
 
     def set_task(self, task: Task):
         self._task = task
+        if task is not None:
+            task.ensure_loaded()
         if task is None or task.LLM_interface is None:
             self.set_view_model(None)
         else:
@@ -581,21 +624,42 @@ class SessionWidget(QWidget):
                     entry_widget = SessionEntryWidget(entry)
                     self.scroll_layout.addWidget(entry_widget)
 
+        self.update_usage_label()
         #
         self.scroll_to_bottom()
 
+    def update_usage_label(self):
+        if self.view_model and len(self.view_model.task_node_llm.usage_history) > 0:
+            self.usage_label.setText(str(self.view_model.task_node_llm.get_usage_summary()))
+        else:
+            self.usage_label.setText("")
+
     def streaming_update(self):
-        num_session_entries = len(self.view_model.get_entries())
+        """
+        updates are coalesced upstream, so entries may have been added and removed since the last one, ie the empty
+        chat entry replaced by a file entry, the widgets are kept up to the first one whose entry is gone
+        """
+        entries = [entry for entry in self.view_model.get_entries() if DEBUG_ALL_PROMPTS or entry.include_in_display]
         num_ui_entries = self.scroll_layout.count()
-        if num_ui_entries > 0 and num_ui_entries == num_session_entries:
-            last_widget = self.scroll_layout.itemAt(num_ui_entries-1).widget()
-            last_widget.RefreshContent()
-        elif num_ui_entries == num_session_entries-1:
-            entry = self.view_model.get_entries()[-1]
+        num_kept = 0
+        while num_kept < num_ui_entries and num_kept < len(entries):
+            widget = self.scroll_layout.itemAt(num_kept).widget()
+            if widget is None or widget.session_entry is not entries[num_kept]:
+                break
+            num_kept += 1
+
+        for i in reversed(range(num_kept, num_ui_entries)):
+            widget = self.scroll_layout.itemAt(i).widget()
+            if widget:
+                self.scroll_layout.removeWidget(widget)
+                widget.deleteLater()
+        if num_kept > 0:
+            # the last kept entry may still be streaming
+            self.scroll_layout.itemAt(num_kept-1).widget().RefreshContent()
+        for entry in entries[num_kept:]:
             entry_widget = SessionEntryWidget(entry)
             self.scroll_layout.addWidget(entry_widget)
-        else:
-            self.update_session_view()
+        self.update_usage_label()
         
         #
         self.scroll_to_bottom()